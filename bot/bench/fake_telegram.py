@@ -0,0 +1,99 @@
+import asyncio
+from itertools import count
+from time import perf_counter
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+
+
+class FakeMessage:
+    def __init__(self, chat_id: int, message_id: int, text: str | None = None):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+
+
+class FakeCallbackQuery:
+    def __init__(self, user_id: int, data: str):
+        self.from_user = FakeUser(user_id)
+        self.data = data
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+
+class FakeUpdate:
+    def __init__(self, user_id: int, callback_query=None, message=None):
+        self.effective_user = FakeUser(user_id)
+        self.callback_query = callback_query
+        self.message = message
+
+
+class FakeBot:
+    """Stands in for telegram.Bot, recording what would be sent with a simulated API latency"""
+
+    def __init__(self, latency=0.03):
+        self.latency = latency
+        self.message_ids = count(1)
+        # Map chat id to number of messages sent
+        self.sent: dict[int, int] = {}
+        self.send_seconds: list[float] = []
+
+    async def _send(self, chat_id: int, text: str | None = None) -> FakeMessage:
+        start = perf_counter()
+        await asyncio.sleep(self.latency)
+        self.sent[chat_id] = self.sent.get(chat_id, 0) + 1
+        self.send_seconds.append(perf_counter() - start)
+        return FakeMessage(chat_id, next(self.message_ids), text)
+
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> FakeMessage:
+        return await self._send(chat_id, text)
+
+    async def send_photo(self, chat_id: int, photo=None, caption=None, **kwargs):
+        return await self._send(chat_id, caption)
+
+    async def edit_message_text(
+        self, text: str, chat_id: int, message_id: int, **kwargs
+    ):
+        return await self._send(chat_id, text)
+
+    async def delete_message(self, chat_id: int, message_id: int, **kwargs):
+        await asyncio.sleep(self.latency)
+        return True
+
+    async def answer_inline_query(self, inline_query_id, results, **kwargs):
+        await asyncio.sleep(self.latency)
+
+
+class FakeApplication:
+    def __init__(self, bot: FakeBot):
+        self.bot = bot
+        self.tasks: set[asyncio.Task] = set()
+
+    def create_task(self, coroutine, *args, **kwargs) -> asyncio.Task:
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+
+class FakeContext:
+    def __init__(self, application: FakeApplication):
+        self.application = application
+        self.bot = application.bot
+
+
+def command_update(user_id: int, text: str) -> FakeUpdate:
+    """e.g. /start"""
+    return FakeUpdate(user_id, message=FakeMessage(user_id, 0, text))
+
+
+def callback_update(user_id: int, data: str) -> FakeUpdate:
+    """Inline keyboard button press"""
+    return FakeUpdate(user_id, callback_query=FakeCallbackQuery(user_id, data))
+
+
+def message_update(user_id: int, text: str) -> FakeUpdate:
+    return FakeUpdate(user_id, message=FakeMessage(user_id, 0, text))
@@ -0,0 +1,315 @@
+"""
+Load driver: ramps up concurrent simulated users against button_callback and message_handler
+until latency SLOs break, and reports which resource saturated first.
+
+Usage (from bot/): poetry run python bench/load.py --max-users 64 --oneinch-rps 10
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+from time import perf_counter
+
+from run import (
+    BenchEnvironment,
+    Dispatcher,
+    add_environment_arguments,
+    blocked_summary,
+    percentile,
+    print_blocked,
+    simulate_user,
+)
+
+# Steps that wait for transactions to be mined, held to their own (looser) SLO
+TRANSACTION_STEPS = {"buy", "withdraw_amount"}
+RESOURCES = ["event_loop", "db_connections", "oneinch_rate", "cpu"]
+
+
+class LoopLagProbe:
+    """Measures event loop lag: how late a sleep of interval seconds wakes up"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.samples: list[float] = []
+        self.task: asyncio.Task | None = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval))
+
+    def start(self):
+        self.samples = []
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+
+def cpu_seconds_total() -> dict[str, float]:
+    """Total seconds per operation in the bot's CPU bound work metric"""
+    from metrics import cpu_seconds
+
+    totals = {}
+    with cpu_seconds.lock:
+        for labels, (_, total, _) in cpu_seconds.values.items():
+            operation = dict(labels).get("operation", "")
+            totals[operation] = totals.get(operation, 0.0) + total
+    return totals
+
+
+async def run_step(
+    users: int, first_user_id: int, environment: BenchEnvironment, dispatcher
+) -> dict:
+    """Run one session per user, all at once, and measure what it cost"""
+    user_ids = [first_user_id + i for i in range(users)]
+    for user_id in user_ids:
+        environment.users.add_user(user_id)
+
+    db = environment.users
+    db.peak_connections = 0
+    db_busy_before = db.busy_seconds
+    oneinch_before = environment.oneinch_stats.total()
+    rate_limited_before = environment.oneinch_stats.rate_limited
+    cpu_before = cpu_seconds_total()
+    probe = LoopLagProbe()
+    probe.start()
+
+    results: dict = {}
+    start = perf_counter()
+    await asyncio.gather(
+        *(
+            simulate_user(user_id, dispatcher, environment.usdc_address, results)
+            for user_id in user_ids
+        )
+    )
+    elapsed = perf_counter() - start
+    await probe.stop()
+    await asyncio.gather(*environment.context.application.tasks, return_exceptions=True)
+
+    errors = results.pop("errors", {})
+    interactive = [
+        value
+        for name, values in results.items()
+        if name not in TRANSACTION_STEPS
+        for value in values
+    ]
+    transactions = [
+        value
+        for name, values in results.items()
+        if name in TRANSACTION_STEPS
+        for value in values
+    ]
+    cpu_after = cpu_seconds_total()
+    cpu = {
+        operation: total - cpu_before.get(operation, 0.0)
+        for operation, total in cpu_after.items()
+    }
+    return {
+        "users": users,
+        "elapsed_seconds": elapsed,
+        "updates": len(interactive) + len(transactions),
+        "errors": sum(len(errs) for errs in errors.values()),
+        "interactive_p95": percentile(interactive, 95),
+        "transaction_p95": percentile(transactions, 95),
+        "loop_lag_p99": percentile(probe.samples, 99),
+        "loop_lag_max": max(probe.samples, default=0.0),
+        "db_peak_connections": db.peak_connections,
+        "db_busy_seconds": db.busy_seconds - db_busy_before,
+        "oneinch_requests": environment.oneinch_stats.total() - oneinch_before,
+        "oneinch_rate_limited": environment.oneinch_stats.rate_limited
+        - rate_limited_before,
+        "cpu_seconds": cpu,
+    }
+
+
+def utilisation(step: dict, args) -> dict[str, float]:
+    """
+    How close each resource is to its limit, 1.0 meaning saturated:
+        event_loop: p99 loop lag against --max-loop-lag
+        db_connections: peak connections against --db-max-connections, or the share of wall
+            time spent in (blocking) queries if that is higher
+        oneinch_rate: 1inch requests per second against --oneinch-rps, or 1.0 once any were rate limited
+        cpu: share of one core spent rendering charts and deriving keys
+    """
+    elapsed = step["elapsed_seconds"] or 1.0
+    oneinch_rate = 0.0
+    if args.oneinch_rps:
+        oneinch_rate = step["oneinch_requests"] / elapsed / args.oneinch_rps
+    if step["oneinch_rate_limited"]:
+        oneinch_rate = max(oneinch_rate, 1.0)
+    return {
+        "event_loop": step["loop_lag_p99"] / args.max_loop_lag,
+        "db_connections": max(
+            step["db_peak_connections"] / args.db_max_connections,
+            step["db_busy_seconds"] / elapsed,
+        ),
+        "oneinch_rate": oneinch_rate,
+        "cpu": sum(step["cpu_seconds"].values()) / elapsed,
+    }
+
+
+def slo_breaches(step: dict, args) -> list[str]:
+    breaches = []
+    if step["interactive_p95"] > args.slo_p95:
+        breaches.append(
+            f"interactive p95 {step['interactive_p95']:.2f}s > {args.slo_p95}s"
+        )
+    if step["transaction_p95"] > args.slo_transaction_p95:
+        breaches.append(
+            f"transaction p95 {step['transaction_p95']:.2f}s > {args.slo_transaction_p95}s"
+        )
+    if step["updates"] and step["errors"] / step["updates"] > args.max_error_ratio:
+        breaches.append(f"{step['errors']} of {step['updates']} updates failed")
+    return breaches
+
+
+def first_saturated(steps: list[dict]) -> str | None:
+    """The resource that reached its limit at the lowest load, else the busiest one at the last step"""
+    for step in steps:
+        saturated = {
+            name: value for name, value in step["utilisation"].items() if value >= 1.0
+        }
+        if saturated:
+            return max(saturated, key=saturated.get)
+    if not steps:
+        return None
+    last = steps[-1]["utilisation"]
+    return max(last, key=last.get)
+
+
+async def run_load(args, environment: BenchEnvironment) -> dict:
+    import main
+    import cache.user
+    import features.ledger.recorder
+    from loop_monitor import LoopMonitor
+
+    cache.user.get_user = environment.users.get_user
+    main.add_user = environment.users.add_user
+    features.ledger.recorder.add_ledger_entry = environment.users.add_ledger_entry
+    await main.warm_up()
+    dispatcher = Dispatcher(main, environment.context, args.concurrent_updates)
+
+    monitor = LoopMonitor(threshold=args.block_threshold)
+    monitor.start()
+    steps = []
+    ceiling = 0
+    users = args.start_users
+    first_user_id = 10_000
+    while users <= args.max_users:
+        step = await run_step(users, first_user_id, environment, dispatcher)
+        first_user_id += users
+        step["utilisation"] = utilisation(step, args)
+        step["slo_breaches"] = slo_breaches(step, args)
+        steps.append(step)
+        if args.verbose_steps:
+            print_step(step)
+        if step["slo_breaches"]:
+            break
+        ceiling = users
+        users = max(users + 1, int(users * args.step_factor))
+    await monitor.stop()
+
+    return {
+        "concurrent_updates": args.concurrent_updates,
+        "ceiling_users": ceiling,
+        "slo_broken": bool(steps and steps[-1]["slo_breaches"]),
+        "saturated_first": first_saturated(steps),
+        "steps": steps,
+        "blocked": blocked_summary(monitor),
+    }
+
+
+def print_step(step: dict):
+    utilisation = "".join(f"{step['utilisation'][name]:>15.2f}" for name in RESOURCES)
+    print(
+        f"{step['users']:>6}{step['elapsed_seconds']:>9.2f}{step['interactive_p95']:>9.2f}"
+        f"{step['transaction_p95']:>9.2f}{step['errors']:>7}{utilisation}"
+    )
+
+
+def print_report(report: dict):
+    print(
+        f"{'users':>6}{'secs':>9}{'p95':>9}{'tx p95':>9}{'errors':>7}"
+        + "".join(f"{name:>15}" for name in RESOURCES)
+    )
+    for step in report["steps"]:
+        print_step(step)
+    print()
+    if report["slo_broken"]:
+        print(
+            f"SLO broke at {report['steps'][-1]['users']} users: "
+            + "; ".join(report["steps"][-1]["slo_breaches"])
+        )
+        print(f"Ceiling: {report['ceiling_users']} concurrent users")
+    else:
+        print(f"SLO held up to {report['ceiling_users']} concurrent users")
+    print(f"Saturated first: {report['saturated_first']}")
+    print_blocked(report["blocked"])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--start-users", type=int, default=1)
+    parser.add_argument("--max-users", type=int, default=64)
+    parser.add_argument(
+        "--step-factor",
+        type=float,
+        default=2.0,
+        help="Multiply concurrent users by this much each step",
+    )
+    parser.add_argument(
+        "--slo-p95",
+        type=float,
+        default=2.0,
+        help="p95 seconds for updates that don't wait on the chain",
+    )
+    parser.add_argument(
+        "--slo-transaction-p95",
+        type=float,
+        default=15.0,
+        help="p95 seconds for buy and withdraw, which wait for receipts",
+    )
+    parser.add_argument("--max-error-ratio", type=float, default=0.01)
+    parser.add_argument(
+        "--max-loop-lag",
+        type=float,
+        default=0.1,
+        help="p99 event loop lag (seconds) considered saturated",
+    )
+    parser.add_argument(
+        "--db-max-connections",
+        type=int,
+        default=151,
+        help="Connections the database allows (MySQL's default max_connections)",
+    )
+    add_environment_arguments(parser)
+    parser.add_argument("--json", help="Also write the report as JSON to this path")
+    parser.add_argument(
+        "--verbose-steps", action="store_true", help="Print each step as it finishes"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+    environment = BenchEnvironment(args)
+    try:
+        report = asyncio.run(run_load(args, environment))
+    finally:
+        environment.shutdown()
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
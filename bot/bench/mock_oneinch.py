@@ -0,0 +1,280 @@
+import json
+import random
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import monotonic, sleep, time
+from urllib.parse import urlparse, parse_qs
+
+# Address 1inch would return as the spender/router
+ROUTER_ADDRESS = "0x111111125421ca6dc452d289314280a0f8842a65"
+NATIVE_TOKEN_ADDRESS = "0xeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee"
+GAS_PRICE = 30 * 10**9
+
+
+class MockToken:
+    def __init__(self, address: str, symbol: str, decimals: int, usd_price: float):
+        self.address = address.lower()
+        self.symbol = symbol
+        self.decimals = decimals
+        self.usd_price = usd_price
+
+    def info(self, chain_id: int) -> dict:
+        return {
+            "chainId": chain_id,
+            "address": self.address,
+            "symbol": self.symbol,
+            "name": self.symbol,
+            "decimals": self.decimals,
+            "logoURI": "",
+            "tags": ["tokens"],
+        }
+
+
+class MockOneInchConfig:
+    def __init__(
+        self,
+        tokens: list[MockToken],
+        balances: dict[str, int],
+        latency=0.05,
+        jitter=0.02,
+        rate_limit_ratio=0.0,
+        retry_after=0,
+        rate_limit_rps=0.0,
+    ):
+        """
+        Args:
+            tokens: Tokens known to the mock (same on every chain)
+            balances: Map token address to the bigint balance every wallet holds
+            latency: Mean seconds added to every response
+            jitter: Seconds of uniform jitter around latency
+            rate_limit_ratio: Fraction of requests answered with 429
+            retry_after: Retry-After (seconds) sent with 429s
+            rate_limit_rps: Requests per second allowed before answering with 429, like the
+                1inch plan's rate limit. 0 for unlimited
+        """
+        self.tokens = {token.address: token for token in tokens}
+        self.balances = {address.lower(): value for address, value in balances.items()}
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.rate_limit_rps = rate_limit_rps
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, with bursts of up to one second's worth"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = monotonic()
+        self.lock = Lock()
+
+    def take(self) -> bool:
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(
+                self.rate, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class MockOneInchStats:
+    def __init__(self):
+        self.lock = Lock()
+        # Map endpoint name to number of requests
+        self.requests: dict[str, int] = {}
+        self.rate_limited = 0
+
+    def record(self, endpoint: str, rate_limited: bool):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            if rate_limited:
+                self.rate_limited += 1
+
+    def total(self) -> int:
+        with self.lock:
+            return sum(self.requests.values())
+
+
+# (endpoint name, path regex), checked in order
+ROUTES = [
+    ("quote", re.compile(r"^/swap/v6\.0/(?P<chain>\d+)/quote$")),
+    (
+        "approve_transaction",
+        re.compile(r"^/swap/v6\.0/(?P<chain>\d+)/approve/transaction$"),
+    ),
+    (
+        "approve_allowance",
+        re.compile(r"^/swap/v6\.0/(?P<chain>\d+)/approve/allowance$"),
+    ),
+    ("swap", re.compile(r"^/swap/v6\.0/(?P<chain>\d+)/swap$")),
+    (
+        "token_custom",
+        re.compile(r"^/token/v1\.2/(?P<chain>\d+)/custom/(?P<address>0x[0-9a-fA-F]+)$"),
+    ),
+    ("token_search", re.compile(r"^/token/v1\.2/(?P<chain>\d+)/search$")),
+    ("token_list", re.compile(r"^/token/v1\.2/(?P<chain>\d+)$")),
+    (
+        "balances",
+        re.compile(
+            r"^/balance/v1\.2/(?P<chain>\d+)/balances/(?P<wallet>0x[0-9a-fA-F]+)$"
+        ),
+    ),
+    (
+        "chart",
+        re.compile(
+            r"^/charts/v1\.0/chart/line/(?P<token0>0x[0-9a-fA-F]+)/(?P<token1>0x[0-9a-fA-F]+)/(?P<period>\w+)/(?P<chain>\d+)$"
+        ),
+    ),
+]
+
+
+def make_handler(config: MockOneInchConfig, stats: MockOneInchStats):
+    bucket = TokenBucket(config.rate_limit_rps) if config.rate_limit_rps else None
+
+    class MockOneInchHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            self.handle_request(None)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            self.handle_request(body)
+
+        def send_json(self, status: int, payload, headers: dict | None = None):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def handle_request(self, body):
+            url = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            for endpoint, pattern in ROUTES:
+                match = pattern.match(url.path)
+                if match:
+                    break
+            else:
+                stats.record("unknown", False)
+                self.send_json(404, {"description": f"Unknown path {url.path}"})
+                return
+
+            sleep(
+                max(0.0, config.latency + random.uniform(-config.jitter, config.jitter))
+            )
+
+            rate_limited = random.random() < config.rate_limit_ratio or (
+                bucket is not None and not bucket.take()
+            )
+            stats.record(endpoint, rate_limited)
+            if rate_limited:
+                self.send_json(
+                    429,
+                    {"description": "Too Many Requests"},
+                    {"Retry-After": str(config.retry_after)},
+                )
+                return
+
+            status, payload = respond(config, endpoint, match.groupdict(), params, body)
+            self.send_json(status, payload)
+
+    return MockOneInchHandler
+
+
+def _quote_amount(config: MockOneInchConfig, src: str, dst: str, amount: int) -> int:
+    src_token = config.tokens.get(src.lower())
+    dst_token = config.tokens.get(dst.lower())
+    if not src_token or not dst_token:
+        return 0
+    usd = amount / 10**src_token.decimals * src_token.usd_price
+    return int(usd / dst_token.usd_price * 10**dst_token.decimals)
+
+
+def respond(config: MockOneInchConfig, endpoint: str, path: dict, params: dict, body):
+    chain_id = int(path["chain"])
+    if endpoint == "quote":
+        amount = _quote_amount(
+            config, params["src"], params["dst"], int(params["amount"])
+        )
+        return 200, {"dstAmount": str(amount)}
+    if endpoint == "approve_transaction":
+        amount = int(params.get("amount", 2**256 - 1))
+        data = "0x095ea7b3" + ROUTER_ADDRESS[2:].rjust(64, "0") + f"{amount:064x}"
+        return 200, {
+            "data": data,
+            "gasPrice": str(GAS_PRICE),
+            "to": params["tokenAddress"],
+            "value": "0",
+        }
+    if endpoint == "approve_allowance":
+        # Always needs approving, which is the slowest path through the swap
+        return 200, {"allowance": "0"}
+    if endpoint == "swap":
+        amount = int(params["amount"])
+        return 200, {
+            "dstAmount": str(
+                _quote_amount(config, params["src"], params["dst"], amount)
+            ),
+            "tx": {
+                "from": params["from"],
+                "to": ROUTER_ADDRESS,
+                "data": "0x12aa3caf" + f"{amount:064x}",
+                "value": "0",
+                "gas": 0 if params.get("disableEstimate") == "true" else 250000,
+                "gasPrice": str(GAS_PRICE),
+            },
+        }
+    if endpoint == "token_custom":
+        token = config.tokens.get(path["address"].lower())
+        if not token:
+            return 400, {"description": "Token not found"}
+        return 200, token.info(chain_id)
+    if endpoint == "token_search":
+        query = params.get("query", "").lower()
+        return 200, [
+            token.info(chain_id)
+            for token in config.tokens.values()
+            if query in token.symbol.lower()
+        ]
+    if endpoint == "token_list":
+        return 200, {
+            token.address: token.info(chain_id) for token in config.tokens.values()
+        }
+    if endpoint == "balances":
+        if body and body.get("tokens"):
+            return 200, {
+                address: str(config.balances.get(address.lower(), 0))
+                for address in body["tokens"]
+            }
+        return 200, {address: str(value) for address, value in config.balances.items()}
+    if endpoint == "chart":
+        now = int(time())
+        return 200, {
+            "data": [
+                {"time": now - 3600 * i, "value": 1 + random.uniform(-0.05, 0.05)}
+                for i in range(24, 0, -1)
+            ]
+        }
+    return 404, {}
+
+
+def start_mock_oneinch(config: MockOneInchConfig, host="127.0.0.1", port=0):
+    """Start the mock on a background thread. Returns (server, stats), the url is http://host:server.server_port"""
+    stats = MockOneInchStats()
+    server = ThreadingHTTPServer((host, port), make_handler(config, stats))
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True, name="mock-1inch").start()
+    return server, stats
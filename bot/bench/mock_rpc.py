@@ -0,0 +1,193 @@
+import json
+import random
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import monotonic, sleep, time
+from eth_account import Account
+from eth_utils import keccak
+
+# ERC20 balanceOf(address) selector
+BALANCE_OF_SELECTOR = "0x70a08231"
+GAS_PRICE = 30 * 10**9
+
+
+class MockChain:
+    """
+    In-process stand-in for an EVM node, enough for wallet.py: blocks advance with time,
+    sent transactions are mined in the next block and always succeed.
+    """
+
+    def __init__(
+        self,
+        chain_id: int,
+        token_balance: int,
+        native_balance: int,
+        block_time=1.0,
+        latency=0.02,
+    ):
+        self.chain_id = chain_id
+        self.token_balance = token_balance
+        self.native_balance = native_balance
+        self.block_time = block_time
+        self.latency = latency
+        self.started_at = monotonic()
+        self.lock = Lock()
+        # Map tx hash to (sender, nonce, block it is mined in)
+        self.transactions: dict[str, tuple[str, int, int]] = {}
+        # Map lowercase sender address to number of transactions sent
+        self.nonces: dict[str, int] = {}
+        self.calls = 0
+
+    def block_number(self) -> int:
+        return int((monotonic() - self.started_at) / self.block_time) + 1
+
+    def send_raw_transaction(self, raw: str) -> str:
+        raw_bytes = bytes.fromhex(raw[2:])
+        sender = Account.recover_transaction(raw_bytes).lower()
+        tx_hash = "0x" + keccak(raw_bytes).hex()
+        with self.lock:
+            nonce = self.nonces.get(sender, 0)
+            self.nonces[sender] = nonce + 1
+            self.transactions[tx_hash] = (sender, nonce, self.block_number() + 1)
+        return tx_hash
+
+    def transaction_count(self, address: str, block: str) -> int:
+        address = address.lower()
+        with self.lock:
+            if block == "pending":
+                return self.nonces.get(address, 0)
+            current = self.block_number()
+            return sum(
+                1
+                for sender, _, mined_in in self.transactions.values()
+                if sender == address and mined_in <= current
+            )
+
+    def receipt(self, tx_hash: str) -> dict | None:
+        with self.lock:
+            tx = self.transactions.get(tx_hash)
+        if tx is None or tx[2] > self.block_number():
+            return None
+        sender, nonce, mined_in = tx
+        return {
+            "blockHash": "0x" + keccak(text=str(mined_in)).hex(),
+            "blockNumber": hex(mined_in),
+            "contractAddress": None,
+            "cumulativeGasUsed": hex(150000),
+            "effectiveGasPrice": hex(GAS_PRICE),
+            "from": sender,
+            "gasUsed": hex(150000),
+            "logs": [],
+            "logsBloom": "0x" + "00" * 256,
+            "status": "0x1",
+            "to": sender,
+            "transactionHash": tx_hash,
+            "transactionIndex": "0x0",
+            "type": "0x0",
+        }
+
+    def block(self, number: int) -> dict:
+        return {
+            "number": hex(number),
+            "hash": "0x" + keccak(text=str(number)).hex(),
+            "parentHash": "0x" + keccak(text=str(number - 1)).hex(),
+            "timestamp": hex(int(time())),
+            "baseFeePerGas": hex(GAS_PRICE),
+            "gasLimit": hex(30_000_000),
+            "gasUsed": hex(0),
+            "miner": "0x" + "00" * 20,
+            "extraData": "0x",
+            "difficulty": "0x0",
+            "nonce": "0x0000000000000000",
+            "logsBloom": "0x" + "00" * 256,
+            "sha3Uncles": "0x" + "00" * 32,
+            "stateRoot": "0x" + "00" * 32,
+            "transactionsRoot": "0x" + "00" * 32,
+            "receiptsRoot": "0x" + "00" * 32,
+            "size": hex(1000),
+            "transactions": [],
+            "uncles": [],
+        }
+
+    def handle(self, method: str, params: list):
+        if method == "web3_clientVersion":
+            return "bench-mock-chain/v1"
+        if method == "eth_chainId":
+            return hex(self.chain_id)
+        if method == "net_version":
+            return str(self.chain_id)
+        if method == "eth_blockNumber":
+            return hex(self.block_number())
+        if method == "eth_getBlockByNumber":
+            tag = params[0]
+            number = self.block_number() if not tag.startswith("0x") else int(tag, 16)
+            return self.block(number)
+        if method == "eth_gasPrice":
+            return hex(GAS_PRICE)
+        if method == "eth_maxPriorityFeePerGas":
+            return hex(10**9)
+        if method == "eth_estimateGas":
+            return hex(150000)
+        if method == "eth_getTransactionCount":
+            return hex(self.transaction_count(params[0], params[1]))
+        if method == "eth_getBalance":
+            return hex(self.native_balance)
+        if method == "eth_call":
+            if (
+                params[0]
+                .get("data", params[0].get("input", ""))
+                .startswith(BALANCE_OF_SELECTOR)
+            ):
+                return "0x" + f"{self.token_balance:064x}"
+            return "0x"
+        if method == "eth_sendRawTransaction":
+            return self.send_raw_transaction(params[0])
+        if method == "eth_getTransactionReceipt":
+            return self.receipt(params[0])
+        if method == "eth_getLogs":
+            return []
+        raise ValueError(f"Unsupported method {method}")
+
+
+def make_handler(chain: MockChain):
+    class MockRPCHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def respond(self, request: dict) -> dict:
+            response = {"jsonrpc": "2.0", "id": request.get("id")}
+            try:
+                response["result"] = chain.handle(
+                    request["method"], request.get("params", [])
+                )
+            except Exception as e:
+                response["error"] = {"code": -32000, "message": str(e)}
+            return response
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            sleep(max(0.0, chain.latency * random.uniform(0.5, 1.5)))
+            with chain.lock:
+                chain.calls += 1
+            # A batch is one round trip for all of its requests
+            if isinstance(request, list):
+                response = [self.respond(item) for item in request]
+            else:
+                response = self.respond(request)
+            data = json.dumps(response).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return MockRPCHandler
+
+
+def start_mock_rpc(chain: MockChain, host="127.0.0.1", port=0):
+    """Start the mock node on a background thread. The url is http://host:server.server_port"""
+    server = ThreadingHTTPServer((host, port), make_handler(chain))
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True, name="mock-rpc").start()
+    return server
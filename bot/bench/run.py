@@ -0,0 +1,455 @@
+"""
+Offline benchmark: replays simulated users through /start, Refresh, All Chains, Buy and Withdraw
+against local stand-ins for 1inch, the chain RPC and Telegram, then reports latencies.
+
+Usage (from bot/): poetry run python bench/run.py --users 20
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+from pathlib import Path
+from threading import Lock
+from time import perf_counter, sleep
+
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+sys.path.insert(0, str(SRC_DIR))
+
+from mock_oneinch import (
+    MockOneInchConfig,
+    MockToken,
+    NATIVE_TOKEN_ADDRESS,
+    start_mock_oneinch,
+)
+from mock_rpc import MockChain, start_mock_rpc
+from fake_telegram import (
+    FakeApplication,
+    FakeBot,
+    FakeContext,
+    callback_update,
+    command_update,
+    message_update,
+)
+
+CHAIN_ID = 137
+# Well known development mnemonic (hardhat/anvil), never holds real funds
+TEST_MNEMONIC = "test test test test test test test test test test test junk"
+WETH_ADDRESS = "0x7ceb23fd6bc0add59e62ac25578270cff1b9f619"
+WITHDRAW_TO_ADDRESS = "0x000000000000000000000000000000000000dEaD"
+
+# Run in a fresh interpreter, as a restarted container would: time to import the bot, then to warm up
+STARTUP_SCRIPT = """
+import asyncio, json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+for network in main.networks.values():
+    network["rpc"] = sys.argv[1]
+asyncio.run(main.warm_up())
+print(json.dumps({"import_seconds": imported - start, "warm_up_seconds": time.perf_counter() - imported}))
+"""
+
+
+class InMemoryUsers:
+    """
+    Stands in for the users and ledger tables, with every user already set up to trade WETH/USDC.
+    Like mysql.connector, each call holds a connection for latency seconds and blocks the caller.
+    """
+
+    def __init__(self, usdc_address: str, latency=0.0):
+        self.usdc_address = usdc_address
+        self.latency = latency
+        self.users: dict[int, dict] = {}
+        self.ledger: list[dict] = []
+        self.lock = Lock()
+        self.connections = 0
+        self.peak_connections = 0
+        self.calls = 0
+        self.busy_seconds = 0.0
+
+    def _connect(self):
+        with self.lock:
+            self.calls += 1
+            self.connections += 1
+            self.peak_connections = max(self.peak_connections, self.connections)
+        start = perf_counter()
+        sleep(self.latency)
+        with self.lock:
+            self.connections -= 1
+            self.busy_seconds += perf_counter() - start
+
+    def add_user(self, user_id: int):
+        self._connect()
+        self.users[user_id] = {
+            "id": user_id,
+            "derivation_path": len(self.users) + 1,
+            "slippage": 1.0,
+            "chain_id": CHAIN_ID,
+            "token0_address": WETH_ADDRESS,
+            "token0_name": "WETH",
+            "token1_address": self.usdc_address,
+            "token1_name": "USDC",
+        }
+
+    def add_ledger_entry(self, entry: dict, position_changes: list[dict]) -> bool:
+        self._connect()
+        with self.lock:
+            self.ledger.append(entry)
+        return True
+
+    def get_user(self, user_id: int):
+        from features.session.types import User
+
+        self._connect()
+        user = self.users.get(user_id)
+        return User(**user) if user else None
+
+
+class BenchEnvironment:
+    def __init__(self, args):
+        """Start the stand-ins and point the bot at them. Must happen before the bot modules are imported."""
+        os.environ["ONEINCH_API_KEY"] = "bench"
+        os.environ["ONEINCH_POST_DELAY"] = str(args.post_delay)
+        os.environ["DERIVATION_MASTER_KEY"] = TEST_MNEMONIC
+
+        import constants
+
+        self.usdc_address = constants.networks[CHAIN_ID]["usdc_address"]
+        self.oneinch_config = MockOneInchConfig(
+            tokens=[
+                MockToken(self.usdc_address, "USDC", 6, 1.0),
+                MockToken(WETH_ADDRESS, "WETH", 18, 2500.0),
+                MockToken(NATIVE_TOKEN_ADDRESS, "POL", 18, 0.4),
+            ],
+            balances={
+                self.usdc_address: 1000 * 10**6,
+                WETH_ADDRESS: 10**18,
+                NATIVE_TOKEN_ADDRESS: 50 * 10**18,
+            },
+            latency=args.oneinch_latency,
+            jitter=args.oneinch_latency / 2,
+            rate_limit_ratio=args.rate_limit_ratio,
+            rate_limit_rps=args.oneinch_rps,
+        )
+        self.oneinch_server, self.oneinch_stats = start_mock_oneinch(
+            self.oneinch_config
+        )
+        os.environ["ONEINCH_API_BASE_URL"] = (
+            f"http://127.0.0.1:{self.oneinch_server.server_port}"
+        )
+
+        self.chain = MockChain(
+            CHAIN_ID,
+            token_balance=10**18,
+            native_balance=50 * 10**18,
+            block_time=args.block_time,
+            latency=args.rpc_latency,
+        )
+        self.rpc_server = start_mock_rpc(self.chain)
+        rpc_url = f"http://127.0.0.1:{self.rpc_server.server_port}"
+        for network in constants.networks.values():
+            network["rpc"] = rpc_url
+
+        self.users = InMemoryUsers(self.usdc_address, latency=args.db_latency)
+        self.bot = FakeBot(latency=args.telegram_latency)
+        self.context = FakeContext(FakeApplication(self.bot))
+
+    def measure_startup(self) -> dict:
+        """Startup of a fresh bot process: interpreter and imports until it can poll, then the background warm-up"""
+        rpc_url = f"http://127.0.0.1:{self.rpc_server.server_port}"
+        start = perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT, rpc_url],
+            cwd=SRC_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        process_seconds = perf_counter() - start
+        startup = json.loads(output.strip().splitlines()[-1])
+        # Interpreter start up plus imports, i.e. until the bot could start polling
+        startup["ready_seconds"] = process_seconds - startup["warm_up_seconds"]
+        return startup
+
+    def shutdown(self):
+        self.oneinch_server.shutdown()
+        self.rpc_server.shutdown()
+
+
+class Dispatcher:
+    """
+    Feeds updates to the bot's handlers the way python-telegram-bot would:
+    one at a time unless concurrent updates are enabled.
+    """
+
+    def __init__(self, main_module, context, concurrent_updates: bool):
+        self.main = main_module
+        self.context = context
+        self.lock = None if concurrent_updates else asyncio.Lock()
+
+    async def dispatch(self, handler, update):
+        if self.lock is None:
+            return await handler(update, self.context)
+        async with self.lock:
+            return await handler(update, self.context)
+
+    def start(self, user_id: int):
+        return self.dispatch(self.main.start, command_update(user_id, "/start"))
+
+    def press(self, user_id: int, data: str):
+        return self.dispatch(self.main.button_callback, callback_update(user_id, data))
+
+    def send(self, user_id: int, text: str):
+        return self.dispatch(self.main.message_handler, message_update(user_id, text))
+
+
+async def simulate_user(
+    user_id: int, dispatcher: Dispatcher, token_address: str, results: dict
+):
+    """One user's session: open the bot, refresh, view all chains, buy 50%, then withdraw"""
+    from features.commands.types import Command
+
+    steps = [
+        ("start", lambda: dispatcher.start(user_id)),
+        ("refresh", lambda: dispatcher.press(user_id, Command.REFRESH.value)),
+        ("portfolio", lambda: dispatcher.press(user_id, Command.PORTFOLIO.value)),
+        ("buy_menu", lambda: dispatcher.press(user_id, Command.BUY.value)),
+        ("buy", lambda: dispatcher.press(user_id, "50")),
+        ("withdraw_menu", lambda: dispatcher.press(user_id, Command.WITHDRAW.value)),
+        ("withdraw_token", lambda: dispatcher.press(user_id, token_address)),
+        ("withdraw_address", lambda: dispatcher.send(user_id, WITHDRAW_TO_ADDRESS)),
+        ("withdraw_amount", lambda: dispatcher.send(user_id, "1")),
+    ]
+    for name, step in steps:
+        start = perf_counter()
+        try:
+            await step()
+        except Exception as e:
+            results.setdefault("errors", {}).setdefault(name, []).append(repr(e))
+        results.setdefault(name, []).append(perf_counter() - start)
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Nearest-rank percentile"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def summarise(values: list[float]) -> dict:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values, default=0.0),
+    }
+
+
+def upstream_summary() -> dict:
+    """Calls and total seconds per upstream operation, from the bot's own metrics"""
+    from metrics import upstream_seconds, cpu_seconds
+
+    summary = {}
+    for metric in (upstream_seconds, cpu_seconds):
+        with metric.lock:
+            for labels, (_, total, count) in metric.values.items():
+                summary[",".join(f"{k}={v}" for k, v in labels)] = {
+                    "count": count,
+                    "total_seconds": total,
+                }
+    return summary
+
+
+def blocked_summary(monitor) -> dict:
+    """Calls that blocked the event loop, grouped by offender, worst first"""
+    summary: dict[str, dict] = {}
+    for blocked in monitor.blocked:
+        entry = summary.setdefault(
+            blocked.offender,
+            {"count": 0, "total_seconds": 0.0, "stack": blocked.format_stack()},
+        )
+        entry["count"] += 1
+        entry["total_seconds"] += blocked.seconds
+    return dict(
+        sorted(summary.items(), key=lambda item: item[1]["total_seconds"], reverse=True)
+    )
+
+
+def print_blocked(blocked: dict):
+    if not blocked:
+        return
+    print("\nEvent loop blocked by:")
+    for offender, entry in blocked.items():
+        print(f"  {offender:<40}{entry['count']:>5}x {entry['total_seconds']:>8.2f}s")
+    worst, entry = next(iter(blocked.items()))
+    print(f"\nStack of {worst} while blocking:\n{entry['stack']}")
+
+
+async def run_benchmark(args, environment: BenchEnvironment) -> dict:
+    import main
+    import cache.user
+    import features.ledger.recorder
+    from features.outbox.sender import get_outbox
+    from loop_monitor import LoopMonitor
+
+    # Swap the users and ledger tables for the in-memory stand-in
+    cache.user.get_user = environment.users.get_user
+    main.add_user = environment.users.add_user
+    features.ledger.recorder.add_ledger_entry = environment.users.add_ledger_entry
+
+    # As post_init does, so users are measured against a warmed up bot
+    await main.warm_up()
+
+    dispatcher = Dispatcher(main, environment.context, args.concurrent_updates)
+    user_ids = [10_000 + i for i in range(args.users)]
+    for user_id in user_ids:
+        environment.users.add_user(user_id)
+
+    monitor = LoopMonitor(threshold=args.block_threshold)
+    monitor.start()
+    results: dict = {}
+    start = perf_counter()
+    await asyncio.gather(
+        *(
+            simulate_user(user_id, dispatcher, environment.usdc_address, results)
+            for user_id in user_ids
+        )
+    )
+    elapsed = perf_counter() - start
+    # Let background work (e.g. prefetches) finish so it doesn't leak into the next run
+    await asyncio.gather(*environment.context.application.tasks, return_exceptions=True)
+    # Messages are sent from the outbox after the handlers return, count them once all are out
+    await get_outbox(environment.bot).flush()
+    await features.ledger.recorder.flush()
+    await monitor.stop()
+
+    errors = results.pop("errors", {})
+    steps = {name: summarise(values) for name, values in results.items()}
+    total_updates = sum(step["count"] for step in steps.values())
+    return {
+        "users": args.users,
+        "concurrent_updates": args.concurrent_updates,
+        "elapsed_seconds": elapsed,
+        "throughput_updates_per_second": total_updates / elapsed if elapsed else 0.0,
+        "throughput_sessions_per_second": args.users / elapsed if elapsed else 0.0,
+        "steps": steps,
+        "errors": {name: len(errs) for name, errs in errors.items()},
+        "error_samples": {name: errs[:3] for name, errs in errors.items()},
+        "oneinch_requests": dict(environment.oneinch_stats.requests),
+        "oneinch_rate_limited": environment.oneinch_stats.rate_limited,
+        "rpc_calls": environment.chain.calls,
+        "telegram_messages": sum(environment.bot.sent.values()),
+        "ledger_entries": len(environment.users.ledger),
+        "upstream": upstream_summary(),
+        "blocked": blocked_summary(monitor),
+        "startup": environment.measure_startup(),
+    }
+
+
+def print_report(report: dict):
+    print(
+        f"{report['users']} users in {report['elapsed_seconds']:.2f}s "
+        f"({report['throughput_updates_per_second']:.2f} updates/s, "
+        f"{report['throughput_sessions_per_second']:.2f} sessions/s, "
+        f"concurrent updates: {report['concurrent_updates']})"
+    )
+    startup = report["startup"]
+    print(
+        f"Startup: ready to poll in {startup['ready_seconds']:.2f}s "
+        f"(imports {startup['import_seconds']:.2f}s), "
+        f"warm up in the background {startup['warm_up_seconds']:.2f}s"
+    )
+    print(f"{'step':<18}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for name, step in report["steps"].items():
+        print(
+            f"{name:<18}{step['count']:>7}{step['p50']:>9.3f}{step['p95']:>9.3f}"
+            f"{step['p99']:>9.3f}{step['max']:>9.3f}"
+        )
+    print(
+        f"\n1inch requests: {sum(report['oneinch_requests'].values())} "
+        f"({report['oneinch_rate_limited']} rate limited), RPC calls: {report['rpc_calls']}, "
+        f"Telegram messages: {report['telegram_messages']}, "
+        f"ledger entries: {report['ledger_entries']}"
+    )
+    if report["errors"]:
+        print(f"Errors: {report['errors']}")
+        for name, samples in report["error_samples"].items():
+            print(f"  {name}: {samples[0]}")
+    print_blocked(report["blocked"])
+
+
+def add_environment_arguments(parser: argparse.ArgumentParser):
+    """Options for the stand-ins, shared with bench/load.py"""
+    parser.add_argument(
+        "--concurrent-updates",
+        action="store_true",
+        help="Handle updates concurrently (python-telegram-bot handles them one at a time by default)",
+    )
+    parser.add_argument("--oneinch-latency", type=float, default=0.05)
+    parser.add_argument(
+        "--rate-limit-ratio",
+        type=float,
+        default=0.0,
+        help="Fraction of 1inch requests answered with 429",
+    )
+    parser.add_argument(
+        "--oneinch-rps",
+        type=float,
+        default=0.0,
+        help="1inch requests per second allowed before answering with 429 (0 for unlimited)",
+    )
+    parser.add_argument(
+        "--post-delay",
+        type=float,
+        default=0.0,
+        help="OneInchAPI post_delay (the bot's default is 1s)",
+    )
+    parser.add_argument("--rpc-latency", type=float, default=0.02)
+    parser.add_argument("--block-time", type=float, default=0.5)
+    parser.add_argument("--telegram-latency", type=float, default=0.03)
+    parser.add_argument(
+        "--db-latency",
+        type=float,
+        default=0.0,
+        help="Seconds each users table query holds a connection",
+    )
+    parser.add_argument(
+        "--block-threshold",
+        type=float,
+        default=0.1,
+        help="Report callbacks that block the event loop for longer than this (seconds)",
+    )
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's logs")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=10, help="Simulated users")
+    add_environment_arguments(parser)
+    parser.add_argument("--json", help="Also write the report as JSON to this path")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+    environment = BenchEnvironment(args)
+    try:
+        report = asyncio.run(run_benchmark(args, environment))
+    finally:
+        environment.shutdown()
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
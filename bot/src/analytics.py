@@ -0,0 +1,135 @@
+"""
+Admin analytics: streams every user from the database, fetches their wallets' balances on each chain
+within the 1inch rate budget, and writes aggregates: AUM per chain and token, active users, and the
+popularity of chains and token pairs.
+
+Usage (from bot/): poetry run python src/analytics.py --out analytics --format parquet
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+from os import getenv
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+
+from constants import networks
+from logger import setup_logging
+from features.analytics.aggregate import (
+    Aggregates,
+    RateLimiter,
+    price_holdings,
+    scan_wallets,
+)
+from features.analytics.report import (
+    FORMATS,
+    aum_rows,
+    chain_rows,
+    pair_rows,
+    pyarrow,
+    write_table,
+)
+from features.database.ledger import count_active_users, get_pair_activity
+from features.tokens.registry import load_registry
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--out", default="analytics", help="Directory to write the tables to"
+    )
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument(
+        "--chains",
+        type=int,
+        nargs="+",
+        default=list(networks),
+        help="Chain ids to fetch balances on (default: all)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=500,
+        help="Users read from the database at a time",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="1inch requests in flight at once"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=float(getenv("ANALYTICS_ONEINCH_RPS", "1")),
+        help="1inch requests per second to stay within, leave room for the bot if it shares the API key",
+    )
+    parser.add_argument(
+        "--active-days",
+        type=int,
+        default=30,
+        help="Users who sent a transaction in this many days count as active",
+    )
+    args = parser.parse_args(argv)
+    if args.format == "parquet" and pyarrow is None:
+        parser.error("--format parquet needs pyarrow, install it or use csv")
+    unknown = set(args.chains) - set(networks)
+    if unknown:
+        parser.error(f"Unknown chains: {', '.join(map(str, unknown))}")
+    return args
+
+
+async def run(args) -> dict[str, list[dict]]:
+    for chain_id in args.chains:
+        # Token info from the last registry sync, so only unknown tokens cost a request
+        try:
+            await asyncio.to_thread(load_registry, chain_id)
+        except Exception:
+            logger.exception(
+                "Failed to load token registry", extra={"chain_id": chain_id}
+            )
+
+    since = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(
+        days=args.active_days
+    )
+    # Read from the ledger while the wallets are scanned
+    ledger = asyncio.gather(
+        asyncio.to_thread(get_pair_activity, since),
+        asyncio.to_thread(count_active_users, since),
+    )
+
+    aggregates = Aggregates()
+    limiter = RateLimiter(args.rate)
+    await scan_wallets(
+        aggregates, limiter, args.chains, args.chunk_size, args.concurrency
+    )
+    await price_holdings(aggregates, limiter, args.concurrency)
+    pair_activity, active_users = await ledger
+
+    return {
+        "chains": chain_rows(aggregates, args.chains, active_users),
+        "tokens": aum_rows(aggregates),
+        "pairs": pair_rows(aggregates, pair_activity),
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging()
+    start = perf_counter()
+    tables = asyncio.run(run(args))
+
+    os.makedirs(args.out, exist_ok=True)
+    for name, rows in tables.items():
+        path = write_table(args.out, name, rows, args.format)
+        print(f"Wrote {len(rows)} rows to {path}")
+    for chain in tables["chains"]:
+        print(
+            f"{chain['chain']}: {chain['aum_usd']:.2f} USD across {chain['funded_wallets']} wallets, "
+            f"{chain['users']} users, {chain['active_users']} active in {args.active_days} days"
+        )
+    print(f"Done in {perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+from time import time
+
+# Last known balances of a wallet. Used when 1inch cannot return fresh ones, and in place of fetching
+# them while the balance watcher keeps them up to date.
+# Map (chain id, lowercase wallet address) to (mapping of token address to bigint balance string, unix time fetched)
+wallet_balances: dict[tuple[int, str], tuple[dict[str, str], float]] = {}
+
+
+def get_cached_balances(
+    chain_id: int, wallet_address: str, max_age: float | None = None
+) -> dict[str, str] | None:
+    """Balances fetched less than max_age seconds ago, or the last fetched if no max_age"""
+    cached = wallet_balances.get((chain_id, wallet_address.lower()))
+    if not cached or (max_age is not None and time() - cached[1] > max_age):
+        return None
+    return cached[0]
+
+
+def set_cached_balances(chain_id: int, wallet_address: str, balances: dict[str, str]):
+    wallet_balances[(chain_id, wallet_address.lower())] = (balances, time())
+
+
+def get_balances_fetched_at(chain_id: int, wallet_address: str) -> float | None:
+    """Unix time the wallet's cached balances were fetched, None if not cached"""
+    cached = wallet_balances.get((chain_id, wallet_address.lower()))
+    return cached[1] if cached else None
+
+
+def unset_cached_balances(chain_id: int, wallet_address: str):
+    wallet_balances.pop((chain_id, wallet_address.lower()), None)
+
+
+def unset_chain_balances(chain_id: int):
+    for key in [key for key in wallet_balances if key[0] == chain_id]:
+        del wallet_balances[key]
+
+
+def apply_balance_change(
+    chain_id: int, wallet_address: str, token_address: str, delta: int
+) -> bool:
+    """Add delta to one token's cached balance. False if the wallet's balances are not cached."""
+    key = (chain_id, wallet_address.lower())
+    cached = wallet_balances.get(key)
+    if not cached:
+        return False
+    balances, fetched_at = cached
+    balance = max(int(balances.get(token_address, "0")) + delta, 0)
+    # A new dict, as a menu being rendered may be holding the old one
+    wallet_balances[key] = ({**balances, token_address: str(balance)}, fetched_at)
+    return True
@@ -0,0 +1,27 @@
+from features.swap.types import PrefetchedCalldata
+
+# Map user id to (chain id, token address, approve calldata) prefetched while the buy/sell menu is showing
+user_approve_calldata: dict[int, tuple[int, str, PrefetchedCalldata]] = {}
+
+
+def get_user_approve_calldata(
+    user_id: int, chain_id: int, token_address: str
+) -> PrefetchedCalldata | None:
+    cached = user_approve_calldata.get(user_id)
+    if not cached:
+        return None
+    cached_chain_id, cached_token_address, prefetched = cached
+    if cached_chain_id != chain_id or cached_token_address != token_address:
+        return None
+    return prefetched
+
+
+def set_user_approve_calldata(
+    user_id: int, chain_id: int, token_address: str, prefetched: PrefetchedCalldata
+):
+    user_approve_calldata[user_id] = (chain_id, token_address, prefetched)
+
+
+def unset_user_approve_calldata(user_id: int):
+    # Default value just to ignore errors
+    user_approve_calldata.pop(user_id, 0)
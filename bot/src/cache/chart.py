@@ -0,0 +1,25 @@
+from time import time
+
+# Last chart data fetched for a pair, used when 1inch cannot return fresh data
+# Map (chain id, token0 address, token1 address, period) to (chart data, unix time fetched)
+chart_data: dict[tuple[int, str, str, str], tuple[dict, float]] = {}
+
+
+def get_cached_chart_data(
+    chain_id: int,
+    token0_address: str,
+    token1_address: str,
+    period: str,
+    max_age: float | None = None,
+) -> dict | None:
+    """Chart data fetched less than max_age seconds ago, or the last fetched if no max_age"""
+    cached = chart_data.get((chain_id, token0_address, token1_address, period))
+    if not cached or (max_age is not None and time() - cached[1] > max_age):
+        return None
+    return cached[0]
+
+
+def set_cached_chart_data(
+    chain_id: int, token0_address: str, token1_address: str, period: str, data: dict
+):
+    chart_data[(chain_id, token0_address, token1_address, period)] = (data, time())
@@ -0,0 +1,37 @@
+from time import monotonic, time
+
+# Last known USD price of a token, used when 1inch cannot give a fresh quote
+# Map (chain id, lowercase token address) to (usd per whole token, unix time of the quote)
+usd_prices: dict[tuple[int, str], tuple[float, float]] = {}
+
+
+def get_cached_usd_price(chain_id: int, token_address: str) -> float | None:
+    cached = usd_prices.get((chain_id, token_address.lower()))
+    return cached[0] if cached else None
+
+
+def set_cached_usd_price(chain_id: int, token_address: str, price: float):
+    usd_prices[(chain_id, token_address.lower())] = (price, time())
+
+
+# Last quoted price of token0 in token1, shared by the background workers that poll prices
+# Map (chain id, lowercase token0 address, lowercase token1 address) to (token1 per token0, monotonic time of the quote)
+pair_prices: dict[tuple[int, str, str], tuple[float, float]] = {}
+
+
+def get_cached_pair_price(
+    chain_id: int, token0_address: str, token1_address: str, max_age: float
+) -> float | None:
+    cached = pair_prices.get((chain_id, token0_address.lower(), token1_address.lower()))
+    if not cached or monotonic() - cached[1] > max_age:
+        return None
+    return cached[0]
+
+
+def set_cached_pair_price(
+    chain_id: int, token0_address: str, token1_address: str, price: float
+):
+    pair_prices[(chain_id, token0_address.lower(), token1_address.lower())] = (
+        price,
+        monotonic(),
+    )
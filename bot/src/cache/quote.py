@@ -0,0 +1,37 @@
+from time import monotonic
+from features.swap.types import PresetQuotes
+
+# How long (in seconds) preset quotes stay valid after being computed
+QUOTE_TTL = 30
+
+# Map user id to the preset quotes shown on their buy/sell menu, along with the time they were computed
+user_preset_quotes: dict[int, tuple[float, PresetQuotes]] = {}
+
+
+def get_user_preset_quotes(
+    user_id: int, chain_id: int, src_token_address: str, dst_token_address: str
+) -> PresetQuotes | None:
+    """Return cached preset quotes if they are still fresh and for the same pair"""
+    cached = user_preset_quotes.get(user_id)
+    if not cached:
+        return None
+    created_at, quotes = cached
+    if monotonic() - created_at > QUOTE_TTL:
+        unset_user_preset_quotes(user_id)
+        return None
+    if (
+        quotes["chain_id"] != chain_id
+        or quotes["src_token_address"] != src_token_address
+        or quotes["dst_token_address"] != dst_token_address
+    ):
+        return None
+    return quotes
+
+
+def set_user_preset_quotes(user_id: int, quotes: PresetQuotes):
+    user_preset_quotes[user_id] = (monotonic(), quotes)
+
+
+def unset_user_preset_quotes(user_id: int):
+    # Default value just to ignore errors
+    user_preset_quotes.pop(user_id, 0)
@@ -0,0 +1,22 @@
+from time import monotonic
+
+# How long (in seconds) 1inch token search results are reused
+SEARCH_TTL = 300
+
+# Map (chain id, lowercase query) to (time of the search, tokens found)
+token_searches: dict[tuple[int, str], tuple[float, list[dict]]] = {}
+
+
+def get_cached_token_search(chain_id: int, query: str) -> list[dict] | None:
+    cached = token_searches.get((chain_id, query.lower()))
+    if not cached:
+        return None
+    searched_at, tokens = cached
+    if monotonic() - searched_at > SEARCH_TTL:
+        token_searches.pop((chain_id, query.lower()), None)
+        return None
+    return tokens
+
+
+def set_cached_token_search(chain_id: int, query: str, tokens: list[dict]):
+    token_searches[(chain_id, query.lower())] = (monotonic(), tokens)
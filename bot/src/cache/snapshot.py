@@ -0,0 +1,142 @@
+# Snapshot of the caches worth keeping across restarts: token info, recent prices and chart data.
+# Written periodically and on shutdown, and loaded at startup so a new process answers from warm caches.
+import asyncio
+import gzip
+import json
+import logging
+import os
+from os import getenv
+from time import monotonic, time
+
+from cache import chart, price, token
+
+logger = logging.getLogger(__name__)
+
+# File to keep the snapshot in, empty to disable
+SNAPSHOT_PATH = getenv("CACHE_SNAPSHOT_PATH", "")
+# Seconds between snapshots while running
+SNAPSHOT_INTERVAL = int(getenv("CACHE_SNAPSHOT_INTERVAL", "900"))
+# Prices and charts older than this (seconds) are not worth loading
+SNAPSHOT_MAX_AGE = int(getenv("CACHE_SNAPSHOT_MAX_AGE", "3600"))
+
+VERSION = 1
+
+try:
+    # Smaller and faster than JSON, used when installed
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _dumps(snapshot: dict) -> bytes:
+    if msgpack is not None:
+        return b"M" + msgpack.packb(snapshot)
+    return b"J" + gzip.compress(json.dumps(snapshot, separators=(",", ":")).encode())
+
+
+def _loads(data: bytes) -> dict:
+    if data[:1] == b"M":
+        if msgpack is None:
+            raise ValueError(
+                "Snapshot was written with msgpack, which is not installed"
+            )
+        return msgpack.unpackb(data[1:], strict_map_key=False)
+    return json.loads(gzip.decompress(data[1:]))
+
+
+def take_snapshot() -> dict:
+    """The caches as lists of rows, as tuple keys don't survive serialisation"""
+    # Pair prices are timed with the monotonic clock, which is meaningless to another process
+    to_unix = time() - monotonic()
+    return {
+        "version": VERSION,
+        "token_info": [
+            [chain_id, address, info]
+            for (chain_id, address), info in list(token.token_info.items())
+        ],
+        "usd_prices": [
+            [chain_id, address, usd, fetched_at]
+            for (chain_id, address), (usd, fetched_at) in list(price.usd_prices.items())
+        ],
+        "pair_prices": [
+            [chain_id, token0, token1, value, quoted_at + to_unix]
+            for (chain_id, token0, token1), (value, quoted_at) in list(
+                price.pair_prices.items()
+            )
+        ],
+        "chart_data": [
+            [chain_id, token0, token1, period, data, fetched_at]
+            for (chain_id, token0, token1, period), (data, fetched_at) in list(
+                chart.chart_data.items()
+            )
+        ],
+    }
+
+
+def restore_snapshot(snapshot: dict) -> int:
+    """Fill the caches from a snapshot without replacing anything newer. Returns the entries loaded."""
+    if snapshot.get("version") != VERSION:
+        logger.warning("Ignoring cache snapshot of another version")
+        return 0
+    now = time()
+    to_monotonic = monotonic() - now
+    loaded = 0
+
+    for chain_id, address, info in snapshot["token_info"]:
+        # Token info never changes, however old
+        token.token_info.setdefault((chain_id, address), info)
+        loaded += 1
+    for chain_id, address, usd, fetched_at in snapshot["usd_prices"]:
+        if now - fetched_at <= SNAPSHOT_MAX_AGE:
+            price.usd_prices.setdefault((chain_id, address), (usd, fetched_at))
+            loaded += 1
+    for chain_id, token0, token1, value, quoted_at in snapshot["pair_prices"]:
+        if now - quoted_at <= SNAPSHOT_MAX_AGE:
+            price.pair_prices.setdefault(
+                (chain_id, token0, token1), (value, quoted_at + to_monotonic)
+            )
+            loaded += 1
+    for chain_id, token0, token1, period, data, fetched_at in snapshot["chart_data"]:
+        if now - fetched_at <= SNAPSHOT_MAX_AGE:
+            chart.chart_data.setdefault(
+                (chain_id, token0, token1, period), (data, fetched_at)
+            )
+            loaded += 1
+    return loaded
+
+
+def save_snapshot(path: str = SNAPSHOT_PATH):
+    data = _dumps(take_snapshot())
+    # Written aside and moved into place, so a crash mid-write never leaves a broken snapshot
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    logger.info("Saved cache snapshot", extra={"bytes": len(data)})
+
+
+def load_snapshot(path: str = SNAPSHOT_PATH) -> int:
+    """Warm the caches from the snapshot file, if there is one. Returns the entries loaded."""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return 0
+    try:
+        loaded = restore_snapshot(_loads(data))
+    except (ValueError, KeyError, TypeError, OSError, EOFError):
+        # A snapshot is only an optimisation, start cold rather than not at all
+        logger.exception("Failed to load cache snapshot")
+        return 0
+    logger.info("Loaded cache snapshot", extra={"entries": loaded})
+    return loaded
+
+
+async def save_snapshots_forever():
+    """Background job: snapshot the caches every SNAPSHOT_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        try:
+            await asyncio.to_thread(save_snapshot)
+        except Exception:
+            logger.exception("Failed to save cache snapshot")
@@ -0,0 +1,11 @@
+# Token info (symbol, decimals, etc.) never changes, so it is kept for the life of the process
+# Map (chain id, lowercase token address) to token info from 1inch
+token_info: dict[tuple[int, str], dict] = {}
+
+
+def get_cached_token_info(chain_id: int, token_address: str) -> dict | None:
+    return token_info.get((chain_id, token_address.lower()))
+
+
+def set_cached_token_info(chain_id: int, token_address: str, info: dict):
+    token_info[(chain_id, token_address.lower())] = info
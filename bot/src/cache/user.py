@@ -1,17 +1,70 @@
-from features.commands.types import Command, CommandStage
+from os import getenv
+from time import monotonic
 
-# Map user id to current command + stage of the command (the handler itself will be index 0, subsequent handling will increment)
-user_current_stage: dict[int, CommandStage] = {}
+from features.commands.types import Command
+from features.database.user import get_user
+from features.session.types import Session, User
 
+# Seconds a session is kept after the user's last update
+SESSION_TTL = int(getenv("SESSION_TTL", "3600"))
 
-def get_user_current_stage(user_id: int):
-    return user_current_stage.get(user_id)
+# Map user id to their session, loaded from the database on their first update and updated in place after that
+sessions: dict[int, Session] = {}
+last_evicted = monotonic()
+
+
+def _evict_idle_sessions():
+    global last_evicted
+    now = monotonic()
+    if now - last_evicted < SESSION_TTL / 10:
+        return
+    last_evicted = now
+    for user_id in [
+        user_id
+        for user_id, session in sessions.items()
+        if now - session.last_seen > SESSION_TTL
+    ]:
+        del sessions[user_id]
+
+
+def get_session(user_id: int) -> Session | None:
+    """The user's session, starting one from their profile if needed. None if they have not /start-ed."""
+    _evict_idle_sessions()
+    session = sessions.get(user_id)
+    if session is None:
+        user = get_user(user_id)
+        if user is None:
+            return None
+        session = sessions[user_id] = Session(user)
+    session.last_seen = monotonic()
+    return session
+
+
+def load_user(user_id: int) -> User | None:
+    """The user's profile, from their session"""
+    session = get_session(user_id)
+    return session.user if session else None
+
+
+def get_user_current_stage(user_id: int) -> Session | None:
+    """The user's session if they are in the middle of a command"""
+    session = sessions.get(user_id)
+    return session if session and session.command else None
 
 
 def set_user_current_stage(user_id: int, command: Command, stage: int):
-    user_current_stage[user_id] = {"command": command, "stage": stage}
+    session = get_session(user_id)
+    if session is not None:
+        session.command = command
+        session.stage = stage
+        session.stage_at = monotonic()
 
 
 def unset_user_current_stage(user_id: int):
-    # Default value just to ignore errors
-    user_current_stage.pop(user_id, 0)
+    """Back to the main menu, dropping the command's draft"""
+    session = sessions.get(user_id)
+    if session is not None:
+        session.command = None
+        session.stage = 0
+        session.withdraw = None
+        session.swap = None
@@ -1,13 +1,35 @@
-import matplotlib.pyplot as plt
-from oneinch_api import OneInchAPI
+import logging
+from oneinch_api import OneInchAPI, OneInchAPIError
+from cache.chart import get_cached_chart_data, set_cached_chart_data
 from datetime import datetime
 from io import BytesIO
+from os import getenv
+from threading import Lock
+from metrics import timer, cpu_seconds
+
+logger = logging.getLogger(__name__)
+
+# Seconds chart data is reused before fetching it again
+CHART_TTL = int(getenv("CHART_TTL", "300"))
+# Charts are drawn in worker threads, and pyplot keeps the current figure as global state
+render_lock = Lock()
 
 
 def generate_chart(chain_id: int, token0_addr: str, token0_name: str, token1_addr: str, token1_name: str):
     oneinch = OneInchAPI()
-    chart_data = oneinch.get_historical_chart_data(chain_id, token0_addr, token1_addr)  # "0x3c499c542cEF5E3811e1192ce70d8cC03d5c3359", "0xDC3326e71D45186F113a2F448984CA0e8D201995")
-    assert chart_data is not None
+    period = "24H"
+    # A day's chart barely moves in a few minutes, reuse recent data (e.g. loaded from the cache snapshot)
+    chart_data = get_cached_chart_data(chain_id, token0_addr, token1_addr, period, max_age=CHART_TTL)
+    if chart_data is None:
+        try:
+            chart_data = oneinch.get_historical_chart_data(chain_id, token0_addr, token1_addr, period)  # "0x3c499c542cEF5E3811e1192ce70d8cC03d5c3359", "0xDC3326e71D45186F113a2F448984CA0e8D201995")
+            set_cached_chart_data(chain_id, token0_addr, token1_addr, period, chart_data)
+        except OneInchAPIError as e:
+            # Show the last chart we have rather than nothing
+            logger.warning("Failed to get chart data, using last known", extra={"error": str(e)})
+            chart_data = get_cached_chart_data(chain_id, token0_addr, token1_addr, period)
+            if chart_data is None:
+                return None
     chart_data = chart_data.get("data")
     if not chart_data:
         return None
@@ -15,25 +37,40 @@ def generate_chart(chain_id: int, token0_addr: str, token0_name: str, token1_add
     times = [datetime.utcfromtimestamp(entry['time']) for entry in chart_data]
     values = [entry['value'] for entry in chart_data]
 
-    # Plotting
-    plt.figure(figsize=(10, 6))
-    plt.plot(times, values, marker='o', linestyle='-', color='b')
+    # Imported here, matplotlib is slow to import and most sessions never show a chart
+    import matplotlib.pyplot as plt
 
-    # Formatting the plot
-    plt.title(f'{token0_name}/{token1_name}')
-    plt.xlabel('Time (UTC)')
-    plt.ylabel('Price')
-    plt.grid(True)
+    with render_lock, timer(cpu_seconds, operation="render_chart"):
+        # Plotting
+        fig = plt.figure(figsize=(10, 6))
+        plt.plot(times, values, marker='o', linestyle='-', color='b')
 
-    # Rotate the x-axis labels for better readability
-    plt.xticks(rotation=45)
+        # Formatting the plot
+        plt.title(f'{token0_name}/{token1_name}')
+        plt.xlabel('Time (UTC)')
+        plt.ylabel('Price')
+        plt.grid(True)
 
-    plt.tight_layout()
-    plt_file = BytesIO()
-    fig = plt.gcf()
-    fig.savefig(plt_file, format="png")
-    plt_file.seek(0)
+        # Rotate the x-axis labels for better readability
+        plt.xticks(rotation=45)
+
+        plt.tight_layout()
+        plt_file = BytesIO()
+        fig.savefig(plt_file, format="png")
+        plt_file.seek(0)
+        # Figures stay open (and in memory) until closed
+        plt.close(fig)
 
     return plt_file
 
 
+def warm_up():
+    """Import matplotlib and render a throwaway chart, which loads the font cache"""
+    import matplotlib.pyplot as plt
+
+    with render_lock:
+        fig = plt.figure(figsize=(1, 1))
+        plt.plot([0, 1], [0, 1])
+        plt.title("warm up")
+        fig.savefig(BytesIO(), format="png")
+        plt.close(fig)
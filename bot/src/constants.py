@@ -2,6 +2,8 @@ from os import getenv
 
 ALCHEMY_API_KEY = getenv("ALCHEMY_API_KEY", "")
 USDC_ADDRESS = "0x3c499c542cef5e3811e1192ce70d8cc03d5c3359"
+# 1inch uses this address for the chain's native asset (POL on Polygon, ETH on Base, etc.)
+NATIVE_TOKEN_ADDRESS = "0xeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee"
 
 # Map chain ID to more info
 networks = {
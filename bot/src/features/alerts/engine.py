@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from os import getenv
+
+from oneinch_api import OneInchAPIError
+from features.alerts.types import PriceAlert
+from features.outbox.sender import send_message
+from features.database.alert import get_active_alerts, set_alerts_triggered
+from features.tokens.price import get_pair_price
+from features.tokens.thresholds import ThresholdIndex, to_pair
+
+logger = logging.getLogger(__name__)
+
+# Seconds between price checks
+CHECK_INTERVAL = int(getenv("ALERT_CHECK_INTERVAL", "60"))
+
+alert_index = ThresholdIndex()
+
+
+def index_alert(alert: PriceAlert):
+    alert_index.add(
+        alert["id"],
+        to_pair(alert["chain_id"], alert["token0_address"], alert["token1_address"]),
+        alert["threshold"],
+        alert["above"],
+        alert,
+    )
+
+
+def _notify(bot, alert: PriceAlert, price: float):
+    direction = "risen" if alert["above"] else "fallen"
+    text = (
+        f"Price alert: {alert['token0_name']} has {direction} to {price:.6g} {alert['token1_name']} "
+        f"(your alert was at {alert['threshold']:.6g})."
+    )
+    # Queued, so a burst of alerts goes out within Telegram's rate limits
+    send_message(bot, alert["user_id"], text)
+
+
+async def check_alerts(bot):
+    """One tick: price every pair with alerts once, concurrently, and notify the alerts reached"""
+    pairs = list(alert_index.pairs)
+    prices = await asyncio.gather(
+        *(get_pair_price(*pair) for pair in pairs), return_exceptions=True
+    )
+
+    triggered: list[tuple[PriceAlert, float]] = []
+    for pair, price in zip(pairs, prices):
+        if isinstance(price, OneInchAPIError):
+            logger.warning(
+                "Failed to price pair for alerts",
+                extra={"pair": pair, "error": str(price)},
+            )
+            continue
+        if isinstance(price, BaseException):
+            logger.error("Failed to price pair for alerts", exc_info=price)
+            continue
+        triggered += [
+            (alert, price) for alert in alert_index.pop_triggered(pair, price)
+        ]
+    if not triggered:
+        return
+
+    # Mark them first so a crash can't notify twice
+    try:
+        await asyncio.to_thread(
+            set_alerts_triggered, [alert["id"] for alert, _ in triggered]
+        )
+    except Exception:
+        # Try again next tick
+        for alert, _ in triggered:
+            index_alert(alert)
+        raise
+    for alert, price in triggered:
+        _notify(bot, alert, price)
+
+
+async def check_alerts_forever(bot):
+    """Background job: load the active alerts, then check them every CHECK_INTERVAL seconds"""
+    while True:
+        try:
+            for alert in await asyncio.to_thread(get_active_alerts):
+                index_alert(alert)
+            break
+        except Exception:
+            logger.exception("Failed to load price alerts, retrying")
+            await asyncio.sleep(CHECK_INTERVAL)
+
+    while True:
+        await asyncio.sleep(CHECK_INTERVAL)
+        try:
+            await check_alerts(bot)
+        except Exception:
+            logger.exception("Failed to check price alerts")
@@ -0,0 +1,15 @@
+from typing import TypedDict
+
+
+class PriceAlert(TypedDict):
+    id: int
+    user_id: int
+    chain_id: int
+    token0_address: str
+    token0_name: str
+    token1_address: str
+    token1_name: str
+    # Price of token0 in token1
+    threshold: float
+    # True to alert when the price rises to threshold, False when it falls to it
+    above: bool
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+from time import monotonic
+
+from constants import networks
+from oneinch_api import OneInchAPI, OneInchAPIError
+from util import parse_decimal
+from wallet import get_wallet_details
+from features.database.user import iter_users
+from features.session.types import User
+from features.tokens.info import get_token_info
+from features.tokens.registry import get_registry
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Spaces calls evenly at rate per second, however many tasks share it"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.ready_at = 0.0
+
+    async def wait(self):
+        # The slot is reserved before sleeping, so concurrent callers queue up behind each other
+        now = monotonic()
+        send_at = max(now, self.ready_at)
+        self.ready_at = send_at + self.interval
+        if send_at > now:
+            await asyncio.sleep(send_at - now)
+
+
+class Aggregates:
+    """
+    Running totals over every user and wallet, so memory grows with the number of tokens and pairs seen
+    rather than with the number of users.
+    """
+
+    def __init__(self):
+        self.users = 0
+        # Map chain id to users who picked it
+        self.chain_users: dict[int, int] = {}
+        # Map (chain id, token0 address, token1 address) to users who picked the pair
+        self.pair_users: dict[tuple[int, str, str], int] = {}
+        # Map (chain id, token address) to its name, as users named it when picking it
+        self.token_names: dict[tuple[int, str], str] = {}
+        # Map (chain id, token address) to the total held across all wallets (bigint)
+        self.holdings: dict[tuple[int, str], int] = {}
+        # Map (chain id, token address) to the wallets holding any
+        self.holders: dict[tuple[int, str], int] = {}
+        # Map chain id to wallets holding anything on it
+        self.funded_wallets: dict[int, int] = {}
+        # Map chain id to wallets whose balances could not be fetched
+        self.failed_wallets: dict[int, int] = {}
+        # Map (chain id, token address) to USD per whole token, None if it could not be priced
+        self.usd_prices: dict[tuple[int, str], float | None] = {}
+        # Map (chain id, token address) to decimals
+        self.decimals: dict[tuple[int, str], int] = {}
+
+    def add_user(self, user: User):
+        self.users += 1
+        if not user.chain_id:
+            return
+        self.chain_users[user.chain_id] = self.chain_users.get(user.chain_id, 0) + 1
+        if user.token0_address and user.token1_address:
+            pair = (
+                user.chain_id,
+                user.token0_address.lower(),
+                user.token1_address.lower(),
+            )
+            self.pair_users[pair] = self.pair_users.get(pair, 0) + 1
+            self.token_names.setdefault(pair[:2], user.token0_name)
+            self.token_names.setdefault((user.chain_id, pair[2]), user.token1_name)
+
+    def add_balances(self, chain_id: int, balances: dict[str, str]):
+        funded = False
+        for token_address, value in balances.items():
+            amount = int(value)
+            if not amount:
+                continue
+            funded = True
+            key = (chain_id, token_address.lower())
+            self.holdings[key] = self.holdings.get(key, 0) + amount
+            self.holders[key] = self.holders.get(key, 0) + 1
+        if funded:
+            self.funded_wallets[chain_id] = self.funded_wallets.get(chain_id, 0) + 1
+
+    def add_failure(self, chain_id: int):
+        self.failed_wallets[chain_id] = self.failed_wallets.get(chain_id, 0) + 1
+
+    def usd_value(self, key: tuple[int, str]) -> float | None:
+        price = self.usd_prices.get(key)
+        if price is None:
+            return None
+        return parse_decimal(self.holdings[key], self.decimals[key]) * price
+
+
+async def scan_wallets(
+    aggregates: Aggregates,
+    limiter: RateLimiter,
+    chain_ids: list[int],
+    chunk_size: int,
+    concurrency: int,
+):
+    """
+    Stream the users table in chunks and fetch every wallet's balances on each chain, concurrency at a time.
+    The queue between them is bounded, so reading from the database only runs as far ahead as the fetches.
+    """
+    queue: asyncio.Queue[tuple[int, str] | None] = asyncio.Queue(concurrency * 2)
+    # Delay is left to the limiter, which paces all the workers together
+    oneinch = OneInchAPI(post_delay=0)
+
+    async def produce():
+        chunks = iter_users(chunk_size)
+        try:
+            while True:
+                users = await asyncio.to_thread(next, chunks, None)
+                if users is None:
+                    break
+                # 2048 rounds of PBKDF2 each, so derived off the event loop
+                addresses = await asyncio.to_thread(
+                    lambda: [
+                        get_wallet_details(user.derivation_path)["address"]
+                        for user in users
+                    ]
+                )
+                for user, address in zip(users, addresses):
+                    aggregates.add_user(user)
+                    for chain_id in chain_ids:
+                        await queue.put((chain_id, address))
+                logger.info("Scanned users", extra={"users": aggregates.users})
+        finally:
+            chunks.close()
+            for _ in range(concurrency):
+                await queue.put(None)
+
+    async def fetch():
+        while (item := await queue.get()) is not None:
+            chain_id, address = item
+            await limiter.wait()
+            try:
+                balances = await asyncio.to_thread(
+                    oneinch.get_token_balance, chain_id, address
+                )
+            except OneInchAPIError as e:
+                logger.warning(
+                    "Failed to get balances",
+                    extra={"chain_id": chain_id, "address": address, "error": str(e)},
+                )
+                aggregates.add_failure(chain_id)
+                continue
+            aggregates.add_balances(chain_id, balances)
+
+    await asyncio.gather(produce(), *(fetch() for _ in range(concurrency)))
+
+
+async def price_holdings(
+    aggregates: Aggregates, limiter: RateLimiter, concurrency: int
+):
+    """Price each token held once, at its USDC quote for one whole token"""
+    oneinch = OneInchAPI(post_delay=0)
+    slots = asyncio.Semaphore(concurrency)
+
+    async def price(key: tuple[int, str]):
+        chain_id, token_address = key
+        usdc_address = networks[chain_id]["usdc_address"]
+        async with slots:
+            try:
+                if key not in aggregates.decimals:
+                    registry = get_registry(chain_id)
+                    if not (registry and registry.get(token_address)):
+                        # Not synced locally, so it costs a request
+                        await limiter.wait()
+                    token_info = await asyncio.to_thread(
+                        get_token_info, chain_id, token_address
+                    )
+                    aggregates.decimals[key] = token_info["decimals"]
+                    aggregates.token_names.setdefault(key, token_info["symbol"])
+                if token_address == usdc_address:
+                    aggregates.usd_prices[key] = 1.0
+                    return
+                await limiter.wait()
+                amount_out = await asyncio.to_thread(
+                    oneinch.quoted_swap,
+                    chain_id,
+                    token_address,
+                    usdc_address,
+                    10 ** aggregates.decimals[key],
+                )
+                # 6 decimals as stablecoins only up to 6 decimals
+                aggregates.usd_prices[key] = parse_decimal(amount_out, 6)
+            except OneInchAPIError as e:
+                # Most likely spam, 1inch doesn't list it
+                logger.warning(
+                    "Failed to price token",
+                    extra={
+                        "chain_id": chain_id,
+                        "token_address": token_address,
+                        "error": str(e),
+                    },
+                )
+                aggregates.usd_prices[key] = None
+
+    await asyncio.gather(*(price(key) for key in aggregates.holdings))
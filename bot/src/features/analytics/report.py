@@ -0,0 +1,125 @@
+import csv
+import os
+
+from constants import networks
+from util import format_amount
+from features.analytics.aggregate import Aggregates
+
+try:
+    # Parquet output, used when installed
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ("csv", "parquet")
+
+
+def _chain_name(chain_id: int) -> str:
+    return networks.get(chain_id, {}).get("name", str(chain_id))
+
+
+def aum_rows(aggregates: Aggregates) -> list[dict]:
+    """A row per token held, most valuable first"""
+    rows = []
+    for key, amount in aggregates.holdings.items():
+        chain_id, token_address = key
+        decimals = aggregates.decimals.get(key)
+        rows.append(
+            {
+                "chain_id": chain_id,
+                "chain": _chain_name(chain_id),
+                "token_address": token_address,
+                "symbol": aggregates.token_names.get(key, ""),
+                # Exact, as a string, or the raw bigint if the token's decimals are unknown
+                "amount": (
+                    format_amount(amount, decimals)
+                    if decimals is not None
+                    else str(amount)
+                ),
+                "holders": aggregates.holders[key],
+                "usd_price": aggregates.usd_prices.get(key),
+                "usd_value": aggregates.usd_value(key),
+            }
+        )
+    rows.sort(key=lambda row: row["usd_value"] or 0, reverse=True)
+    return rows
+
+
+def chain_rows(
+    aggregates: Aggregates, chain_ids: list[int], active_users: dict[int, int]
+) -> list[dict]:
+    rows = []
+    for chain_id in chain_ids:
+        keys = [key for key in aggregates.holdings if key[0] == chain_id]
+        values = [aggregates.usd_value(key) for key in keys]
+        rows.append(
+            {
+                "chain_id": chain_id,
+                "chain": _chain_name(chain_id),
+                "users": aggregates.chain_users.get(chain_id, 0),
+                "active_users": active_users.get(chain_id, 0),
+                "funded_wallets": aggregates.funded_wallets.get(chain_id, 0),
+                "failed_wallets": aggregates.failed_wallets.get(chain_id, 0),
+                "aum_usd": sum(value for value in values if value is not None),
+                "unpriced_tokens": sum(value is None for value in values),
+            }
+        )
+    return rows
+
+
+def pair_rows(aggregates: Aggregates, pair_activity: list[dict]) -> list[dict]:
+    """
+    A row per token pair, either way round: users who picked it and swaps made in it, most swapped first.
+    """
+    pairs: dict[tuple[int, str, str], dict] = {}
+
+    def row(chain_id: int, token_a: str, token_b: str) -> dict:
+        token_a, token_b = sorted((token_a, token_b))
+        key = (chain_id, token_a, token_b)
+        if key not in pairs:
+            pairs[key] = {
+                "chain_id": chain_id,
+                "chain": _chain_name(chain_id),
+                "token_a": token_a,
+                "symbol_a": aggregates.token_names.get((chain_id, token_a), ""),
+                "token_b": token_b,
+                "symbol_b": aggregates.token_names.get((chain_id, token_b), ""),
+                "users": 0,
+                "swaps": 0,
+                # A user may have swapped both ways, so this may count them twice
+                "swap_users": 0,
+                "usd_volume": 0.0,
+            }
+        return pairs[key]
+
+    for (chain_id, token0, token1), users in aggregates.pair_users.items():
+        row(chain_id, token0, token1)["users"] += users
+    for activity in pair_activity:
+        pair = row(
+            activity["chain_id"],
+            activity["src_token_address"],
+            activity["dst_token_address"],
+        )
+        pair["swaps"] += activity["swaps"]
+        pair["swap_users"] += activity["users"]
+        pair["usd_volume"] += float(activity["usd_volume"])
+    return sorted(
+        pairs.values(), key=lambda pair: (pair["swaps"], pair["users"]), reverse=True
+    )
+
+
+def write_table(directory: str, name: str, rows: list[dict], format: str) -> str:
+    """Write the rows to <directory>/<name>.<format>. Returns the path."""
+    path = os.path.join(directory, f"{name}.{format}")
+    if format == "parquet":
+        if pyarrow is None:
+            raise RuntimeError("Parquet output needs pyarrow, install it or use csv")
+        pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows), path)
+        return path
+    with open(path, "w", newline="") as f:
+        if rows:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    return path
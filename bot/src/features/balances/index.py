@@ -0,0 +1,53 @@
+from os import getenv
+
+# Addresses per log filter. RPC providers cap the size of a filter, so larger sets are split.
+FILTER_CHUNK_SIZE = int(getenv("BALANCE_FILTER_ADDRESSES", "500"))
+
+
+def to_topic(address: str) -> str:
+    """An address as it appears in a log's topics, left padded to 32 bytes"""
+    return "0x" + address.lower()[2:].rjust(64, "0")
+
+
+def from_topic(topic) -> str:
+    """Address from a 32 byte topic, given as hex or bytes"""
+    if isinstance(topic, (bytes, bytearray)):
+        topic = topic.hex()
+    return "0x" + topic[-40:].lower()
+
+
+class AddressIndex:
+    """
+    Every user's wallet address (the same on all chains), so one set of log filters covers all users
+    and each log is matched to its user in one lookup.
+    """
+
+    def __init__(self):
+        # Map lowercase address to user id
+        self.users: dict[str, int] = {}
+        self._topic_chunks: list[list[str]] | None = None
+
+    def __len__(self):
+        return len(self.users)
+
+    def add(self, address: str, user_id: int):
+        address = address.lower()
+        if self.users.get(address) != user_id:
+            self.users[address] = user_id
+            self._topic_chunks = None
+
+    def get(self, address: str) -> int | None:
+        return self.users.get(address.lower())
+
+    def topic_chunks(self) -> list[list[str]]:
+        """The addresses as topics, in chunks of FILTER_CHUNK_SIZE. Rebuilt only after addresses are added."""
+        if self._topic_chunks is None:
+            topics = [to_topic(address) for address in self.users]
+            self._topic_chunks = [
+                topics[i : i + FILTER_CHUNK_SIZE]
+                for i in range(0, len(topics), FILTER_CHUNK_SIZE)
+            ]
+        return self._topic_chunks
+
+
+address_index = AddressIndex()
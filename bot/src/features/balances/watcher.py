@@ -0,0 +1,202 @@
+import asyncio
+import logging
+from os import getenv
+from time import time
+
+from constants import networks
+from oneinch_api import OneInchAPIError
+from util import format_amount
+from wallet import (
+    get_block_number,
+    get_transaction_sender,
+    get_transfer_logs,
+    get_wallet_details,
+)
+from cache.balance import (
+    apply_balance_change,
+    get_balances_fetched_at,
+    get_cached_balances,
+    unset_cached_balances,
+    unset_chain_balances,
+)
+from features.balances.index import address_index, from_topic
+from features.database.user import get_user_derivation_paths
+from features.outbox.sender import send_message
+from features.tokens.info import get_token_info
+from metrics import counter
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks for new blocks, 0 to disable the watcher and fetch balances from 1inch on every load
+POLL_INTERVAL = float(getenv("BALANCE_WATCH_INTERVAL", "5"))
+# Seconds balances are served from the cache while the watcher is running. Native token deposits
+# have no logs, so this bounds how long one can go unseen.
+BALANCE_TTL = int(getenv("BALANCE_TTL", "300"))
+# Most blocks fetched in one go. A watcher further behind than this starts over from the latest block.
+MAX_BLOCK_RANGE = int(getenv("BALANCE_MAX_BLOCK_RANGE", "500"))
+# Tell users about tokens sent to their wallet, set to "off" to disable
+DEPOSIT_NOTIFICATIONS = getenv("DEPOSIT_NOTIFICATIONS", "on") != "off"
+
+transfer_logs_total = counter(
+    "bot_transfer_logs_total",
+    "ERC-20 transfers seen for our wallets, by effect (applied, invalidated, uncached)",
+)
+
+# Chains whose watcher is up to date, so their cached balances can be served
+watched_chains: set[int] = set()
+
+
+def get_watched_balances(chain_id: int, wallet_address: str) -> dict[str, str] | None:
+    """Balances kept up to date by the watcher. None if the chain is not watched or the wallet's are not cached."""
+    if chain_id not in watched_chains:
+        return None
+    return get_cached_balances(chain_id, wallet_address, max_age=BALANCE_TTL)
+
+
+def watch_user(user_id: int, derivation_path: int):
+    address_index.add(get_wallet_details(derivation_path)["address"], user_id)
+
+
+def load_addresses():
+    """Derive every user's address into the index. Slow (one key derivation each), run in a thread."""
+    for user_id, derivation_path in get_user_derivation_paths():
+        watch_user(user_id, derivation_path)
+    logger.info("Loaded wallet addresses", extra={"addresses": len(address_index)})
+
+
+class BalanceWatcher:
+    """Follows one chain's new blocks and applies the ERC-20 transfers of our wallets to their cached balances"""
+
+    def __init__(self, bot, chain_id: int):
+        self.bot = bot
+        self.chain_id = chain_id
+        self.rpc = networks[chain_id]["rpc"]
+        # Last block whose logs were applied, None until the watcher has started
+        self.last_block: int | None = None
+        # Unix time just before last_block was read as the head. Balances fetched since may already
+        # include blocks after it.
+        self.last_block_at = 0.0
+
+    async def run_forever(self):
+        while True:
+            try:
+                await self.poll()
+            except Exception:
+                # Cached balances go stale while no logs are applied, so stop serving them
+                watched_chains.discard(self.chain_id)
+                logger.exception(
+                    "Failed to follow blocks", extra={"chain_id": self.chain_id}
+                )
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def poll(self):
+        head_at = time()
+        head = await asyncio.to_thread(get_block_number, self.rpc)
+        if self.last_block is None or head - self.last_block > MAX_BLOCK_RANGE:
+            # Starting, or too far behind to catch up: what is cached may have missed transfers
+            unset_chain_balances(self.chain_id)
+            self.last_block = head
+            self.last_block_at = head_at
+            watched_chains.add(self.chain_id)
+            return
+        if head <= self.last_block:
+            watched_chains.add(self.chain_id)
+            return
+
+        logs = await asyncio.to_thread(
+            get_transfer_logs,
+            self.rpc,
+            self.last_block + 1,
+            head,
+            address_index.topic_chunks(),
+        )
+        deposits = self.apply(logs)
+        self.last_block = head
+        self.last_block_at = head_at
+        watched_chains.add(self.chain_id)
+        if deposits and DEPOSIT_NOTIFICATIONS:
+            await self.notify(deposits)
+
+    def apply(self, logs: list) -> list[dict]:
+        """Apply the transfers to cached balances. Returns the ones received, which may be deposits."""
+        received = []
+        seen = set()
+        for log in logs:
+            # A transfer between two of our wallets matches both filters
+            log_id = (bytes(log["transactionHash"]), log["logIndex"])
+            # ERC-721 transfers share the topic, but index the token id instead of carrying an amount
+            if log_id in seen or len(log["topics"]) != 3:
+                continue
+            seen.add(log_id)
+            token_address = log["address"].lower()
+            sender = from_topic(log["topics"][1])
+            recipient = from_topic(log["topics"][2])
+            amount = int.from_bytes(bytes(log["data"]), "big")
+
+            if address_index.get(sender) is not None:
+                # Only our bot signs for the wallet, and it spent gas too, so fetch everything again on the next load
+                unset_cached_balances(self.chain_id, sender)
+                transfer_logs_total.inc(effect="invalidated")
+            user_id = address_index.get(recipient)
+            if user_id is None:
+                continue
+            fetched_at = get_balances_fetched_at(self.chain_id, recipient)
+            if fetched_at is not None and fetched_at >= self.last_block_at:
+                # Fetched from 1inch after last_block, so the transfer may be counted already
+                unset_cached_balances(self.chain_id, recipient)
+                transfer_logs_total.inc(effect="invalidated")
+            elif apply_balance_change(self.chain_id, recipient, token_address, amount):
+                transfer_logs_total.inc(effect="applied")
+            else:
+                transfer_logs_total.inc(effect="uncached")
+            received.append(
+                {
+                    "user_id": user_id,
+                    "token_address": token_address,
+                    "amount": amount,
+                    "tx_hash": log["transactionHash"],
+                }
+            )
+        return received
+
+    async def notify(self, received: list[dict]):
+        """Tell users about the transfers sent to them by others, i.e. not the proceeds of their own swaps"""
+
+        async def notify_deposit(transfer: dict):
+            try:
+                sender = await asyncio.to_thread(
+                    get_transaction_sender, self.rpc, transfer["tx_hash"]
+                )
+                if address_index.get(sender) is not None:
+                    return
+                token_info = await asyncio.to_thread(
+                    get_token_info, self.chain_id, transfer["token_address"]
+                )
+            except OneInchAPIError:
+                # Most likely spam, 1inch doesn't list it
+                return
+            except Exception:
+                logger.exception(
+                    "Failed to check deposit", extra={"chain_id": self.chain_id}
+                )
+                return
+            amount = format_amount(transfer["amount"], token_info["decimals"])
+            chain_name = networks[self.chain_id]["name"]
+            text = f"Deposit received: {amount} {token_info['symbol']} on {chain_name}."
+            send_message(self.bot, transfer["user_id"], text)
+
+        await asyncio.gather(*(notify_deposit(transfer) for transfer in received))
+
+
+async def watch_balances_forever(bot):
+    """Background job: index every user's address, then follow each chain's blocks"""
+    while True:
+        try:
+            await asyncio.to_thread(load_addresses)
+            break
+        except Exception:
+            logger.exception("Failed to load wallet addresses, retrying")
+            await asyncio.sleep(60)
+    await asyncio.gather(
+        *(BalanceWatcher(bot, chain_id).run_forever() for chain_id in networks)
+    )
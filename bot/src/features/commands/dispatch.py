@@ -0,0 +1,115 @@
+import logging
+from dataclasses import dataclass
+from os import getenv
+from time import monotonic, perf_counter
+from typing import Awaitable, Callable
+
+from telegram import Update
+
+from features.commands.types import Command, InputKind
+from features.session.types import Session
+from cache.user import unset_user_current_stage
+from features.outbox.sender import send_message
+from metrics import histogram
+
+logger = logging.getLogger(__name__)
+
+# Seconds a user may take between the stages of a command before it expires and they are sent back to the main menu
+STAGE_TIMEOUT = int(getenv("STAGE_TIMEOUT", "900"))
+
+transition_seconds = histogram(
+    "bot_transition_seconds",
+    "Time to handle an update in a command's stage, by command, stage and input",
+)
+
+# Called with the update, the user's session, the input (callback data or message text) and the context
+Handler = Callable[[Update, Session, str, object], Awaitable[None]]
+# Given the input, the message to reply with if it is not valid for the stage
+Validator = Callable[[str], str | None]
+# Called after each transition with its key and how long it took in seconds
+TimingHook = Callable[[tuple[Command, int, InputKind], float], None]
+
+
+@dataclass(slots=True, frozen=True)
+class Transition:
+    handler: Handler
+    validate: Validator | None = None
+
+
+def observe_transition(key: tuple[Command, int, InputKind], seconds: float):
+    command, stage, kind = key
+    transition_seconds.observe(
+        seconds, command=command.value, stage=stage, input=kind.value.lower()
+    )
+
+
+class StateMachine:
+    """
+    Routes each update by the (command, stage, input kind) the user is in, in one lookup.
+    Stage 0 is the main menu: its buttons carry the Command's value as callback data,
+    and pressing one starts that command wherever the user was.
+    """
+
+    def __init__(
+        self,
+        transitions: dict[tuple[Command, int, InputKind], Transition],
+        on_expired: Handler,
+    ):
+        self.transitions = transitions
+        self.on_expired = on_expired
+        self.hooks: list[TimingHook] = [observe_transition]
+
+    def add_hook(self, hook: TimingHook):
+        self.hooks.append(hook)
+
+    def route(
+        self, session: Session, kind: InputKind, data: str
+    ) -> tuple[Command, int, InputKind] | None:
+        """The transition for the input, None if there is none"""
+        if kind == InputKind.BUTTON and data in Command._value2member_map_:
+            key = (Command(data), 0, kind)
+            return key if key in self.transitions else None
+        if session.command is None:
+            return None
+        key = (session.command, session.stage, kind)
+        return key if key in self.transitions else None
+
+    def is_expired(self, session: Session) -> bool:
+        return (
+            session.command is not None
+            and monotonic() - session.stage_at > STAGE_TIMEOUT
+        )
+
+    async def dispatch(
+        self, update: Update, session: Session, kind: InputKind, data: str, context
+    ) -> bool:
+        """Handle the input. False if nothing handles it in the user's current stage."""
+        key = self.route(session, kind, data)
+        if key is not None and key[1] == 0:
+            # A main menu button abandons whatever the user was in the middle of
+            unset_user_current_stage(session.user.id)
+        elif self.is_expired(session):
+            unset_user_current_stage(session.user.id)
+            await self.on_expired(update, session, data, context)
+            return True
+        elif key is None:
+            return False
+
+        transition = self.transitions[key]
+        if transition.validate is not None:
+            error = transition.validate(data)
+            if error is not None:
+                send_message(context.bot, session.user.id, error)
+                return True
+
+        start = perf_counter()
+        try:
+            await transition.handler(update, session, data, context)
+        finally:
+            seconds = perf_counter() - start
+            for hook in self.hooks:
+                try:
+                    hook(key, seconds)
+                except Exception:
+                    logger.exception("Transition hook failed")
+        return True
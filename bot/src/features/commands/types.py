@@ -1,4 +1,3 @@
-from typing import TypedDict
 from enum import Enum
 
 
@@ -13,8 +12,16 @@ class Command(Enum):
     BUY = "BUY"
     SELL = "SELL"
     REFRESH = "REFRESH"
+    PORTFOLIO = "PORTFOLIO"
+    ALERTS = "ALERTS"
+    ORDERS = "ORDERS"
+    DCA = "DCA"
+    HISTORY = "HISTORY"
 
 
-class CommandStage(TypedDict):
-    command: Command
-    stage: int
+# What kind of update the user sent while in a command's stage
+class InputKind(Enum):
+    # Inline keyboard button, the input is its callback data
+    BUTTON = "BUTTON"
+    # Text message
+    TEXT = "TEXT"
@@ -1,6 +1,8 @@
 from os import getenv
 from mysql.connector import connect
+from metrics import timed, upstream_seconds, upstream_errors
 
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="connect")
 def get_connection():
     conn = connect(
         host=getenv("DB_HOST"),
@@ -0,0 +1,78 @@
+from features.database import get_connection
+from util import tuples_to_dicts
+from metrics import timed, upstream_seconds, upstream_errors
+
+ALERT_FIELDS = ['id', 'user_id', 'chain_id', 'token0_address', 'token0_name', 'token1_address', 'token1_name', 'threshold', 'above']
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="add_alert")
+def add_alert(user_id: int, chain_id: int, token0_address: str, token0_name: str, token1_address: str, token1_name: str, threshold: float, above: bool) -> int:
+    """ Returns the new alert's id """
+    conn = get_connection()
+
+    query = (
+        'INSERT INTO price_alerts(user_id, chain_id, token0_address, token0_name, token1_address, token1_name, threshold, above) '
+        'VALUES (%s, %s, %s, %s, %s, %s, %s, %s)'
+    )
+
+    cursor = conn.cursor()
+    cursor.execute(query, (user_id, chain_id, token0_address.lower(), token0_name, token1_address.lower(), token1_name, threshold, above))
+    alert_id = cursor.lastrowid
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+    return alert_id
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="get_active_alerts")
+def get_active_alerts(user_id: int | None = None) -> list[dict]:
+    """ Alerts that have not triggered yet, of every user if user_id is None """
+    conn = get_connection()
+
+    query = f'SELECT {", ".join(ALERT_FIELDS)} FROM price_alerts WHERE triggered_at IS NULL'
+    params: tuple = ()
+    if user_id is not None:
+        query += ' AND user_id=%s'
+        params = (user_id,)
+
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    alerts = cursor.fetchall()
+
+    cursor.close()
+    conn.close()
+
+    return [{**alert, 'above': bool(alert['above'])} for alert in tuples_to_dicts(alerts, ALERT_FIELDS)]
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="delete_alert")
+def delete_alert(user_id: int, alert_id: int) -> bool:
+    """ Returns whether the user had the alert """
+    conn = get_connection()
+
+    query = 'DELETE FROM price_alerts WHERE id=%s AND user_id=%s'
+
+    cursor = conn.cursor()
+    cursor.execute(query, (alert_id, user_id))
+    deleted = cursor.rowcount > 0
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+    return deleted
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="set_alerts_triggered")
+def set_alerts_triggered(alert_ids: list[int]):
+    """ Mark alerts as triggered in one statement """
+    if not alert_ids:
+        return
+    conn = get_connection()
+
+    query = f'UPDATE price_alerts SET triggered_at=CURRENT_TIMESTAMP(3) WHERE id IN ({", ".join(["%s"] * len(alert_ids))})'
+
+    cursor = conn.cursor()
+    cursor.execute(query, tuple(alert_ids))
+
+    conn.commit()
+    cursor.close()
+    conn.close()
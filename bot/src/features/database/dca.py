@@ -0,0 +1,110 @@
+from datetime import datetime
+from features.database import get_connection
+from util import tuples_to_dicts
+from metrics import timed, upstream_seconds, upstream_errors
+
+DCA_FIELDS = ['id', 'user_id', 'chain_id', 'token0_address', 'token0_name', 'token1_address', 'token1_name', 'token1_decimals', 'amount', 'interval_hours', 'next_run_at']
+
+def _to_plans(rows) -> list[dict]:
+    return [{**plan, 'amount': int(plan['amount'])} for plan in tuples_to_dicts(rows, DCA_FIELDS)]
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="add_dca_plan")
+def add_dca_plan(user_id: int, chain_id: int, token0_address: str, token0_name: str, token1_address: str, token1_name: str, token1_decimals: int, amount: int, interval_hours: int, next_run_at: datetime) -> int:
+    """ Returns the new plan's id """
+    conn = get_connection()
+
+    query = (
+        'INSERT INTO dca_plans(user_id, chain_id, token0_address, token0_name, token1_address, token1_name, token1_decimals, amount, interval_hours, next_run_at) '
+        'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'
+    )
+
+    cursor = conn.cursor()
+    cursor.execute(query, (user_id, chain_id, token0_address.lower(), token0_name, token1_address.lower(), token1_name, token1_decimals, amount, interval_hours, next_run_at))
+    plan_id = cursor.lastrowid
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+    return plan_id
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="get_user_dca_plans")
+def get_user_dca_plans(user_id: int) -> list[dict]:
+    conn = get_connection()
+
+    query = f'SELECT {", ".join(DCA_FIELDS)} FROM dca_plans WHERE user_id=%s AND active=true'
+
+    cursor = conn.cursor()
+    cursor.execute(query, (user_id,))
+    plans = cursor.fetchall()
+
+    cursor.close()
+    conn.close()
+
+    return _to_plans(plans)
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="get_due_dca_plans")
+def get_due_dca_plans(until: datetime) -> list[dict]:
+    """ Active plans due before until, soonest first """
+    conn = get_connection()
+
+    query = f'SELECT {", ".join(DCA_FIELDS)} FROM dca_plans WHERE active=true AND next_run_at < %s ORDER BY next_run_at'
+
+    cursor = conn.cursor()
+    cursor.execute(query, (until,))
+    plans = cursor.fetchall()
+
+    cursor.close()
+    conn.close()
+
+    return _to_plans(plans)
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="claim_dca_run")
+def claim_dca_run(plan_id: int, run_at: datetime, next_run_at: datetime) -> bool:
+    """
+    Move the plan on to its next run, only if it is still due at run_at.
+    Returns whether it was moved, so each run happens at most once even across restarts.
+    """
+    conn = get_connection()
+
+    query = 'UPDATE dca_plans SET next_run_at=%s, last_run_at=CURRENT_TIMESTAMP(3) WHERE id=%s AND next_run_at=%s AND active=true'
+
+    cursor = conn.cursor()
+    cursor.execute(query, (next_run_at, plan_id, run_at))
+    claimed = cursor.rowcount > 0
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+    return claimed
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="set_dca_error")
+def set_dca_error(plan_id: int, error: str | None):
+    conn = get_connection()
+
+    query = 'UPDATE dca_plans SET last_error=%s WHERE id=%s'
+
+    cursor = conn.cursor()
+    cursor.execute(query, (error, plan_id))
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="cancel_dca_plan")
+def cancel_dca_plan(user_id: int, plan_id: int) -> bool:
+    """ Returns whether the user had the plan active """
+    conn = get_connection()
+
+    query = 'UPDATE dca_plans SET active=false WHERE id=%s AND user_id=%s AND active=true'
+
+    cursor = conn.cursor()
+    cursor.execute(query, (plan_id, user_id))
+    cancelled = cursor.rowcount > 0
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+    return cancelled
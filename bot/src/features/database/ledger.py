@@ -0,0 +1,120 @@
+from datetime import datetime
+from features.database import get_connection
+from util import tuples_to_dicts
+from metrics import timed, upstream_seconds, upstream_errors
+
+LEDGER_FIELDS = ['id', 'user_id', 'chain_id', 'kind', 'tx_hash', 'success', 'src_token_address', 'src_amount', 'dst_token_address', 'dst_amount', 'to_address', 'gas_used', 'gas_price', 'price', 'usd_value', 'gas_usd', 'created_at']
+POSITION_FIELDS = ['chain_id', 'token_address', 'bought_amount', 'bought_usd', 'sold_amount', 'sold_usd', 'withdrawn_amount', 'gas_amount', 'gas_usd', 'unpriced']
+# Running totals, added to on every ledger entry
+POSITION_TOTALS = ['bought_amount', 'bought_usd', 'sold_amount', 'sold_usd', 'withdrawn_amount', 'gas_amount', 'gas_usd', 'unpriced']
+# DECIMAL(65, 0) columns, read back as Decimal
+BIGINT_FIELDS = ['src_amount', 'dst_amount', 'gas_price', 'bought_amount', 'sold_amount', 'withdrawn_amount', 'gas_amount']
+
+def _to_ints(rows: list[dict]) -> list[dict]:
+    return [{**row, **{field: int(row[field]) for field in BIGINT_FIELDS if row.get(field) is not None}} for row in rows]
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="add_ledger_entry")
+def add_ledger_entry(entry: dict, position_changes: list[dict]) -> bool:
+    """
+    Record the transaction and add to the user's running totals, in one transaction.
+    Returns False if the transaction was already recorded, leaving the totals as they were.
+    """
+    conn = get_connection()
+
+    fields = LEDGER_FIELDS[1:-1]
+    query = f'INSERT IGNORE INTO ledger_entries({", ".join(fields)}) VALUES ({", ".join(["%s"] * len(fields))})'
+
+    cursor = conn.cursor()
+    cursor.execute(query, tuple(entry[field] for field in fields))
+    added = cursor.rowcount > 0
+
+    if added and position_changes:
+        keys = ['user_id', 'chain_id', 'token_address']
+        query = (
+            f'INSERT INTO pnl_positions({", ".join(keys + POSITION_TOTALS)}) VALUES ({", ".join(["%s"] * (len(keys) + len(POSITION_TOTALS)))}) '
+            f'ON DUPLICATE KEY UPDATE {", ".join(f"{field}={field}+VALUES({field})" for field in POSITION_TOTALS)}'
+        )
+        cursor.executemany(query, [tuple(change[field] for field in keys + POSITION_TOTALS) for change in position_changes])
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+    return added
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="get_ledger_page")
+def get_ledger_page(user_id: int, limit: int, before: tuple[datetime, int] | None = None) -> list[dict]:
+    """
+    The user's entries, newest first, from just before the (created_at, id) cursor of the last one shown.
+    Reads only the page from the (user_id, created_at) index, however long the history.
+    """
+    conn = get_connection()
+
+    query = f'SELECT {", ".join(LEDGER_FIELDS)} FROM ledger_entries WHERE user_id=%s'
+    params: tuple = (user_id,)
+    if before is not None:
+        created_at, entry_id = before
+        query += ' AND (created_at < %s OR (created_at = %s AND id < %s))'
+        params += (created_at, created_at, entry_id)
+    query += ' ORDER BY created_at DESC, id DESC LIMIT %s'
+    params += (limit,)
+
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    entries = cursor.fetchall()
+
+    cursor.close()
+    conn.close()
+
+    return _to_ints(tuples_to_dicts(entries, LEDGER_FIELDS))
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="get_pnl_positions")
+def get_pnl_positions(user_id: int) -> list[dict]:
+    conn = get_connection()
+
+    query = f'SELECT {", ".join(POSITION_FIELDS)} FROM pnl_positions WHERE user_id=%s'
+
+    cursor = conn.cursor()
+    cursor.execute(query, (user_id,))
+    positions = cursor.fetchall()
+
+    cursor.close()
+    conn.close()
+
+    return _to_ints(tuples_to_dicts(positions, POSITION_FIELDS))
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="get_pair_activity")
+def get_pair_activity(since: datetime) -> list[dict]:
+    """ Successful swaps since then per (chain, src token, dst token): count, distinct users and USD volume """
+    conn = get_connection()
+
+    query = (
+        'SELECT chain_id, src_token_address, dst_token_address, COUNT(*), COUNT(DISTINCT user_id), COALESCE(SUM(usd_value), 0) '
+        'FROM ledger_entries WHERE kind=%s AND success=true AND created_at >= %s '
+        'GROUP BY chain_id, src_token_address, dst_token_address'
+    )
+
+    cursor = conn.cursor()
+    cursor.execute(query, ('swap', since))
+    rows = cursor.fetchall()
+
+    cursor.close()
+    conn.close()
+
+    return tuples_to_dicts(rows, ['chain_id', 'src_token_address', 'dst_token_address', 'swaps', 'users', 'usd_volume'])
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="count_active_users")
+def count_active_users(since: datetime) -> dict[int, int]:
+    """ Map chain id to the number of users who sent a transaction on it since then """
+    conn = get_connection()
+
+    query = 'SELECT chain_id, COUNT(DISTINCT user_id) FROM ledger_entries WHERE created_at >= %s GROUP BY chain_id'
+
+    cursor = conn.cursor()
+    cursor.execute(query, (since,))
+    rows = cursor.fetchall()
+
+    cursor.close()
+    conn.close()
+
+    return dict(rows)
@@ -0,0 +1,95 @@
+from features.database import get_connection
+from util import tuples_to_dicts
+from metrics import timed, upstream_seconds, upstream_errors
+
+ORDER_FIELDS = ['id', 'user_id', 'chain_id', 'side', 'order_type', 'token0_address', 'token0_name', 'token1_address', 'token1_name', 'trigger_price', 'percentage', 'status', 'tx_hash']
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="add_order")
+def add_order(user_id: int, chain_id: int, side: str, order_type: str, token0_address: str, token0_name: str, token1_address: str, token1_name: str, trigger_price: float, percentage: int) -> int:
+    """ Returns the new order's id """
+    conn = get_connection()
+
+    query = (
+        'INSERT INTO orders(user_id, chain_id, side, order_type, token0_address, token0_name, token1_address, token1_name, trigger_price, percentage) '
+        'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'
+    )
+
+    cursor = conn.cursor()
+    cursor.execute(query, (user_id, chain_id, side, order_type, token0_address.lower(), token0_name, token1_address.lower(), token1_name, trigger_price, percentage))
+    order_id = cursor.lastrowid
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+    return order_id
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="get_orders")
+def get_orders(status: str, user_id: int | None = None) -> list[dict]:
+    """ Orders with the status, of every user if user_id is None """
+    conn = get_connection()
+
+    query = f'SELECT {", ".join(ORDER_FIELDS)} FROM orders WHERE status=%s'
+    params: tuple = (status,)
+    if user_id is not None:
+        query += ' AND user_id=%s'
+        params += (user_id,)
+
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    orders = cursor.fetchall()
+
+    cursor.close()
+    conn.close()
+
+    return tuples_to_dicts(orders, ORDER_FIELDS)
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="update_order_status")
+def update_order_status(order_id: int, from_status: str, to_status: str, error: str | None = None) -> bool:
+    """
+    Move the order from one status to another, only if it is still in from_status.
+    Returns whether it was moved, so only one worker (or user) can e.g. claim or cancel an order.
+    """
+    conn = get_connection()
+
+    query = 'UPDATE orders SET status=%s, error=%s WHERE id=%s AND status=%s'
+
+    cursor = conn.cursor()
+    cursor.execute(query, (to_status, error, order_id, from_status))
+    updated = cursor.rowcount > 0
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+    return updated
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="set_order_tx_hash")
+def set_order_tx_hash(order_id: int, tx_hash: str):
+    conn = get_connection()
+
+    query = 'UPDATE orders SET tx_hash=%s WHERE id=%s'
+
+    cursor = conn.cursor()
+    cursor.execute(query, (tx_hash, order_id))
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="cancel_order")
+def cancel_order(user_id: int, order_id: int) -> bool:
+    """ Returns whether the user had the order open """
+    conn = get_connection()
+
+    query = "UPDATE orders SET status='cancelled' WHERE id=%s AND user_id=%s AND status='open'"
+
+    cursor = conn.cursor()
+    cursor.execute(query, (order_id, user_id))
+    cancelled = cursor.rowcount > 0
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+    return cancelled
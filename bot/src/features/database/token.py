@@ -0,0 +1,38 @@
+from features.database import get_connection
+from util import tuples_to_dicts
+from metrics import timed, upstream_seconds, upstream_errors
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="get_tokens")
+def get_tokens(chain_id: int) -> list[dict]:
+    conn = get_connection()
+
+    query = 'SELECT address, symbol, name, decimals FROM tokens WHERE chain_id=%s'
+
+    cursor = conn.cursor()
+    cursor.execute(query, (chain_id,))
+    tokens = cursor.fetchall()
+
+    cursor.close()
+    conn.close()
+
+    return tuples_to_dicts(tokens, ['address', 'symbol', 'name', 'decimals'])
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="save_tokens")
+def save_tokens(chain_id: int, tokens: list[dict]):
+    """ Insert or update tokens (dicts with address, symbol, name, decimals) in one round trip """
+    conn = get_connection()
+
+    query = (
+        'INSERT INTO tokens(chain_id, address, symbol, name, decimals) VALUES (%s, %s, %s, %s, %s) '
+        'ON DUPLICATE KEY UPDATE symbol=VALUES(symbol), name=VALUES(name), decimals=VALUES(decimals)'
+    )
+
+    cursor = conn.cursor()
+    cursor.executemany(query, [
+        (chain_id, token['address'].lower(), token['symbol'], token['name'], token['decimals'])
+        for token in tokens
+    ])
+
+    conn.commit()
+    cursor.close()
+    conn.close()
@@ -1,6 +1,8 @@
 from features.database import get_connection
-from util import tuple_to_dict
+from features.session.types import User
+from metrics import timed, upstream_seconds, upstream_errors
 
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="add_user")
 def add_user(user_id: int):
     conn = get_connection()
 
@@ -13,7 +15,8 @@ def add_user(user_id: int):
     cursor.close()
     conn.close()
 
-def get_user(user_id: int):
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="get_user")
+def get_user(user_id: int) -> User | None:
     conn = get_connection()
 
     query = 'SELECT id, derivation_path, slippage, chain_id, token0_address, token0_name, token1_address, token1_name FROM users WHERE id=%s'
@@ -25,5 +28,55 @@ def get_user(user_id: int):
     if not user:
         return None
     
-    return tuple_to_dict(user, ['id', 'derivation_path', 'slippage', 'chain_id', 'token0_address', 'token0_name', 'token1_address', 'token1_name'])
-    
+    return User(*user)
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="get_user_derivation_paths")
+def get_user_derivation_paths() -> list[tuple[int, int]]:
+    """(user id, derivation path) of every user"""
+    conn = get_connection()
+
+    query = 'SELECT id, derivation_path FROM users'
+
+    cursor = conn.cursor()
+    cursor.execute(query)
+
+    rows = cursor.fetchall()
+    cursor.close()
+    conn.close()
+
+    return rows
+
+@timed(upstream_seconds, upstream_errors, upstream="mysql", operation="get_users_after")
+def get_users_after(after_id: int | None, limit: int) -> list[User]:
+    """ Up to limit users with ids after after_id (from the first if None), in id order """
+    conn = get_connection()
+
+    query = 'SELECT id, derivation_path, slippage, chain_id, token0_address, token0_name, token1_address, token1_name FROM users'
+    params: tuple = ()
+    if after_id is not None:
+        query += ' WHERE id > %s'
+        params += (after_id,)
+    query += ' ORDER BY id LIMIT %s'
+    params += (limit,)
+
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
+
+    cursor.close()
+    conn.close()
+
+    return [User(*row) for row in rows]
+
+def iter_users(chunk_size: int):
+    """
+    Every user, in chunks of up to chunk_size. Each chunk is its own short query from the last id read,
+    so no connection is held open while a slow consumer works through the table.
+    """
+    after_id = None
+    while True:
+        users = get_users_after(after_id, chunk_size)
+        if not users:
+            break
+        yield users
+        after_id = users[-1].id
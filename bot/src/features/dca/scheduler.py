@@ -0,0 +1,240 @@
+import asyncio
+import dataclasses
+import logging
+from datetime import datetime, timedelta, timezone
+from os import getenv
+
+from constants import networks, NATIVE_TOKEN_ADDRESS
+from oneinch_api import OneInchAPI, OneInchAPIError
+from util import parse_decimal
+from wallet import get_gas_price, get_wallet_details
+from features.database.user import get_user
+from features.database.dca import claim_dca_run, get_due_dca_plans, set_dca_error
+from features.dca.types import DcaPlan
+from features.outbox.sender import send_message
+from features.swap.engine import run_swap
+from features.tokens.price import get_pair_price
+from features.tokens.thresholds import Pair, to_pair
+from metrics import counter
+
+logger = logging.getLogger(__name__)
+
+# Seconds per scheduling window. Plans due in the same window share one gas price read per chain
+# and one quote per pair, and their buys are spread out over the window.
+WINDOW = int(getenv("DCA_WINDOW", "600"))
+# Buys run at once across all users
+CONCURRENCY = int(getenv("DCA_CONCURRENCY", "4"))
+# Gas units set aside for an approval and a swap when checking the wallet can pay for gas
+GAS_BUDGET = int(getenv("DCA_GAS_BUDGET", "400000"))
+
+dca_runs_total = counter(
+    "bot_dca_runs_total",
+    "Recurring buys by outcome (filled, failed)",
+)
+
+
+def utcnow() -> datetime:
+    """Naive UTC, as DATETIME columns are stored"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def next_run(plan: DcaPlan, now: datetime) -> datetime:
+    """When the plan runs after this run. Runs missed while the bot was down are skipped, not caught up."""
+    interval = timedelta(hours=plan["interval_hours"])
+    next_run_at = plan["next_run_at"] + interval
+    if next_run_at <= now:
+        next_run_at = now + interval
+    return next_run_at
+
+
+def describe_plan(plan: DcaPlan) -> str:
+    amount = parse_decimal(plan["amount"], plan["token1_decimals"])
+    return (
+        f"Buy {plan['token0_name']} with {amount:.6g} {plan['token1_name']} "
+        f"every {plan['interval_hours']}h"
+    )
+
+
+async def _gas_prices(chain_ids: set[int]) -> dict[int, int | None]:
+    async def gas_price(chain_id: int) -> int | None:
+        try:
+            return await asyncio.to_thread(get_gas_price, networks[chain_id]["rpc"])
+        except Exception:
+            logger.exception("Failed to get gas price", extra={"chain_id": chain_id})
+            return None
+
+    chain_ids = list(chain_ids)
+    prices = await asyncio.gather(*(gas_price(chain_id) for chain_id in chain_ids))
+    return dict(zip(chain_ids, prices))
+
+
+async def _pair_prices(pairs: set[Pair]) -> dict[Pair, float | None]:
+    """Price of one whole token1 in token0 for each pair, i.e. how much of token0 it buys"""
+
+    async def pair_price(pair: Pair) -> float | None:
+        try:
+            return await get_pair_price(*pair, max_age=WINDOW)
+        except OneInchAPIError as e:
+            logger.warning(
+                "Failed to price pair for DCA", extra={"pair": pair, "error": str(e)}
+            )
+            return None
+
+    pairs = list(pairs)
+    prices = await asyncio.gather(*(pair_price(pair) for pair in pairs))
+    return dict(zip(pairs, prices))
+
+
+def _price_pair(plan: DcaPlan) -> Pair:
+    return to_pair(plan["chain_id"], plan["token1_address"], plan["token0_address"])
+
+
+class DcaScheduler:
+    def __init__(self, bot):
+        self.bot = bot
+        self.slots = asyncio.Semaphore(CONCURRENCY)
+        # Ids of plans waiting for their slot in the window, so the next window does not schedule them again
+        self.scheduled: set[int] = set()
+        self.tasks: set[asyncio.Task] = set()
+
+    async def run_forever(self):
+        """Background job: schedule the plans due in each window"""
+        while True:
+            start = utcnow()
+            try:
+                await self.run_window(start)
+            except Exception:
+                logger.exception("Failed to schedule DCA plans")
+            elapsed = (utcnow() - start).total_seconds()
+            await asyncio.sleep(max(0, WINDOW - elapsed))
+
+    async def run_window(self, start: datetime):
+        """
+        Fetch the work the window's plans share once, then start each buy at its slot in the window.
+        Slots are spread so hundreds of plans due on the hour don't hit 1inch together, even when the
+        hour falls partway through the window, and a plan never runs before it is due.
+        """
+        plans = [
+            plan
+            for plan in await asyncio.to_thread(
+                get_due_dca_plans, start + timedelta(seconds=WINDOW)
+            )
+            if plan["id"] not in self.scheduled
+        ]
+        if not plans:
+            return
+
+        gas_prices, prices = await asyncio.gather(
+            _gas_prices({plan["chain_id"] for plan in plans}),
+            _pair_prices({_price_pair(plan) for plan in plans}),
+        )
+
+        # Soonest first, so each plan is spread over what is left of the window after it falls due.
+        # Delays only grow with i, each at least (WINDOW - offset) / len(plans) after the one before.
+        for i, plan in enumerate(plans):
+            offset = min(max(0, (plan["next_run_at"] - start).total_seconds()), WINDOW)
+            delay = offset + i * (WINDOW - offset) / len(plans)
+            self.scheduled.add(plan["id"])
+            task = asyncio.create_task(
+                self._run_at(
+                    delay,
+                    plan,
+                    gas_prices[plan["chain_id"]],
+                    prices[_price_pair(plan)],
+                )
+            )
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        logger.info("Scheduled DCA plans", extra={"plans": len(plans)})
+
+    async def _run_at(
+        self, delay: float, plan: DcaPlan, gas_price: int | None, price: float | None
+    ):
+        try:
+            await asyncio.sleep(delay)
+            await self._execute(plan, gas_price, price)
+        except Exception:
+            logger.exception("Failed to run DCA plan", extra={"plan_id": plan["id"]})
+        finally:
+            self.scheduled.discard(plan["id"])
+
+    async def _check_funds(
+        self, plan: DcaPlan, wallet_address: str, gas_price: int | None
+    ) -> str | None:
+        """Reason the wallet can't pay for the buy, if any"""
+        token1_address = plan["token1_address"].lower()
+        try:
+            balances = await asyncio.to_thread(
+                OneInchAPI().get_token_balance,
+                plan["chain_id"],
+                wallet_address,
+                list({token1_address, NATIVE_TOKEN_ADDRESS}),
+            )
+        except OneInchAPIError as e:
+            # Not fatal, the swap itself fails if the funds are not there
+            logger.warning("Failed to get balances for DCA", extra={"error": str(e)})
+            return None
+
+        if int(balances.get(token1_address, 0)) < plan["amount"]:
+            return f"Not enough {plan['token1_name']}."
+        if gas_price is not None:
+            native_needed = gas_price * GAS_BUDGET
+            if token1_address == NATIVE_TOKEN_ADDRESS:
+                # Sent as the swap transaction's value, on top of its gas
+                native_needed += plan["amount"]
+            if int(balances.get(NATIVE_TOKEN_ADDRESS, 0)) < native_needed:
+                return "Not enough funds for gas."
+        return None
+
+    async def _execute(self, plan: DcaPlan, gas_price: int | None, price: float | None):
+        async with self.slots:
+            # Claiming is atomic in the database, so a cancelled or already run plan is skipped
+            claimed = await asyncio.to_thread(
+                claim_dca_run,
+                plan["id"],
+                plan["next_run_at"],
+                next_run(plan, utcnow()),
+            )
+            if not claimed:
+                return
+
+            user = await asyncio.to_thread(get_user, plan["user_id"])
+            if user is None:
+                logger.warning("DCA plan without user", extra={"plan_id": plan["id"]})
+                return
+            wallet = get_wallet_details(user.derivation_path)
+
+            error = await self._check_funds(plan, wallet["address"], gas_price)
+            if error is None:
+                try:
+                    # The plan's chain, even if the user has switched since creating it
+                    result = await run_swap(
+                        dataclasses.replace(user, chain_id=plan["chain_id"]),
+                        plan["token1_address"],
+                        plan["token0_address"],
+                        None,
+                        amount=plan["amount"],
+                    )
+                    error = result["error"]
+                except Exception:
+                    logger.exception(
+                        "Failed to execute DCA plan", extra={"plan_id": plan["id"]}
+                    )
+                    error = "Transaction Failed."
+            await self._finish(plan, error, price)
+
+    async def _finish(self, plan: DcaPlan, error: str | None, price: float | None):
+        dca_runs_total.inc(outcome="failed" if error else "filled")
+        await asyncio.to_thread(set_dca_error, plan["id"], error)
+
+        amount = parse_decimal(plan["amount"], plan["token1_decimals"])
+        if error:
+            text = f"Recurring buy failed: {describe_plan(plan)}\n{error}"
+        elif price is not None:
+            text = (
+                f"Recurring buy: ~{amount * price:.6g} {plan['token0_name']} "
+                f"for {amount:.6g} {plan['token1_name']}."
+            )
+        else:
+            text = f"Recurring buy: {describe_plan(plan)}"
+        send_message(self.bot, plan["user_id"], text)
@@ -0,0 +1,20 @@
+from datetime import datetime
+from typing import TypedDict
+
+
+class DcaPlan(TypedDict):
+    id: int
+    user_id: int
+    chain_id: int
+    # Token bought
+    token0_address: str
+    token0_name: str
+    # Token spent
+    token1_address: str
+    token1_name: str
+    token1_decimals: int
+    # token1 spent per run, in its smallest unit (bigint)
+    amount: int
+    interval_hours: int
+    # UTC
+    next_run_at: datetime
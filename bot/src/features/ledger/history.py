@@ -0,0 +1,108 @@
+import asyncio
+from datetime import datetime
+from os import getenv
+
+from constants import networks
+from oneinch_api import OneInchAPIError
+from util import parse_decimal
+from features.ledger.pnl import realized_pnl
+from features.ledger.types import LedgerRow, PnlPosition
+from features.tokens.info import get_token_info
+
+# Ledger entries shown per page of the history screen
+PAGE_SIZE = int(getenv("HISTORY_PAGE_SIZE", "10"))
+
+
+def encode_cursor(entry: LedgerRow) -> str:
+    """Callback data to show the entries before this one"""
+    return f"{entry['created_at'].isoformat()}|{entry['id']}"
+
+
+def decode_cursor(data: str) -> tuple[datetime, int]:
+    """Raises ValueError if the data is not a cursor"""
+    created_at, entry_id = data.split("|")
+    return datetime.fromisoformat(created_at), int(entry_id)
+
+
+async def _symbols(tokens: set[tuple[int, str]]) -> dict[tuple[int, str], dict | None]:
+    """Token info of each (chain id, address), None for those 1inch can't look up"""
+
+    async def lookup(chain_id: int, token_address: str) -> dict | None:
+        try:
+            return await asyncio.to_thread(get_token_info, chain_id, token_address)
+        except OneInchAPIError:
+            return None
+
+    tokens = list(tokens)
+    infos = await asyncio.gather(*(lookup(*token) for token in tokens))
+    return dict(zip(tokens, infos))
+
+
+def _amount(value: int | None, token_info: dict | None, token_address: str) -> str:
+    if token_info is None:
+        return f"{value} of {token_address}"
+    return f"{parse_decimal(value, token_info['decimals']):.6g} {token_info['symbol']}"
+
+
+async def describe_entries(entries: list[LedgerRow]) -> list[str]:
+    """A line per ledger entry, e.g. '2026-10-19 08:00 Swap 100 USDC for 0.04 WETH (100.00 USD)'"""
+    tokens = {(entry["chain_id"], entry["src_token_address"]) for entry in entries}
+    tokens |= {
+        (entry["chain_id"], entry["dst_token_address"])
+        for entry in entries
+        if entry["dst_token_address"]
+    }
+    infos = await _symbols(tokens)
+
+    lines = []
+    for entry in entries:
+        chain_id = entry["chain_id"]
+        src_info = infos[(chain_id, entry["src_token_address"])]
+        src = _amount(entry["src_amount"], src_info, entry["src_token_address"])
+        line = f"{entry['created_at']:%Y-%m-%d %H:%M} "
+        if entry["kind"] == "swap":
+            line += f"Swap {src}"
+            if entry["dst_amount"]:
+                dst_info = infos[(chain_id, entry["dst_token_address"])]
+                line += f" for {_amount(entry['dst_amount'], dst_info, entry['dst_token_address'])}"
+        elif entry["kind"] == "withdraw":
+            line += f"Withdraw {src} to {entry['to_address']}"
+        else:
+            name = src_info["symbol"] if src_info else entry["src_token_address"]
+            line += f"Approve {name}"
+        if entry["usd_value"] is not None and entry["kind"] != "approve":
+            line += f" ({entry['usd_value']:.2f} USD)"
+        if not entry["success"]:
+            line += " FAILED"
+        lines.append(line)
+    return lines
+
+
+async def describe_pnl(positions: list[PnlPosition]) -> str:
+    """Realized PnL per token traded and in total, less gas"""
+    infos = await _symbols(
+        {(position["chain_id"], position["token_address"]) for position in positions}
+    )
+    lines = []
+    total = 0.0
+    gas_usd = 0.0
+    unpriced = False
+    for position in positions:
+        gas_usd += position["gas_usd"]
+        unpriced = unpriced or position["unpriced"] > 0
+        if not position["sold_amount"]:
+            continue
+        pnl = realized_pnl(position)
+        total += pnl
+        info = infos[(position["chain_id"], position["token_address"])]
+        name = info["symbol"] if info else position["token_address"]
+        chain_name = networks.get(position["chain_id"], {}).get(
+            "name", position["chain_id"]
+        )
+        lines.append(f"{name} ({chain_name}): {pnl:+.2f} USD")
+    total -= gas_usd
+    lines.append(f"Gas: -{gas_usd:.2f} USD")
+    text = "\n".join(lines) + f"\nRealized PnL: {total:+.2f} USD"
+    if unpriced:
+        text += " (some trades could not be priced)"
+    return text
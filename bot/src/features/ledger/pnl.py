@@ -0,0 +1,82 @@
+from constants import NATIVE_TOKEN_ADDRESS
+from features.ledger.types import LedgerEntry, PnlPosition, PositionChange
+
+
+def _change(entry: LedgerEntry, token_address: str, **totals) -> PositionChange:
+    return {
+        "user_id": entry["user_id"],
+        "chain_id": entry["chain_id"],
+        "token_address": token_address.lower(),
+        "bought_amount": 0,
+        "bought_usd": 0.0,
+        "sold_amount": 0,
+        "sold_usd": 0.0,
+        "withdrawn_amount": 0,
+        "gas_amount": 0,
+        "gas_usd": 0.0,
+        "unpriced": 0,
+        **totals,
+    }
+
+
+def position_changes(entry: LedgerEntry) -> list[PositionChange]:
+    """What the entry adds to the user's running totals per token"""
+    changes = []
+    if entry["gas_used"]:
+        # Gas is paid whether or not the transaction succeeded
+        changes.append(
+            _change(
+                entry,
+                NATIVE_TOKEN_ADDRESS,
+                gas_amount=entry["gas_used"] * entry["gas_price"],
+                gas_usd=entry["gas_usd"] or 0.0,
+                unpriced=int(entry["gas_usd"] is None),
+            )
+        )
+    if not entry["success"]:
+        return changes
+
+    unpriced = int(entry["usd_value"] is None)
+    usd_value = entry["usd_value"] or 0.0
+    if entry["kind"] == "swap":
+        changes.append(
+            _change(
+                entry,
+                entry["src_token_address"],
+                sold_amount=entry["src_amount"],
+                sold_usd=usd_value,
+                unpriced=unpriced,
+            )
+        )
+        changes.append(
+            _change(
+                entry,
+                entry["dst_token_address"],
+                bought_amount=entry["dst_amount"],
+                bought_usd=usd_value,
+                unpriced=unpriced,
+            )
+        )
+    elif entry["kind"] == "withdraw":
+        changes.append(
+            _change(
+                entry, entry["src_token_address"], withdrawn_amount=entry["src_amount"]
+            )
+        )
+    return changes
+
+
+def realized_pnl(position: PnlPosition) -> float:
+    """
+    USD made selling the token over what it cost to buy, at the average cost of what was bought through the bot.
+    Tokens held before (e.g. deposits) have no known cost, so only the part of the sales that buys cover counts.
+    """
+    bought = position["bought_amount"]
+    sold = position["sold_amount"]
+    if not bought or not sold:
+        return 0.0
+    covered = min(sold, bought)
+    return (
+        position["sold_usd"] * covered / sold
+        - position["bought_usd"] * covered / bought
+    )
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+
+from constants import NATIVE_TOKEN_ADDRESS
+from oneinch_api import OneInchAPIError
+from util import parse_decimal
+from features.balances.index import from_topic
+from features.database.ledger import add_ledger_entry
+from features.ledger.pnl import position_changes
+from features.ledger.types import LedgerEntry
+from features.portfolio.valuation import quote_usd
+from features.tokens.info import get_token_info
+from wallet import TRANSFER_TOPIC
+
+logger = logging.getLogger(__name__)
+
+# Transactions still being recorded, kept so their tasks are not garbage collected
+pending: set[asyncio.Task] = set()
+
+
+def transferred_amount(
+    receipt,
+    token_address: str,
+    from_address: str | None = None,
+    to_address: str | None = None,
+) -> int:
+    """Total of the token's Transfer logs in the receipt, from and/or to the addresses"""
+    total = 0
+    for log in receipt["logs"]:
+        topics = log["topics"]
+        if (
+            log["address"].lower() != token_address.lower()
+            or len(topics) != 3
+            or bytes(topics[0]).hex() != TRANSFER_TOPIC[2:]
+        ):
+            continue
+        if from_address and from_topic(topics[1]) != from_address.lower():
+            continue
+        if to_address and from_topic(topics[2]) != to_address.lower():
+            continue
+        total += int.from_bytes(bytes(log["data"]), "big")
+    return total
+
+
+async def _usd_value(chain_id: int, token_address: str, amount: int) -> float | None:
+    if not amount:
+        return 0.0
+    try:
+        token_info = await asyncio.to_thread(get_token_info, chain_id, token_address)
+    except OneInchAPIError:
+        return None
+    usd, _ = await quote_usd(chain_id, token_address, amount, token_info["decimals"])
+    return usd
+
+
+async def _price(
+    chain_id: int,
+    src_token_address: str,
+    src_amount: int,
+    dst_token_address: str,
+    dst_amount: int,
+) -> float | None:
+    try:
+        src_info, dst_info = await asyncio.gather(
+            asyncio.to_thread(get_token_info, chain_id, src_token_address),
+            asyncio.to_thread(get_token_info, chain_id, dst_token_address),
+        )
+    except OneInchAPIError:
+        return None
+    return parse_decimal(dst_amount, dst_info["decimals"]) / parse_decimal(
+        src_amount, src_info["decimals"]
+    )
+
+
+async def record_transaction(
+    user_id: int,
+    chain_id: int,
+    kind: str,
+    tx_hash: str,
+    receipt,
+    src_token_address: str,
+    src_amount: int,
+    dst_token_address: str | None = None,
+    dst_amount: int | None = None,
+    to_address: str | None = None,
+):
+    """
+    Write the transaction to the ledger, priced at execution, and add it to the user's PnL totals.
+    receipt is None if the transaction was not mined in time. Never raises, a failure is only logged.
+    """
+    try:
+        gas_used = receipt["gasUsed"] if receipt else 0
+        gas_price = receipt.get("effectiveGasPrice", 0) if receipt else 0
+        entry: LedgerEntry = {
+            "user_id": user_id,
+            "chain_id": chain_id,
+            "kind": kind,
+            "tx_hash": tx_hash,
+            "success": bool(receipt and receipt["status"]),
+            "src_token_address": src_token_address.lower(),
+            "src_amount": src_amount,
+            "dst_token_address": (
+                dst_token_address.lower() if dst_token_address else None
+            ),
+            "dst_amount": dst_amount,
+            "to_address": to_address.lower() if to_address else None,
+            "gas_used": gas_used,
+            "gas_price": gas_price,
+            "price": None,
+            "usd_value": None,
+            "gas_usd": None,
+        }
+        # Approvals move no tokens, only their gas is worth pricing
+        if kind == "approve":
+            entry["gas_usd"] = await _usd_value(
+                chain_id, NATIVE_TOKEN_ADDRESS, gas_used * gas_price
+            )
+        else:
+            entry["usd_value"], entry["gas_usd"] = await asyncio.gather(
+                _usd_value(chain_id, src_token_address, src_amount),
+                _usd_value(chain_id, NATIVE_TOKEN_ADDRESS, gas_used * gas_price),
+            )
+        if entry["success"] and dst_amount and src_amount:
+            entry["price"] = await _price(
+                chain_id, src_token_address, src_amount, dst_token_address, dst_amount
+            )
+
+        await asyncio.to_thread(add_ledger_entry, entry, position_changes(entry))
+    except Exception:
+        logger.exception(
+            "Failed to record transaction",
+            extra={
+                "user_id": user_id,
+                "chain_id": chain_id,
+                "kind": kind,
+                "tx_hash": tx_hash,
+            },
+        )
+
+
+def record_in_background(*args, **kwargs):
+    """Record the transaction without holding up the caller, see record_transaction"""
+    task = asyncio.create_task(record_transaction(*args, **kwargs))
+    pending.add(task)
+    task.add_done_callback(pending.discard)
+
+
+async def flush():
+    """Wait for the transactions being recorded, e.g. before shutting down"""
+    while pending:
+        await asyncio.gather(*pending)
@@ -0,0 +1,64 @@
+from datetime import datetime
+from typing import TypedDict
+
+
+class LedgerEntry(TypedDict):
+    user_id: int
+    chain_id: int
+    # approve, swap or withdraw
+    kind: str
+    tx_hash: str
+    # False if the transaction reverted or was not mined in time
+    success: bool
+    # Token approved, sold or withdrawn. Amounts are in the token's smallest unit (bigint)
+    src_token_address: str
+    src_amount: int
+    # Token bought, swaps only
+    dst_token_address: str | None
+    dst_amount: int | None
+    # Recipient, withdrawals only
+    to_address: str | None
+    gas_used: int
+    # Wei per gas
+    gas_price: int
+    # Whole dst tokens per whole src token, swaps only
+    price: float | None
+    # USD value of the src amount at execution, None if it could not be priced
+    usd_value: float | None
+    # USD value of the gas, None if it could not be priced
+    gas_usd: float | None
+
+
+class LedgerRow(LedgerEntry):
+    id: int
+    # UTC
+    created_at: datetime
+
+
+class PositionChange(TypedDict):
+    """Amounts added to a user's running totals for a token"""
+
+    user_id: int
+    chain_id: int
+    token_address: str
+    bought_amount: int
+    bought_usd: float
+    sold_amount: int
+    sold_usd: float
+    withdrawn_amount: int
+    gas_amount: int
+    gas_usd: float
+    unpriced: int
+
+
+class PnlPosition(TypedDict):
+    chain_id: int
+    token_address: str
+    bought_amount: int
+    bought_usd: float
+    sold_amount: int
+    sold_usd: float
+    withdrawn_amount: int
+    gas_amount: int
+    gas_usd: float
+    unpriced: int
@@ -0,0 +1,202 @@
+import asyncio
+import dataclasses
+import logging
+from os import getenv
+
+from constants import networks
+from oneinch_api import OneInchAPIError
+from wallet import wait_for_transaction
+from features.database.user import get_user
+from features.database.order import get_orders, set_order_tx_hash, update_order_status
+from features.orders.types import Order
+from features.outbox.sender import send_message
+from features.swap.engine import run_swap
+from features.tokens.price import get_pair_price
+from features.tokens.thresholds import ThresholdIndex, to_pair
+from metrics import counter
+
+logger = logging.getLogger(__name__)
+
+# Seconds between price checks
+CHECK_INTERVAL = int(getenv("ORDER_CHECK_INTERVAL", "15"))
+# Swaps run at once across all users
+WORKERS = int(getenv("ORDER_WORKERS", "4"))
+# Triggered orders waiting for a worker. Once full, further triggered orders stay in the book for the next check.
+QUEUE_SIZE = int(getenv("ORDER_QUEUE_SIZE", "50"))
+
+orders_total = counter(
+    "bot_orders_total",
+    "Limit/stop orders by outcome (triggered, deferred, filled, failed)",
+)
+
+# Open orders waiting for their trigger price
+order_book = ThresholdIndex()
+
+
+def triggers_above(order: Order) -> bool:
+    """Limit sells and stop buys trigger as the price rises, limit buys and stop sells as it falls"""
+    return (order["side"] == "sell") == (order["order_type"] == "limit")
+
+
+def index_order(order: Order):
+    order_book.add(
+        order["id"],
+        to_pair(order["chain_id"], order["token0_address"], order["token1_address"]),
+        order["trigger_price"],
+        triggers_above(order),
+        order,
+    )
+
+
+def describe_order(order: Order) -> str:
+    return (
+        f"{order['order_type'].capitalize()} {order['side']} {order['percentage']}% "
+        f"{order['token0_name']} at {order['trigger_price']:.6g} {order['token1_name']}"
+    )
+
+
+class OrderExecutor:
+    def __init__(self, bot):
+        self.bot = bot
+        self.queue: asyncio.Queue[Order] = asyncio.Queue(QUEUE_SIZE)
+
+    async def run_forever(self):
+        """Background job: finish orders interrupted by a restart, then check and execute orders"""
+        while True:
+            try:
+                await self.recover()
+                for order in await asyncio.to_thread(get_orders, "open"):
+                    index_order(order)
+                break
+            except Exception:
+                logger.exception("Failed to load orders, retrying")
+                await asyncio.sleep(CHECK_INTERVAL)
+
+        workers = [asyncio.create_task(self._worker()) for _ in range(WORKERS)]
+        try:
+            while True:
+                await asyncio.sleep(CHECK_INTERVAL)
+                try:
+                    await self.check()
+                except Exception:
+                    logger.exception("Failed to check orders")
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def recover(self):
+        """
+        Orders left executing by a restart. If the swap was signed its hash was recorded before broadcasting,
+        so the chain decides the outcome. Otherwise nothing was sent and the order can simply reopen.
+        """
+        orders = await asyncio.to_thread(get_orders, "executing")
+        await asyncio.gather(*(self._recover(order) for order in orders))
+
+    async def _recover(self, order: Order):
+        if not order["tx_hash"]:
+            await asyncio.to_thread(
+                update_order_status, order["id"], "executing", "open"
+            )
+            return
+        rpc = networks[order["chain_id"]]["rpc"]
+        receipt = await asyncio.to_thread(wait_for_transaction, rpc, order["tx_hash"])
+        if receipt and receipt.status:
+            await self._finish(order, None)
+        elif receipt:
+            await self._finish(order, "Transaction Failed.")
+        else:
+            await self._finish(
+                order, "Swap transaction was not mined, please check your wallet."
+            )
+
+    async def check(self):
+        """Price every pair with open orders once, concurrently, and queue the orders triggered"""
+        pairs = list(order_book.pairs)
+        prices = await asyncio.gather(
+            *(get_pair_price(*pair) for pair in pairs), return_exceptions=True
+        )
+        for pair, price in zip(pairs, prices):
+            if isinstance(price, OneInchAPIError):
+                logger.warning(
+                    "Failed to price pair for orders",
+                    extra={"pair": pair, "error": str(price)},
+                )
+                continue
+            if isinstance(price, BaseException):
+                logger.error("Failed to price pair for orders", exc_info=price)
+                continue
+            for order in order_book.pop_triggered(pair, price):
+                try:
+                    self.queue.put_nowait(order)
+                    orders_total.inc(outcome="triggered")
+                except asyncio.QueueFull:
+                    # Backpressure: leave it in the book, it is checked again next time
+                    index_order(order)
+                    orders_total.inc(outcome="deferred")
+
+    async def _worker(self):
+        while True:
+            order = await self.queue.get()
+            try:
+                await self._execute(order)
+            except Exception:
+                logger.exception(
+                    "Failed to execute order", extra={"order_id": order["id"]}
+                )
+            finally:
+                self.queue.task_done()
+
+    async def _execute(self, order: Order):
+        # Claiming is atomic in the database, so a cancelled or already claimed order is skipped
+        claimed = await asyncio.to_thread(
+            update_order_status, order["id"], "open", "executing"
+        )
+        if not claimed:
+            return
+
+        user = await asyncio.to_thread(get_user, order["user_id"])
+        if user is None:
+            await self._finish(order, "User not found.")
+            return
+        # The order's chain, even if the user has switched since placing it
+        user = dataclasses.replace(user, chain_id=order["chain_id"])
+        if order["side"] == "buy":
+            src, dst = order["token1_address"], order["token0_address"]
+        else:
+            src, dst = order["token0_address"], order["token1_address"]
+
+        signed: list[str] = []
+
+        def record_tx_hash(tx_hash: str):
+            set_order_tx_hash(order["id"], tx_hash)
+            signed.append(tx_hash)
+
+        try:
+            result = await run_swap(
+                user, src, dst, order["percentage"], on_swap_signed=record_tx_hash
+            )
+        except Exception:
+            logger.exception("Failed to execute order", extra={"order_id": order["id"]})
+            if signed:
+                # The swap may have gone out, let the chain decide
+                await self._recover({**order, "tx_hash": signed[-1]})
+            else:
+                await self._finish(order, "Transaction Failed.")
+            return
+        if result["error"] and signed:
+            # Failed after signing, e.g. the receipt wait timed out, so the swap may have gone out
+            await self._recover({**order, "tx_hash": signed[-1]})
+            return
+        await self._finish(order, result["error"])
+
+    async def _finish(self, order: Order, error: str | None):
+        status = "failed" if error else "filled"
+        await asyncio.to_thread(
+            update_order_status, order["id"], "executing", status, error
+        )
+        orders_total.inc(outcome=status)
+        if error:
+            text = f"Order failed: {describe_order(order)}\n{error}"
+        else:
+            text = f"Order filled: {describe_order(order)}"
+        send_message(self.bot, order["user_id"], text)
@@ -0,0 +1,22 @@
+from typing import TypedDict
+
+
+class Order(TypedDict):
+    id: int
+    user_id: int
+    chain_id: int
+    # buy or sell (token0)
+    side: str
+    # limit or stop
+    order_type: str
+    token0_address: str
+    token0_name: str
+    token1_address: str
+    token1_name: str
+    # Price of token0 in token1 that triggers the order
+    trigger_price: float
+    # Percentage of the balance to swap
+    percentage: int
+    # open, executing, filled, failed or cancelled
+    status: str
+    tx_hash: str | None
@@ -0,0 +1,257 @@
+import asyncio
+import logging
+from collections import deque
+from os import getenv
+from time import monotonic
+
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+from features.outbox.types import OutgoingMessage
+from metrics import counter
+
+logger = logging.getLogger(__name__)
+
+# Seconds between messages to the same chat, Telegram allows about 1 per second
+CHAT_INTERVAL = float(getenv("OUTBOX_CHAT_INTERVAL", "1"))
+# Messages per second across all chats, Telegram allows about 30
+GLOBAL_RATE = float(getenv("OUTBOX_GLOBAL_RATE", "30"))
+# Times a message is retried after Telegram asks to wait (flood control)
+MAX_RETRIES = int(getenv("OUTBOX_MAX_RETRIES", "5"))
+# Telegram's limit on the length of a message
+MAX_TEXT_LENGTH = 4096
+# Seconds to keep sending queued messages when the bot stops, before giving up on the rest
+DRAIN_TIMEOUT = float(getenv("OUTBOX_DRAIN_TIMEOUT", "10"))
+
+outbox_messages_total = counter(
+    "bot_outbox_messages_total",
+    "Outgoing Telegram messages by outcome (sent, edited, merged, superseded, retried, failed)",
+)
+
+
+def _mergeable(first: OutgoingMessage, second: OutgoingMessage) -> bool:
+    """Whether two consecutive plain text messages can go out as one. The first can't have buttons, as they belong at the bottom."""
+    return (
+        first.photo is None
+        and second.photo is None
+        and first.reply_markup is None
+        and not first.transient
+        and not second.transient
+        and first.parse_mode == second.parse_mode
+        and len(first.text) + len(second.text) + 2 <= MAX_TEXT_LENGTH
+    )
+
+
+class Outbox:
+    """
+    Sends a bot's messages from a queue per chat, so handlers don't wait on Telegram.
+    Each chat's queue is drained by its own task at Telegram's per chat rate, and all of them share the global rate.
+    Messages that pile up while a chat waits its turn are merged, and a status message is edited into the next one.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        # Map chat id to messages waiting to be sent
+        self.queues: dict[int, deque[OutgoingMessage]] = {}
+        # Map chat id to the task draining its queue
+        self.workers: dict[int, asyncio.Task] = {}
+        # Map chat id to the id of the status message the next message edits
+        self.status_message_ids: dict[int, int] = {}
+        # Map chat id to when its next message may be sent (time.monotonic())
+        self.chat_ready_at: dict[int, float] = {}
+        self.global_ready_at = 0.0
+
+    def send(self, message: OutgoingMessage):
+        """Queue the message and return at once"""
+        queue = self.queues.setdefault(message.chat_id, deque())
+        if queue and queue[-1].transient:
+            # A status that was never sent is out of date already
+            queue.pop()
+            outbox_messages_total.inc(outcome="superseded")
+        queue.append(message)
+        if message.chat_id not in self.workers:
+            self.workers[message.chat_id] = asyncio.create_task(
+                self._drain(message.chat_id)
+            )
+
+    async def flush(self):
+        """Wait until every queued message has been sent"""
+        while self.workers:
+            await asyncio.gather(*self.workers.values(), return_exceptions=True)
+
+    async def drain(self, timeout: float = DRAIN_TIMEOUT):
+        """Flush before stopping, giving up on what is left after timeout seconds"""
+        try:
+            await asyncio.wait_for(self.flush(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                "Outbox not drained, dropping messages",
+                extra={"messages": sum(len(queue) for queue in self.queues.values())},
+            )
+
+    async def _wait_turn(self, chat_id: int):
+        # The chat's own pace first, so a chat that has to wait doesn't hold up the others
+        wait = self.chat_ready_at.get(chat_id, 0) - monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        # Then the next global slot, reserved before sleeping so concurrent chats queue up behind each other
+        now = monotonic()
+        send_at = max(now, self.global_ready_at)
+        self.global_ready_at = send_at + 1 / GLOBAL_RATE
+        self.chat_ready_at[chat_id] = send_at + CHAT_INTERVAL
+        if send_at > now:
+            await asyncio.sleep(send_at - now)
+
+    def _next(self, chat_id: int) -> OutgoingMessage:
+        """Take the next message, merging in the ones after it where possible"""
+        queue = self.queues[chat_id]
+        message = queue.popleft()
+        while queue and _mergeable(message, queue[0]):
+            following = queue.popleft()
+            message.text = f"{message.text}\n\n{following.text}"
+            message.reply_markup = following.reply_markup
+            outbox_messages_total.inc(outcome="merged")
+        return message
+
+    async def _drain(self, chat_id: int):
+        try:
+            while True:
+                if not self.queues.get(chat_id):
+                    # Stay until the chat's next turn, so a message queued meanwhile is still paced
+                    wait = self.chat_ready_at.get(chat_id, 0) - monotonic()
+                    if wait <= 0:
+                        break
+                    await asyncio.sleep(wait)
+                    continue
+                await self._wait_turn(chat_id)
+                await self._deliver(self._next(chat_id))
+        finally:
+            del self.workers[chat_id]
+            self.queues.pop(chat_id, None)
+            self.chat_ready_at.pop(chat_id, None)
+
+    async def _deliver(self, message: OutgoingMessage):
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                await self._send(message)
+                return
+            except RetryAfter as e:
+                if attempt == MAX_RETRIES:
+                    break
+                outbox_messages_total.inc(outcome="retried")
+                logger.warning(
+                    "Flood control, retrying message",
+                    extra={"chat_id": message.chat_id, "retry_after": e.retry_after},
+                )
+                # Only this chat's task waits, other chats and the handlers carry on
+                self.chat_ready_at[message.chat_id] = monotonic() + e.retry_after
+                await self._wait_turn(message.chat_id)
+            except TelegramError:
+                logger.exception(
+                    "Failed to send message", extra={"chat_id": message.chat_id}
+                )
+                break
+        outbox_messages_total.inc(outcome="failed")
+
+    async def _send(self, message: OutgoingMessage):
+        chat_id = message.chat_id
+        status_message_id = self.status_message_ids.get(chat_id)
+        if status_message_id is not None and message.photo is None:
+            try:
+                await self.bot.edit_message_text(
+                    text=message.text,
+                    chat_id=chat_id,
+                    message_id=status_message_id,
+                    parse_mode=message.parse_mode,
+                    reply_markup=message.reply_markup,
+                )
+                outbox_messages_total.inc(outcome="edited")
+                if not message.transient:
+                    del self.status_message_ids[chat_id]
+                return
+            except BadRequest:
+                # e.g. the user deleted it, send a new message instead
+                pass
+        if status_message_id is not None and message.photo is not None:
+            # A text message can't be edited into a photo, so the status is deleted rather than left behind
+            try:
+                await self.bot.delete_message(
+                    chat_id=chat_id, message_id=status_message_id
+                )
+            except BadRequest:
+                # e.g. the user deleted it already
+                pass
+        # Anything sent after the status leaves it behind
+        self.status_message_ids.pop(chat_id, None)
+
+        if message.photo is not None:
+            # A retry uploads the file again from the start
+            if hasattr(message.photo, "seek"):
+                message.photo.seek(0)
+            sent = await self.bot.send_photo(
+                chat_id=chat_id,
+                photo=message.photo,
+                caption=message.text,
+                parse_mode=message.parse_mode,
+                reply_markup=message.reply_markup,
+            )
+        else:
+            sent = await self.bot.send_message(
+                chat_id=chat_id,
+                text=message.text,
+                parse_mode=message.parse_mode,
+                reply_markup=message.reply_markup,
+            )
+        outbox_messages_total.inc(outcome="sent")
+        if message.transient:
+            self.status_message_ids[chat_id] = sent.message_id
+
+
+# One outbox per bot, so handlers and background jobs share the rate limits
+outboxes: dict[object, Outbox] = {}
+
+
+def get_outbox(bot) -> Outbox:
+    outbox = outboxes.get(bot)
+    if outbox is None:
+        outbox = outboxes[bot] = Outbox(bot)
+    return outbox
+
+
+def send_message(
+    bot,
+    chat_id: int,
+    text: str,
+    parse_mode: str | None = None,
+    reply_markup=None,
+    transient: bool = False,
+):
+    """Queue a message to the chat, see Outbox"""
+    get_outbox(bot).send(
+        OutgoingMessage(
+            chat_id,
+            text,
+            parse_mode=parse_mode,
+            reply_markup=reply_markup,
+            transient=transient,
+        )
+    )
+
+
+def send_photo(
+    bot,
+    chat_id: int,
+    photo,
+    caption: str | None = None,
+    parse_mode: str | None = None,
+    reply_markup=None,
+):
+    """Queue a photo to the chat, see Outbox"""
+    get_outbox(bot).send(
+        OutgoingMessage(
+            chat_id,
+            caption,
+            photo=photo,
+            parse_mode=parse_mode,
+            reply_markup=reply_markup,
+        )
+    )
@@ -0,0 +1,16 @@
+from dataclasses import dataclass
+from typing import Any
+
+
+@dataclass(slots=True)
+class OutgoingMessage:
+    """A message waiting in a chat's queue"""
+
+    chat_id: int
+    text: str | None = None
+    # Image sent with the text as its caption
+    photo: Any = None
+    parse_mode: str | None = None
+    reply_markup: Any = None
+    # Status such as "Loading...": the next message to the chat replaces it, by editing it if it was sent
+    transient: bool = False
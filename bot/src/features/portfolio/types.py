@@ -0,0 +1,27 @@
+from typing import TypedDict
+
+
+class TokenHolding(TypedDict):
+    address: str
+    name: str
+    # Human amount, e.g. 1.5 (ETH)
+    amount: float
+    # None if the token could not be priced at all
+    usd: float | None
+    # Whether usd had to use the last known price
+    usd_stale: bool
+
+
+class ChainPortfolio(TypedDict):
+    chain_id: int
+    # False if 1inch is unavailable and there are no last known balances
+    balances_available: bool
+    # Whether the balances are the last known ones
+    balances_stale: bool
+    holdings: list[TokenHolding]
+    # Addresses of tokens held whose info could not be looked up
+    unknown_tokens: list[str]
+    usd_total: float
+    # Whether the total uses last known balances or prices, or is missing some tokens entirely
+    usd_stale: bool
+    usd_incomplete: bool
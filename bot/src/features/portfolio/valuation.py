@@ -0,0 +1,169 @@
+import asyncio
+import logging
+from os import getenv
+
+from constants import networks
+from oneinch_api import OneInchAPI, OneInchAPIError
+from util import parse_decimal
+from cache.balance import get_cached_balances, set_cached_balances
+from cache.price import get_cached_usd_price, set_cached_usd_price
+from features.tokens.info import get_token_info
+from features.balances.watcher import get_watched_balances
+from features.portfolio.types import ChainPortfolio, TokenHolding
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for any one chain before showing the portfolio without it
+CHAIN_TIMEOUT = float(getenv("PORTFOLIO_CHAIN_TIMEOUT", "10"))
+
+
+def _unavailable(chain_id: int) -> ChainPortfolio:
+    return {
+        "chain_id": chain_id,
+        "balances_available": False,
+        "balances_stale": False,
+        "holdings": [],
+        "unknown_tokens": [],
+        "usd_total": 0.0,
+        "usd_stale": False,
+        "usd_incomplete": False,
+    }
+
+
+async def quote_usd(
+    chain_id: int, token_address: str, value: int, decimals: int
+) -> tuple[float | None, bool]:
+    """
+    USD value of an amount (bigint) of the token, from a quote in USDC.
+    Uses the last known price if 1inch is unavailable, and says so. None if it was never priced.
+    """
+    amount = parse_decimal(value, decimals)
+    usdc_address = networks[chain_id]["usdc_address"]
+    if token_address.lower() == usdc_address:
+        return amount, False
+
+    # Get a quote from oneinch, or use the last known price if it is unavailable
+    try:
+        dst_amount = await asyncio.to_thread(
+            OneInchAPI().quoted_swap, chain_id, token_address, usdc_address, value
+        )
+        # 6 decimals as stablecoins only up to 6 decimals
+        usd = parse_decimal(dst_amount, 6)
+        if amount:
+            set_cached_usd_price(chain_id, token_address, usd / amount)
+        return usd, False
+    except OneInchAPIError as e:
+        logger.warning(
+            "Failed to quote token in USD, using last known price",
+            extra={"error": str(e)},
+        )
+        price = get_cached_usd_price(chain_id, token_address)
+        if price is None:
+            return None, False
+        return amount * price, True
+
+
+async def _value_holding(
+    chain_id: int, token_address: str, value: int
+) -> TokenHolding | None:
+    """Look up the token and value it in USDC. None if the token info is unavailable."""
+    try:
+        token_info = await asyncio.to_thread(get_token_info, chain_id, token_address)
+    except OneInchAPIError as e:
+        logger.warning("Failed to get token info", extra={"error": str(e)})
+        return None
+    usd, usd_stale = await quote_usd(
+        chain_id, token_address, value, token_info.get("decimals")
+    )
+    return {
+        "address": token_address,
+        "name": token_info.get("symbol", token_address),
+        "amount": parse_decimal(value, token_info.get("decimals")),
+        "usd": usd,
+        "usd_stale": usd_stale,
+    }
+
+
+async def get_chain_portfolio(chain_id: int, wallet_address: str) -> ChainPortfolio:
+    """
+    Balances of every token the wallet holds on the chain, valued in USD.
+    Token lookups and quotes run concurrently. Falls back to last known balances and prices if 1inch is unavailable.
+    """
+    portfolio = _unavailable(chain_id)
+    # Kept up to date from the chain's transfer logs, 1inch is only asked when they aren't
+    balances = get_watched_balances(chain_id, wallet_address)
+    if balances is None:
+        try:
+            balances = await asyncio.to_thread(
+                OneInchAPI().get_token_balance, chain_id, wallet_address
+            )
+            set_cached_balances(chain_id, wallet_address, balances)
+        except OneInchAPIError as e:
+            logger.warning(
+                "Failed to get balances, using last known", extra={"error": str(e)}
+            )
+            balances = get_cached_balances(chain_id, wallet_address)
+            portfolio["balances_stale"] = True
+    if balances is None:
+        return portfolio
+    portfolio["balances_available"] = True
+
+    nonzero = [
+        (token_address, int(value))
+        for token_address, value in balances.items()
+        if value != "0"
+    ]
+    holdings = await asyncio.gather(
+        *(
+            _value_holding(chain_id, token_address, value)
+            for token_address, value in nonzero
+        )
+    )
+    for (token_address, _), holding in zip(nonzero, holdings):
+        if holding is None:
+            portfolio["unknown_tokens"].append(token_address)
+        else:
+            portfolio["holdings"].append(holding)
+
+    portfolio["usd_total"] = sum(
+        holding["usd"]
+        for holding in portfolio["holdings"]
+        if holding["usd"] is not None
+    )
+    portfolio["usd_stale"] = portfolio["balances_stale"] or any(
+        holding["usd_stale"] for holding in portfolio["holdings"]
+    )
+    portfolio["usd_incomplete"] = any(
+        holding["usd"] is None for holding in portfolio["holdings"]
+    )
+    return portfolio
+
+
+async def _get_chain_portfolio_or_timeout(
+    chain_id: int, wallet_address: str
+) -> ChainPortfolio:
+    try:
+        return await asyncio.wait_for(
+            get_chain_portfolio(chain_id, wallet_address), CHAIN_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        logger.warning("Timed out getting portfolio", extra={"chain_id": chain_id})
+        return _unavailable(chain_id)
+
+
+async def get_portfolio(
+    wallet_address: str, chain_ids: list[int] | None = None
+) -> list[ChainPortfolio]:
+    """
+    The wallet's portfolio on every chain (the derived address is the same on all of them).
+    Chains are queried concurrently, so this takes as long as the slowest chain, capped at CHAIN_TIMEOUT.
+    """
+    chain_ids = chain_ids or list(networks)
+    return list(
+        await asyncio.gather(
+            *(
+                _get_chain_portfolio_or_timeout(chain_id, wallet_address)
+                for chain_id in chain_ids
+            )
+        )
+    )
@@ -0,0 +1,55 @@
+from dataclasses import dataclass
+
+from features.commands.types import Command
+
+
+@dataclass(slots=True)
+class User:
+    """A row of the users table"""
+
+    id: int
+    derivation_path: int
+    slippage: float
+    chain_id: int | None
+    token0_address: str | None
+    token0_name: str | None
+    token1_address: str | None
+    token1_name: str | None
+
+
+@dataclass(slots=True)
+class WithdrawDraft:
+    """Withdrawal being entered, one stage at a time"""
+
+    # Token address, or WITHDRAW_ALL to sweep every balance
+    token_address: str
+    wallet_address: str | None = None
+    # bigint, 0 for the whole balance
+    amount: int = 0
+
+
+@dataclass(slots=True)
+class SwapDraft:
+    """Pair on the buy/sell menu, so the swap uses the tokens the user was shown"""
+
+    src_token_address: str
+    dst_token_address: str
+
+
+@dataclass(slots=True)
+class Session:
+    """
+    Everything kept about a user while they talk to the bot, updated in place:
+    their profile, the command (and its stage) they are in the middle of, and its draft.
+    """
+
+    user: User
+    # None on the main menu
+    command: Command | None = None
+    stage: int = 0
+    # time.monotonic() of entering the stage, to expire stages left hanging
+    stage_at: float = 0.0
+    withdraw: WithdrawDraft | None = None
+    swap: SwapDraft | None = None
+    # time.monotonic() of the user's last update
+    last_seen: float = 0.0
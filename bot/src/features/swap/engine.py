@@ -0,0 +1,309 @@
+import asyncio
+import logging
+from typing import Callable
+from contextlib import contextmanager
+from time import perf_counter
+from oneinch_api import OneInchAPI, OneInchAPIError, is_unavailable_error
+from wallet import (
+    get_wallet_details,
+    get_private_key,
+    get_block_number,
+    send_transaction,
+    wait_for_transaction,
+)
+from constants import networks, NATIVE_TOKEN_ADDRESS
+from features.session.types import User
+from features.swap.types import SwapResult
+from features.swap.quote import get_preset_quotes
+from features.swap.prefetch import (
+    get_prefetched_approve_calldata,
+    fetch_swap_calldata,
+    is_calldata_fresh,
+)
+from cache.quote import unset_user_preset_quotes
+from cache.calldata import unset_user_approve_calldata
+from cache.balance import unset_cached_balances
+from features.ledger.recorder import record_in_background, transferred_amount
+from metrics import histogram
+
+logger = logging.getLogger(__name__)
+
+swap_stage_seconds = histogram(
+    "bot_swap_stage_seconds",
+    "Time spent in each stage of a swap (quote, approve, swap, confirm)",
+)
+
+# 1 because we don't understand the min 1 max 50 in Swagger docs
+SLIPPAGE = 1
+
+# Map (user id, chain id) to the swap currently running for it
+in_flight_swaps: dict[tuple[int, int], asyncio.Task] = {}
+# Map user id to the lock letting one swap at a time use their wallet. Limit orders, DCA buys and manual
+# swaps all go through run_swap, and each reads the wallet's latest nonce when it signs.
+swap_locks: dict[int, asyncio.Lock] = {}
+
+
+class SwapError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+@contextmanager
+def stage(timings: dict[str, float], name: str):
+    """Record how long a stage of the swap took"""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + perf_counter() - start
+
+
+def _swap_key(user: User):
+    # Per wallet and chain, not per swap: a 25% tap then a 50% tap would otherwise start two swaps
+    return (user.id, user.chain_id)
+
+
+def is_swap_in_flight(user: User) -> bool:
+    return _swap_key(user) in in_flight_swaps
+
+
+async def execute_swap(
+    user: User, src_token_address: str, dst_token_address: str, percentage: int
+) -> SwapResult:
+    """
+    Swap a percentage of the user's src token balance into dst token.
+    If one of the user's swaps is already running on the chain (e.g. they tapped twice, or tapped another
+    percentage), wait for it instead of starting another.
+    """
+    key = _swap_key(user)
+    task = in_flight_swaps.get(key)
+    if task is not None:
+        result = await asyncio.shield(task)
+        return {**result, "coalesced": True}
+
+    task = asyncio.create_task(
+        run_swap(user, src_token_address, dst_token_address, percentage)
+    )
+    in_flight_swaps[key] = task
+    task.add_done_callback(lambda _: in_flight_swaps.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def run_swap(
+    user: User,
+    src_token_address: str,
+    dst_token_address: str,
+    percentage: int | None,
+    on_swap_signed: Callable[[str], None] | None = None,
+    amount: int | None = None,
+) -> SwapResult:
+    """
+    Run a swap without coalescing, for background workers that do their own deduplication.
+    Waits for any other swap of the user's to finish first, see swap_locks.
+    on_swap_signed is called with the swap's tx hash (from a worker thread) before it is broadcast.
+    amount (src token's smallest unit) swaps a fixed amount instead of a percentage of the balance.
+    """
+    timings: dict[str, float] = {}
+    async with swap_locks.setdefault(user.id, asyncio.Lock()):
+        try:
+            await _swap_stages(
+                user,
+                src_token_address,
+                dst_token_address,
+                percentage,
+                timings,
+                on_swap_signed,
+                amount,
+            )
+            result: SwapResult = {
+                "success": True,
+                "error": None,
+                "timings": timings,
+                "coalesced": False,
+            }
+        except OneInchAPIError as e:
+            logger.warning("1inch failed during swap", extra={"error": str(e)})
+            error = (
+                "1inch is busy right now, please try again later."
+                if is_unavailable_error(e)
+                else "Transaction Failed."
+            )
+            result = {
+                "success": False,
+                "error": error,
+                "timings": timings,
+                "coalesced": False,
+            }
+        except SwapError as e:
+            result = {
+                "success": False,
+                "error": str(e),
+                "timings": timings,
+                "coalesced": False,
+            }
+        except Exception:
+            # Web3 and RPC errors, e.g. estimating gas, sending or waiting for the receipt, are
+            # reported as a failed transaction so the caller still replies and cleans up
+            logger.exception("Swap failed", extra={"user_id": user.id})
+            result = {
+                "success": False,
+                "error": "Transaction Failed.",
+                "timings": timings,
+                "coalesced": False,
+            }
+    for name, seconds in timings.items():
+        swap_stage_seconds.observe(seconds, stage=name)
+    logger.info(
+        "Swap finished",
+        extra={
+            "user_id": user.id,
+            "percentage": percentage,
+            "amount": amount,
+            "src_token_address": src_token_address,
+            "dst_token_address": dst_token_address,
+            **result,
+        },
+    )
+    return result
+
+
+async def _swap_stages(
+    user: User,
+    src_token_address: str,
+    dst_token_address: str,
+    percentage: int | None,
+    timings: dict[str, float],
+    on_swap_signed: Callable[[str], None] | None = None,
+    amount: int | None = None,
+):
+    user_id = user.id
+    chain_id = user.chain_id
+    rpc = networks[chain_id]["rpc"]
+    wallet_details = get_wallet_details(user.derivation_path)
+    wallet_address = wallet_details["address"]
+    oneinch = OneInchAPI()
+
+    # Quote: reuse the quote shown on the menu, which already knows the balance and decimals.
+    # A fixed amount is left to the caller to check against the balance.
+    if amount is None:
+        with stage(timings, "quote"):
+            preset_quotes = await get_preset_quotes(
+                user_id, chain_id, wallet_address, src_token_address, dst_token_address
+            )
+            preset_quote = preset_quotes["quotes"].get(percentage)
+            amount = preset_quote["amount_in"] if preset_quote else 0
+    if amount == 0:
+        raise SwapError("Not enough funds.")
+    private_key = (await asyncio.to_thread(get_private_key, user.derivation_path)).hex()
+
+    # Balance is about to change, so the quotes on the menu are stale after this
+    unset_user_preset_quotes(user_id)
+    unset_cached_balances(chain_id, wallet_address)
+
+    # Approve if needed, fetching the swap calldata while the approval is being mined
+    prefetched = None
+    with stage(timings, "approve"):
+        if src_token_address.lower() == NATIVE_TOKEN_ADDRESS:
+            allowance = amount
+        else:
+            allowance, block_number = await asyncio.gather(
+                asyncio.to_thread(
+                    oneinch.get_allowance, chain_id, src_token_address, wallet_address
+                ),
+                asyncio.to_thread(get_block_number, rpc),
+            )
+
+        if allowance < amount:
+            # Use the approval prefetched while the menu was showing if it is still fresh
+            transaction = get_prefetched_approve_calldata(
+                user_id, chain_id, src_token_address, amount, block_number
+            )
+            if transaction is None:
+                transaction = await asyncio.to_thread(
+                    oneinch.approve_swap_calldata, chain_id, src_token_address, amount
+                )
+            tx_hash = await asyncio.to_thread(
+                send_transaction, rpc, transaction, private_key
+            )
+
+            swap_calldata_task = asyncio.create_task(
+                fetch_swap_calldata(
+                    chain_id,
+                    rpc,
+                    src_token_address,
+                    dst_token_address,
+                    amount,
+                    wallet_address,
+                    SLIPPAGE,
+                    disable_estimate=True,
+                )
+            )
+            tx_receipt = await asyncio.to_thread(wait_for_transaction, rpc, tx_hash)
+            record_in_background(
+                user_id,
+                chain_id,
+                "approve",
+                tx_hash,
+                tx_receipt,
+                src_token_address,
+                amount,
+            )
+            if not (tx_receipt and tx_receipt.status):
+                swap_calldata_task.cancel()
+                raise SwapError("Transaction Failed.")
+            try:
+                prefetched = await swap_calldata_task
+                if not is_calldata_fresh(prefetched, tx_receipt.blockNumber):
+                    prefetched = None
+            except OneInchAPIError as e:
+                # Only speculative, fetch it again now that the approval is mined
+                logger.warning(
+                    "Failed to prefetch swap calldata", extra={"error": str(e)}
+                )
+    unset_user_approve_calldata(user_id)
+
+    with stage(timings, "swap"):
+        if prefetched is None:
+            prefetched = await fetch_swap_calldata(
+                chain_id,
+                rpc,
+                src_token_address,
+                dst_token_address,
+                amount,
+                wallet_address,
+                SLIPPAGE,
+            )
+        tx_hash = await asyncio.to_thread(
+            send_transaction,
+            rpc,
+            prefetched["calldata"]["tx"],
+            private_key,
+            on_swap_signed,
+        )
+
+    with stage(timings, "confirm"):
+        tx_receipt = await asyncio.to_thread(wait_for_transaction, rpc, tx_hash)
+        # Loaded again once mined, failed or not, as gas was spent either way
+        unset_cached_balances(chain_id, wallet_address)
+        success = bool(tx_receipt and tx_receipt.status)
+        dst_amount = None
+        if success and dst_token_address.lower() != NATIVE_TOKEN_ADDRESS:
+            dst_amount = transferred_amount(
+                tx_receipt, dst_token_address, to_address=wallet_address
+            )
+        if success and not dst_amount:
+            # Native tokens are sent without a Transfer log, 1inch's quote is the closest record
+            dst_amount = int(prefetched["calldata"].get("dstAmount", 0)) or None
+        record_in_background(
+            user_id,
+            chain_id,
+            "swap",
+            tx_hash,
+            tx_receipt,
+            src_token_address,
+            amount,
+            dst_token_address,
+            dst_amount,
+        )
+        if not success:
+            raise SwapError("Transaction Failed.")
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+from time import monotonic
+from oneinch_api import OneInchAPI, OneInchAPIError
+from wallet import get_block_number
+from features.swap.types import PrefetchedCalldata
+from cache.calldata import get_user_approve_calldata, set_user_approve_calldata
+
+logger = logging.getLogger(__name__)
+
+# Prefetched calldata carries a gas price, so it should not be used once it is too old
+CALLDATA_TTL = 30
+CALLDATA_MAX_BLOCKS = 10
+
+# ERC20 approve(address,uint256) selector
+APPROVE_SELECTOR = "0x095ea7b3"
+
+
+def is_calldata_fresh(prefetched: PrefetchedCalldata, block_number: int) -> bool:
+    return (
+        monotonic() - prefetched["fetched_at"] <= CALLDATA_TTL
+        and block_number - prefetched["block_number"] <= CALLDATA_MAX_BLOCKS
+    )
+
+
+def with_approve_amount(calldata: dict, amount: int) -> dict | None:
+    """
+    Re-encode approve calldata for another amount, so one prefetched approval serves every preset.
+    Returns None if the calldata is not a plain approve call.
+    """
+    data: str = calldata.get("data", "")
+    if not data.startswith(APPROVE_SELECTOR) or len(data) != 2 + 8 + 64 * 2:
+        return None
+    return {**calldata, "data": data[: 2 + 8 + 64] + f"{amount:064x}"}
+
+
+async def prefetch_approve_calldata(
+    user_id: int, chain_id: int, rpc: str, token_address: str, amount: int
+):
+    """Fetch approve calldata in the background while the user picks an amount"""
+    oneinch = OneInchAPI()
+    try:
+        calldata, block_number = await asyncio.gather(
+            asyncio.to_thread(
+                oneinch.approve_swap_calldata, chain_id, token_address, amount
+            ),
+            asyncio.to_thread(get_block_number, rpc),
+        )
+    except OneInchAPIError as e:
+        # Only speculative, the swap will fetch it again
+        logger.warning("Failed to prefetch approve calldata", extra={"error": str(e)})
+        return
+    set_user_approve_calldata(
+        user_id,
+        chain_id,
+        token_address,
+        {"calldata": calldata, "block_number": block_number, "fetched_at": monotonic()},
+    )
+
+
+def get_prefetched_approve_calldata(
+    user_id: int, chain_id: int, token_address: str, amount: int, block_number: int
+) -> dict | None:
+    prefetched = get_user_approve_calldata(user_id, chain_id, token_address)
+    if prefetched is None or not is_calldata_fresh(prefetched, block_number):
+        return None
+    return with_approve_amount(prefetched["calldata"], amount)
+
+
+async def fetch_swap_calldata(
+    chain_id: int,
+    rpc: str,
+    src_token_address: str,
+    dst_token_address: str,
+    amount: int,
+    wallet_address: str,
+    slippage,
+    disable_estimate=False,
+) -> PrefetchedCalldata:
+    """
+    Fetch swap calldata along with the block it was fetched at.
+    Use disable_estimate when fetching before the approval is mined.
+    Raises OneInchAPIError if 1inch fails.
+    """
+    oneinch = OneInchAPI()
+    calldata, block_number = await asyncio.gather(
+        asyncio.to_thread(
+            oneinch.perform_swap_calldata,
+            chain_id,
+            src_token_address,
+            dst_token_address,
+            amount,
+            wallet_address,
+            slippage,
+            disable_estimate,
+        ),
+        asyncio.to_thread(get_block_number, rpc),
+    )
+    if disable_estimate:
+        # 1inch does not estimate gas in this mode, gas is estimated when sending instead
+        calldata["tx"].pop("gas", None)
+    return {
+        "calldata": calldata,
+        "block_number": block_number,
+        "fetched_at": monotonic(),
+    }
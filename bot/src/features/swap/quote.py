@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from oneinch_api import OneInchAPI, OneInchAPIError
+from util import percentage_of
+from features.tokens.info import get_token_info
+from features.swap.types import PresetQuote, PresetQuotes
+from cache.quote import get_user_preset_quotes, set_user_preset_quotes
+
+logger = logging.getLogger(__name__)
+
+# Percentages of the source token balance offered on the buy/sell menus
+PRESET_PERCENTAGES = [25, 50, 75, 100]
+
+
+async def quote_presets(
+    chain_id: int, wallet_address: str, src_token_address: str, dst_token_address: str
+) -> PresetQuotes:
+    """
+    Quote every preset percentage of the wallet's src token balance.
+    Token info and balance are fetched together, then all presets are quoted concurrently.
+    Raises OneInchAPIError if the token info or balance cannot be fetched.
+    """
+    oneinch = OneInchAPI()
+    src_info, dst_info, balances = await asyncio.gather(
+        asyncio.to_thread(get_token_info, chain_id, src_token_address),
+        asyncio.to_thread(get_token_info, chain_id, dst_token_address),
+        asyncio.to_thread(
+            oneinch.get_token_balance, chain_id, wallet_address, [src_token_address]
+        ),
+    )
+    balance = int(list(balances.values())[0]) if balances else 0
+
+    amounts_in = {
+        percentage: percentage_of(balance, percentage)
+        for percentage in PRESET_PERCENTAGES
+    }
+
+    async def quote(amount_in: int) -> int:
+        # No point asking 1inch for a quote on nothing
+        if amount_in == 0:
+            return 0
+        try:
+            amount_out = await asyncio.to_thread(
+                oneinch.quoted_swap,
+                chain_id,
+                src_token_address,
+                dst_token_address,
+                amount_in,
+            )
+        except OneInchAPIError as e:
+            # The preset is still usable without a quote, it just won't show the amount out
+            logger.warning("Failed to quote preset", extra={"error": str(e)})
+            return 0
+        return amount_out
+
+    amounts_out = await asyncio.gather(
+        *(quote(amounts_in[percentage]) for percentage in PRESET_PERCENTAGES)
+    )
+
+    quotes: dict[int, PresetQuote] = {
+        percentage: {
+            "percentage": percentage,
+            "amount_in": amounts_in[percentage],
+            "amount_out": amount_out,
+        }
+        for percentage, amount_out in zip(PRESET_PERCENTAGES, amounts_out)
+    }
+
+    return {
+        "chain_id": chain_id,
+        "src_token_address": src_token_address,
+        "dst_token_address": dst_token_address,
+        "src_decimals": src_info["decimals"],
+        "dst_decimals": dst_info["decimals"],
+        "balance": balance,
+        "quotes": quotes,
+    }
+
+
+async def get_preset_quotes(
+    user_id: int,
+    chain_id: int,
+    wallet_address: str,
+    src_token_address: str,
+    dst_token_address: str,
+) -> PresetQuotes:
+    """Get preset quotes for the user, reusing the ones shown on their menu if still fresh"""
+    quotes = get_user_preset_quotes(
+        user_id, chain_id, src_token_address, dst_token_address
+    )
+    if quotes is None:
+        quotes = await quote_presets(
+            chain_id, wallet_address, src_token_address, dst_token_address
+        )
+        set_user_preset_quotes(user_id, quotes)
+    return quotes
@@ -0,0 +1,36 @@
+from typing import TypedDict
+
+
+class PresetQuote(TypedDict):
+    percentage: int
+    # Amounts are in the token's smallest unit (bigint)
+    amount_in: int
+    amount_out: int
+
+
+class PresetQuotes(TypedDict):
+    chain_id: int
+    src_token_address: str
+    dst_token_address: str
+    src_decimals: int
+    dst_decimals: int
+    balance: int
+    # Map percentage of balance to its quote
+    quotes: dict[int, PresetQuote]
+
+
+class PrefetchedCalldata(TypedDict):
+    calldata: dict
+    # Block number and time (monotonic) the calldata was fetched at, used to invalidate it
+    block_number: int
+    fetched_at: float
+
+
+class SwapResult(TypedDict):
+    success: bool
+    # Reason for failure, shown to the user
+    error: str | None
+    # Map stage name (quote, approve, swap, confirm) to seconds spent
+    timings: dict[str, float]
+    # True if this caller joined a swap that was already running
+    coalesced: bool
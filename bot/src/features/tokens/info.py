@@ -0,0 +1,18 @@
+from oneinch_api import OneInchAPI
+from cache.token import get_cached_token_info, set_cached_token_info
+from features.tokens.registry import get_registry
+
+
+def get_token_info(chain_id: int, token_address: str) -> dict:
+    """
+    Token info from 1inch, cached as it never changes.
+    Raises OneInchAPIError if it is not cached and 1inch cannot be reached.
+    """
+    info = get_cached_token_info(chain_id, token_address)
+    if info is None:
+        registry = get_registry(chain_id)
+        info = registry.get(token_address) if registry else None
+    if info is None:
+        info = OneInchAPI().get_token_info(chain_id, token_address)
+        set_cached_token_info(chain_id, token_address, info)
+    return info
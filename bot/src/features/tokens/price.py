@@ -0,0 +1,35 @@
+import asyncio
+
+from oneinch_api import OneInchAPI
+from util import parse_decimal
+from features.tokens.info import get_token_info
+from cache.price import get_cached_pair_price, set_cached_pair_price
+
+
+async def get_pair_price(
+    chain_id: int, token0_address: str, token1_address: str, max_age: float = 0
+) -> float:
+    """
+    Price of one whole token0 in token1, from a 1inch quote.
+    A price quoted less than max_age seconds ago is reused.
+    Raises OneInchAPIError if 1inch cannot be reached.
+    """
+    if max_age:
+        price = get_cached_pair_price(chain_id, token0_address, token1_address, max_age)
+        if price is not None:
+            return price
+
+    token0_info, token1_info = await asyncio.gather(
+        asyncio.to_thread(get_token_info, chain_id, token0_address),
+        asyncio.to_thread(get_token_info, chain_id, token1_address),
+    )
+    amount_out = await asyncio.to_thread(
+        OneInchAPI().quoted_swap,
+        chain_id,
+        token0_address,
+        token1_address,
+        10 ** token0_info["decimals"],
+    )
+    price = parse_decimal(amount_out, token1_info["decimals"])
+    set_cached_pair_price(chain_id, token0_address, token1_address, price)
+    return price
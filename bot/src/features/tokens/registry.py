@@ -0,0 +1,163 @@
+import asyncio
+import heapq
+import logging
+from os import getenv
+
+from constants import networks
+from oneinch_api import OneInchAPI, OneInchAPIError
+from features.database.token import get_tokens, save_tokens
+from metrics import timer, cpu_seconds
+
+logger = logging.getLogger(__name__)
+
+# Seconds between syncs of the token list from 1inch
+SYNC_INTERVAL = int(getenv("TOKEN_REGISTRY_SYNC_INTERVAL", str(6 * 60 * 60)))
+SEARCH_LIMIT = 8
+
+
+def _trigrams(text: str) -> set[str]:
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class TokenIndex:
+    """
+    In-memory index over one chain's tokens for symbol search:
+    every prefix of the symbol and of each word of the name, plus trigrams of both for substring matches.
+    Built once per sync and never mutated, so searches need no locking.
+    """
+
+    def __init__(self, tokens: list[dict]):
+        # Map lowercase address to token info
+        self.tokens: dict[str, dict] = {}
+        # Map lowercase prefix/trigram to addresses
+        self.prefixes: dict[str, set[str]] = {}
+        self.trigrams: dict[str, set[str]] = {}
+
+        for token in tokens:
+            address = token["address"].lower()
+            self.tokens[address] = token
+            symbol = token["symbol"].lower()
+            words = [symbol] + token["name"].lower().split()
+            for word in words:
+                for i in range(1, len(word) + 1):
+                    self.prefixes.setdefault(word[:i], set()).add(address)
+            for trigram in _trigrams(symbol) | _trigrams(token["name"].lower()):
+                self.trigrams.setdefault(trigram, set()).add(address)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def get(self, address: str) -> dict | None:
+        return self.tokens.get(address.lower())
+
+    def search(self, query: str, limit=SEARCH_LIMIT) -> list[dict]:
+        """
+        Tokens matching query, best first: exact symbol, then symbol/name word prefix, then substring
+        """
+        query = query.strip().lower()
+        if not query:
+            return []
+        if query in self.tokens:
+            return [self.tokens[query]]
+
+        matches = set(self.prefixes.get(query, ()))
+        if len(query) >= 3 and len(matches) < limit:
+            candidates = None
+            for trigram in _trigrams(query):
+                found = self.trigrams.get(trigram, set())
+                candidates = found if candidates is None else candidates & found
+                if not candidates:
+                    break
+            for address in candidates or ():
+                token = self.tokens[address]
+                if query in token["symbol"].lower() or query in token["name"].lower():
+                    matches.add(address)
+
+        def rank(address: str):
+            symbol = self.tokens[address]["symbol"].lower()
+            return (
+                symbol != query,
+                not symbol.startswith(query),
+                len(symbol),
+                symbol,
+            )
+
+        return [
+            self.tokens[address]
+            for address in heapq.nsmallest(limit, matches, key=rank)
+        ]
+
+
+# Map chain id to its token index, replaced wholesale on every sync
+registries: dict[int, TokenIndex] = {}
+
+
+def get_registry(chain_id: int) -> TokenIndex | None:
+    return registries.get(chain_id)
+
+
+def search_tokens(chain_id: int, query: str, limit=SEARCH_LIMIT) -> list[dict]:
+    """Search the chain's registry for tokens by symbol or name. Empty until the registry is loaded."""
+    registry = registries.get(chain_id)
+    return registry.search(query, limit) if registry else []
+
+
+def _build_index(chain_id: int, tokens: list[dict]):
+    with timer(cpu_seconds, operation="build_token_index"):
+        registries[chain_id] = TokenIndex(tokens)
+
+
+def load_registry(chain_id: int):
+    """Load the chain's tokens saved by the last sync"""
+    tokens = get_tokens(chain_id)
+    if tokens:
+        _build_index(chain_id, tokens)
+
+
+def sync_registry(chain_id: int):
+    """Fetch the chain's token list from 1inch, index it and save it"""
+    token_list = OneInchAPI().get_token_list(chain_id)
+    tokens = [
+        {
+            "address": address.lower(),
+            "symbol": info.get("symbol") or "",
+            "name": info.get("name") or "",
+            "decimals": info.get("decimals") or 0,
+        }
+        for address, info in token_list.items()
+        if info.get("symbol")
+    ]
+    _build_index(chain_id, tokens)
+    save_tokens(chain_id, tokens)
+    logger.info(
+        "Synced token registry", extra={"chain_id": chain_id, "tokens": len(tokens)}
+    )
+
+
+async def sync_registries_forever():
+    """
+    Background job: serve the saved registries straight away, then keep them in sync with 1inch.
+    The sync is a bulk fetch per chain, so searches never hit 1inch.
+    """
+    for chain_id in networks:
+        try:
+            await asyncio.to_thread(load_registry, chain_id)
+        except Exception:
+            logger.exception(
+                "Failed to load token registry", extra={"chain_id": chain_id}
+            )
+
+    while True:
+        for chain_id in networks:
+            try:
+                await asyncio.to_thread(sync_registry, chain_id)
+            except OneInchAPIError as e:
+                logger.warning(
+                    "Failed to sync token registry",
+                    extra={"chain_id": chain_id, "error": str(e)},
+                )
+            except Exception:
+                logger.exception(
+                    "Failed to sync token registry", extra={"chain_id": chain_id}
+                )
+        await asyncio.sleep(SYNC_INTERVAL)
@@ -0,0 +1,48 @@
+import asyncio
+
+from oneinch_api import OneInchAPI
+from cache.search import get_cached_token_search, set_cached_token_search
+from features.tokens.registry import SEARCH_LIMIT, search_tokens
+
+# 1inch returns at most this many tokens per search
+ONEINCH_SEARCH_LIMIT = 10
+
+
+def _matches(token: dict, query: str) -> bool:
+    query = query.lower()
+    return (
+        query in (token.get("symbol") or "").lower()
+        or query in (token.get("name") or "").lower()
+    )
+
+
+def _cached_prefix_search(chain_id: int, query: str) -> list[dict] | None:
+    """
+    Narrow down a cached search for a shorter prefix of query, e.g. "usd" while typing "usdc".
+    Only valid if that search returned everything 1inch had, i.e. fewer results than its limit.
+    """
+    for length in range(len(query) - 1, 0, -1):
+        tokens = get_cached_token_search(chain_id, query[:length])
+        if tokens is not None and len(tokens) < ONEINCH_SEARCH_LIMIT:
+            return [token for token in tokens if _matches(token, query)]
+    return None
+
+
+async def find_tokens(chain_id: int, query: str, limit=SEARCH_LIMIT) -> list[dict]:
+    """
+    Tokens matching query by symbol or name: from the local registry when it has matches,
+    else from 1inch search, cached and narrowed locally as the query gets longer.
+    Raises OneInchAPIError if 1inch has to be asked and cannot be reached.
+    """
+    tokens = search_tokens(chain_id, query, limit)
+    if tokens:
+        return tokens
+
+    query = query.strip().lower()
+    tokens = get_cached_token_search(chain_id, query)
+    if tokens is None:
+        tokens = _cached_prefix_search(chain_id, query)
+    if tokens is None:
+        tokens = await asyncio.to_thread(OneInchAPI().search_tokens, chain_id, query)
+        set_cached_token_search(chain_id, query, tokens)
+    return tokens[:limit]
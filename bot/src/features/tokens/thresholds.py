@@ -0,0 +1,92 @@
+from bisect import bisect_left, bisect_right, insort
+
+# (chain id, lowercase token0 address, lowercase token1 address)
+Pair = tuple[int, str, str]
+
+
+def to_pair(chain_id: int, token0_address: str, token1_address: str) -> Pair:
+    return (chain_id, token0_address.lower(), token1_address.lower())
+
+
+class PairThresholds:
+    """
+    Price thresholds on one pair, sorted separately for each direction.
+    Every threshold covers a price interval, [threshold, inf) or (-inf, threshold],
+    so the ones a price falls in are a prefix or suffix found by binary search.
+    """
+
+    def __init__(self):
+        # Sorted (threshold, id)
+        self.above: list[tuple[float, int]] = []
+        self.below: list[tuple[float, int]] = []
+
+    def __len__(self):
+        return len(self.above) + len(self.below)
+
+    def add(self, item_id: int, threshold: float, above: bool):
+        insort(self.above if above else self.below, (threshold, item_id))
+
+    def remove(self, item_id: int, threshold: float, above: bool):
+        thresholds = self.above if above else self.below
+        entry = (threshold, item_id)
+        i = bisect_left(thresholds, entry)
+        if i < len(thresholds) and thresholds[i] == entry:
+            del thresholds[i]
+
+    def pop_triggered(self, price: float) -> list[int]:
+        """Remove and return the ids of thresholds the price has reached"""
+        # Above thresholds <= price
+        above_end = bisect_right(self.above, (price, float("inf")))
+        triggered = [item_id for _, item_id in self.above[:above_end]]
+        del self.above[:above_end]
+        # Below thresholds >= price
+        below_start = bisect_left(self.below, (price, float("-inf")))
+        triggered += [item_id for _, item_id in self.below[below_start:]]
+        del self.below[below_start:]
+        return triggered
+
+
+class ThresholdIndex:
+    """
+    Items (e.g. price alerts, limit orders) waiting for a pair's price to reach a threshold, grouped by pair
+    so each check prices every pair once however many items it has
+    """
+
+    def __init__(self):
+        # Map id to (pair, threshold, above, item)
+        self.items: dict[int, tuple[Pair, float, bool, dict]] = {}
+        self.pairs: dict[Pair, PairThresholds] = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item_id: int, pair: Pair, threshold: float, above: bool, item: dict):
+        """
+        Args:
+            above: True to trigger when the price rises to threshold, False when it falls to it
+        """
+        if item_id in self.items:
+            return
+        self.items[item_id] = (pair, threshold, above, item)
+        self.pairs.setdefault(pair, PairThresholds()).add(item_id, threshold, above)
+
+    def remove(self, item_id: int):
+        entry = self.items.pop(item_id, None)
+        if entry is None:
+            return
+        pair, threshold, above, _ = entry
+        self.pairs[pair].remove(item_id, threshold, above)
+        if not self.pairs[pair]:
+            del self.pairs[pair]
+
+    def pop_triggered(self, pair: Pair, price: float) -> list[dict]:
+        pair_thresholds = self.pairs.get(pair)
+        if pair_thresholds is None:
+            return []
+        triggered = [
+            self.items.pop(item_id)[3]
+            for item_id in pair_thresholds.pop_triggered(price)
+        ]
+        if not pair_thresholds:
+            del self.pairs[pair]
+        return triggered
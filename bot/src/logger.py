@@ -0,0 +1,37 @@
+import json
+import logging
+from os import getenv
+from time import gmtime, strftime
+
+# Attributes every LogRecord has, anything else was passed through `extra` and is logged as a field
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with fields passed via `extra` included as keys"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": strftime("%Y-%m-%dT%H:%M:%S", gmtime(record.created))
+            + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging():
+    """Log structured JSON to stderr, at LOG_LEVEL (default INFO)"""
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(getenv("LOG_LEVEL", "INFO").upper())
+    # httpx logs every Telegram poll at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
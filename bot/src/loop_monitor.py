@@ -0,0 +1,152 @@
+# Event loop lag monitor and blocking call detector.
+# A ticker task on the loop measures how late it wakes up (lag) and leaves a heartbeat. A watchdog
+# thread notices when the heartbeat stops for longer than the threshold, meaning some callback is
+# blocking the loop, and captures the loop thread's stack while the offender is still running.
+import asyncio
+import logging
+import sys
+import traceback
+from collections import deque
+from os import getenv
+from pathlib import Path
+from threading import Event, Thread, get_ident
+from time import monotonic
+
+from metrics import counter, histogram
+
+logger = logging.getLogger(__name__)
+
+SRC_DIR = str(Path(__file__).resolve().parent)
+
+loop_lag_seconds = histogram(
+    "bot_event_loop_lag_seconds",
+    "How late the event loop woke up a sleeping task",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+loop_blocked = counter(
+    "bot_event_loop_blocked_total",
+    "Times a callback blocked the event loop for longer than the threshold, by offender",
+)
+loop_blocked_seconds = histogram(
+    "bot_event_loop_blocked_seconds",
+    "How long callbacks blocked the event loop for, by offender",
+)
+
+
+class BlockedCall:
+    def __init__(self, seconds: float, stack: list[traceback.FrameSummary]):
+        self.seconds = seconds
+        self.stack = stack
+
+    @property
+    def offender(self) -> str:
+        """Innermost frame in the bot's own code, e.g. charts.py:generate_chart"""
+        for frame in reversed(self.stack):
+            if frame.filename.startswith(SRC_DIR) and not frame.filename.endswith(
+                "loop_monitor.py"
+            ):
+                return f"{Path(frame.filename).name}:{frame.name}"
+        if self.stack:
+            frame = self.stack[-1]
+            return f"{Path(frame.filename).name}:{frame.name}"
+        return "unknown"
+
+    def format_stack(self) -> str:
+        return "".join(traceback.format_list(self.stack))
+
+
+class LoopMonitor:
+    def __init__(self, threshold=0.1, interval=0.05, debug=False):
+        """
+        Args:
+            threshold: Seconds a callback may hold the loop before it is reported
+            interval: Seconds between lag samples
+            debug: Also turn on asyncio debug mode, which logs every callback slower than threshold
+                (with more overhead than the watchdog)
+        """
+        self.threshold = threshold
+        self.interval = interval
+        self.debug = debug
+        # Most recent blocked calls, for the benchmarks and debugging
+        self.blocked: deque[BlockedCall] = deque(maxlen=100)
+        self.heartbeat = monotonic()
+        self.loop_thread_id: int | None = None
+        self.task: asyncio.Task | None = None
+        self.stopped = Event()
+
+    def start(self):
+        """Start monitoring the running loop"""
+        loop = asyncio.get_running_loop()
+        if self.debug:
+            loop.set_debug(True)
+            loop.slow_callback_duration = self.threshold
+        self.loop_thread_id = get_ident()
+        self.heartbeat = monotonic()
+        self.stopped.clear()
+        self.task = loop.create_task(self._tick())
+        Thread(target=self._watch, daemon=True, name="loop-monitor").start()
+
+    async def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _tick(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            loop_lag_seconds.observe(max(0.0, loop.time() - start - self.interval))
+            self.heartbeat = monotonic()
+
+    def _watch(self):
+        # Heartbeat of the stall being tracked and the stack captured when it was noticed
+        stalled_heartbeat = None
+        stack = None
+        while not self.stopped.wait(self.threshold / 4):
+            heartbeat = self.heartbeat
+            if stalled_heartbeat is not None and heartbeat != stalled_heartbeat:
+                # The loop came back
+                self._report(heartbeat - stalled_heartbeat - self.interval, stack)
+                stalled_heartbeat = None
+                stack = None
+            elif (
+                stalled_heartbeat is None
+                and monotonic() - heartbeat - self.interval > self.threshold
+            ):
+                frame = sys._current_frames().get(self.loop_thread_id)
+                stalled_heartbeat = heartbeat
+                stack = traceback.extract_stack(frame) if frame else []
+
+    def _report(self, seconds: float, stack: list[traceback.FrameSummary]):
+        blocked = BlockedCall(seconds, stack)
+        self.blocked.append(blocked)
+        loop_blocked.inc(offender=blocked.offender)
+        loop_blocked_seconds.observe(seconds, offender=blocked.offender)
+        logger.warning(
+            "Event loop blocked for %.3fs by %s",
+            seconds,
+            blocked.offender,
+            extra={
+                "blocked_seconds": seconds,
+                "offender": blocked.offender,
+                "stack": blocked.format_stack(),
+            },
+        )
+
+
+def start_loop_monitor() -> LoopMonitor | None:
+    """
+    Start monitoring the running loop as configured by LOOP_MONITOR (prod, debug or off, default prod)
+    and LOOP_BLOCK_THRESHOLD (seconds, default 0.1)
+    """
+    mode = getenv("LOOP_MONITOR", "prod").lower()
+    if mode == "off":
+        return None
+    monitor = LoopMonitor(
+        threshold=float(getenv("LOOP_BLOCK_THRESHOLD", "0.1")), debug=mode == "debug"
+    )
+    monitor.start()
+    return monitor
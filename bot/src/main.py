@@ -1,63 +1,160 @@
+import asyncio
+import logging
+import re
 from os import getenv
-from typing import Callable, TypedDict
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from datetime import datetime
+from time import perf_counter
+from telegram import (
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+    Update,
+)
 from telegram.constants import ParseMode
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
     MessageHandler,
     filters,
 )
 from features.database import get_connection
-from eth_account import Account
-from features.database.user import get_user, add_user
-from wallet import withdraw_tokens, execute_transaction, get_wallet_details
-from features.commands.types import Command
+from features.database.user import add_user
+import wallet
+from wallet import (
+    withdraw_tokens,
+    get_wallet_details,
+    get_private_key,
+    get_token_balance,
+    sweep_wallet,
+)
+from features.commands.types import Command, InputKind
+from features.commands.dispatch import StateMachine, Transition
+from features.outbox.sender import get_outbox, send_message, send_photo
+from features.session.types import Session, SwapDraft, User, WithdrawDraft
 from cache.user import (
-    get_user_current_stage,
+    get_session,
+    load_user,
     set_user_current_stage,
     unset_user_current_stage,
 )
-from oneinch_api import OneInchAPI
+from oneinch_api import OneInchAPI, OneInchAPIError, is_unavailable_error
+import charts
 from charts import generate_chart
 from constants import networks
-from util import parse_decimal, format_decimal
+from util import parse_decimal, parse_amount, format_amount
+from features.swap.quote import get_preset_quotes
+from features.swap.types import PresetQuotes
+from features.swap.prefetch import prefetch_approve_calldata
+from metrics import (
+    timed_handler,
+    timer,
+    upstream_seconds,
+    upstream_errors,
+    start_metrics_server,
+)
+from logger import setup_logging
+from loop_monitor import start_loop_monitor
+from features.tokens.info import get_token_info
+from features.tokens.registry import search_tokens, sync_registries_forever
+from features.tokens.search import find_tokens
+from features.portfolio.types import ChainPortfolio
+from features.portfolio.valuation import get_chain_portfolio, get_portfolio
+from features.tokens.price import get_pair_price
+from features.alerts.engine import (
+    CHECK_INTERVAL as ALERT_CHECK_INTERVAL,
+    alert_index,
+    check_alerts_forever,
+    index_alert,
+)
+from features.database.alert import add_alert, delete_alert, get_active_alerts
+from features.database.order import add_order, cancel_order, get_orders
+from features.orders.executor import (
+    CHECK_INTERVAL as ORDER_CHECK_INTERVAL,
+    OrderExecutor,
+    describe_order,
+    index_order,
+    order_book,
+)
+from features.database.dca import add_dca_plan, cancel_dca_plan, get_user_dca_plans
+from features.dca.scheduler import DcaScheduler, describe_plan, utcnow
+from features.swap.quote import PRESET_PERCENTAGES
+from cache.snapshot import (
+    SNAPSHOT_PATH,
+    load_snapshot,
+    save_snapshot,
+    save_snapshots_forever,
+)
+from cache.balance import (
+    get_cached_balances,
+    set_cached_balances,
+    unset_cached_balances,
+)
+from features.balances.watcher import (
+    POLL_INTERVAL,
+    get_watched_balances,
+    watch_balances_forever,
+    watch_user,
+)
+from features.swap.engine import execute_swap, is_swap_in_flight
+from features.database.ledger import get_ledger_page, get_pnl_positions
+from features.ledger.history import (
+    PAGE_SIZE,
+    decode_cursor,
+    describe_entries,
+    describe_pnl,
+    encode_cursor,
+)
+from features.ledger.recorder import (
+    flush as flush_ledger,
+    record_in_background,
+    transferred_amount,
+)
+
+logger = logging.getLogger(__name__)
 
-Account.enable_unaudited_hdwallet_features()
 
+class TimedRequest(HTTPXRequest):
+    """Records how long each Telegram Bot API call takes, by method (sendMessage, sendPhoto, ...)"""
 
-class WithdrawInfo(TypedDict):
-    withdraw_wallet_address: str
-    withdraw_token_address: str
-    withdraw_amount: float
+    async def do_request(self, url: str, *args, **kwargs):
+        operation = url.rsplit("/", 1)[-1]
+        with timer(
+            upstream_seconds, upstream_errors, upstream="telegram", operation=operation
+        ):
+            return await super().do_request(url, *args, **kwargs)
 
 
-# Stores withdrawal data input by the user
-# Map user id to withdrawal info
-withdrawal: dict[int, WithdrawInfo] = {}
+# Selected in place of a token address to sweep every balance
+WITHDRAW_ALL = "ALL"
 
 
 # Define the main menu keyboard layout
-def main_menu_keyboard(user: dict):
+def main_menu_keyboard(user: User):
     """
     Args:
-        user (dict): Result from get_user
+        user (User): The user's profile, from load_user
     """
     buttons: list[list[InlineKeyboardButton]] = []
 
     # Get the chain name
-    chain_id = user.get("chain_id", -1)
+    chain_id = user.chain_id
     chain_info = networks.get(chain_id)
     chain_name = chain_info["name"] if chain_info else chain_id
 
     # Populate current configuration into button text
     if chain_name:
         buttons.append(
-            [InlineKeyboardButton("Withdraw", callback_data=Command.WITHDRAW.value)]
+            [
+                InlineKeyboardButton("Withdraw", callback_data=Command.WITHDRAW.value),
+                InlineKeyboardButton("History", callback_data=Command.HISTORY.value),
+            ]
         )
 
-    slippage = user["slippage"]
+    slippage = user.slippage
     buttons.append(
         [
             InlineKeyboardButton(
@@ -71,8 +168,8 @@ def main_menu_keyboard(user: dict):
     )
 
     # Only if a chain has been chosen, the user can set the token addresses
-    token0_name = user.get("token0_name")
-    token1_name = user.get("token1_name")
+    token0_name = user.token0_name
+    token1_name = user.token1_name
     if chain_id:
         buttons.append(
             [
@@ -100,23 +197,178 @@ def main_menu_keyboard(user: dict):
                 ),
             ]
         )
+        buttons.append(
+            [
+                InlineKeyboardButton(
+                    "Price Alerts", callback_data=Command.ALERTS.value
+                ),
+                InlineKeyboardButton(
+                    "Limit/Stop Orders", callback_data=Command.ORDERS.value
+                ),
+            ]
+        )
+        buttons.append(
+            [InlineKeyboardButton("Recurring Buys", callback_data=Command.DCA.value)]
+        )
 
     buttons.append(
-        [InlineKeyboardButton("Refresh", callback_data=Command.REFRESH.value)]
+        [
+            InlineKeyboardButton("Refresh", callback_data=Command.REFRESH.value),
+            InlineKeyboardButton("All Chains", callback_data=Command.PORTFOLIO.value),
+        ]
     )
 
     return InlineKeyboardMarkup(buttons)
 
 
-async def show_main_menu(user: dict, context):
+def preset_amount_keyboard(preset_quotes: PresetQuotes, dst_token_name: str):
+    """
+    Buttons for each preset percentage, labelled with the amount of dst token it would return
+    Args:
+        preset_quotes (PresetQuotes): Result from get_preset_quotes
+    """
+    buttons: list[list[InlineKeyboardButton]] = []
+    dst_decimals = preset_quotes["dst_decimals"]
+
+    for percentage, quote in preset_quotes["quotes"].items():
+        text = f"{percentage}%"
+        if quote["amount_out"]:
+            amount_out = parse_decimal(quote["amount_out"], dst_decimals)
+            text += f" (~{amount_out:.6g} {dst_token_name})"
+        button = InlineKeyboardButton(text, callback_data=str(percentage))
+
+        # 2 buttons per row
+        if buttons and len(buttons[-1]) < 2:
+            buttons[-1].append(button)
+        else:
+            buttons.append([button])
+
+    return InlineKeyboardMarkup(buttons)
+
+
+ADDRESS_PATTERN = re.compile(r"^0x[0-9a-fA-F]{40}$")
+
+
+# Validators for the input of a stage, returning the reply if it is not valid
+def validate_address(text: str) -> str | None:
+    if not ADDRESS_PATTERN.match(text):
+        return "Invalid wallet address, please enter it again:"
+    return None
+
+
+def validate_withdraw_token(data: str) -> str | None:
+    if data != WITHDRAW_ALL and not ADDRESS_PATTERN.match(data):
+        return "Please select a token from the list."
+    return None
+
+
+def validate_id(data: str) -> str | None:
+    if not data.isdigit():
+        return "Please select one from the list."
+    return None
+
+
+def validate_percentage(data: str) -> str | None:
+    if not data.isdigit() or int(data) not in PRESET_PERCENTAGES:
+        return "Please select an amount from the list."
+    return None
+
+
+def validate_history_cursor(data: str) -> str | None:
+    try:
+        decode_cursor(data)
+    except ValueError:
+        return "Invalid page."
+    return None
+
+
+def validate_chain_id(text: str) -> str | None:
+    if not text.strip().isdigit():
+        return "Invalid chain ID, please enter a number:"
+    return None
+
+
+def validate_slippage(text: str) -> str | None:
+    try:
+        slippage = float(text)
+    except ValueError:
+        slippage = -1
+    if not 0 <= slippage <= 100:
+        return "Invalid slippage, please enter a percentage, e.g. 1:"
+    return None
+
+
+def token_search_keyboard(tokens: list[dict]):
+    """
+    One button per token, which sends back its address
+    Args:
+        tokens (list[dict]): Result from search_tokens
+    """
+    buttons = [
+        [
+            InlineKeyboardButton(
+                (
+                    f"{token['symbol']} ({token['name']})"
+                    if token["name"] and token["name"] != token["symbol"]
+                    else token["symbol"]
+                ),
+                callback_data=token["address"],
+            )
+        ]
+        for token in tokens
+    ]
+    return InlineKeyboardMarkup(buttons)
+
+
+async def reply_token_search(user_id: int, chain_id: int, query: str, context):
+    """Let the user pick from tokens in the chain's registry matching their query"""
+    tokens = search_tokens(chain_id, query)
+    if not tokens:
+        text = f"No tokens found for '{query}'. Please enter another symbol or paste the address."
+        send_message(context.bot, user_id, text)
+        return
+    text = "Select a token, or enter another symbol (click here to /cancel):"
+    send_message(
+        context.bot,
+        chat_id=user_id,
+        text=text,
+        reply_markup=token_search_keyboard(tokens),
+    )
+
+
+def portfolio_text(portfolio: ChainPortfolio) -> str:
+    """Balances and USD total of one chain, as shown on the main menu"""
+    if not portfolio["balances_available"]:
+        return "\nBalance is temporarily unavailable, please Refresh later.\n"
+
+    if portfolio["balances_stale"]:
+        text = "\nBalance (last known, 1inch is unavailable):\n"
+    else:
+        text = "\nBalance:\n"
+    for token_address in portfolio["unknown_tokens"]:
+        text += f"{token_address}: (token info unavailable)\n"
+    for holding in portfolio["holdings"]:
+        text += f"{holding['name']}: {holding['amount']}\n"
+
+    # Show USD equivalent of all coins
+    text += f"Total Balance (USD): {portfolio['usd_total']}"
+    if portfolio["usd_incomplete"]:
+        text += " (some tokens could not be priced)"
+    elif portfolio["usd_stale"]:
+        text += " (using last known prices)"
+    return text
+
+
+@timed_handler
+async def show_main_menu(user: User, context):
     """Default prompt which shows token0/token1 graph, wallet address and balance"""
-    user_id = user["id"]
+    user_id = user.id
 
     # Loading message because stuff takes pretty long to load here.
-    await context.bot.send_message(chat_id=user_id, text="Loading, please wait...")
+    send_message(context.bot, user_id, "Loading, please wait...", transient=True)
 
-    chain_id = user.get("chain_id")
-    wallet = get_wallet_details(user["derivation_path"])
+    chain_id = user.chain_id
+    wallet = get_wallet_details(user.derivation_path)
     wallet_address = wallet["address"]
 
     text = ""
@@ -126,69 +378,26 @@ async def show_main_menu(user: dict, context):
 
     # If chain has been set, we can retrieve token balance for the user
     if chain_id:
-        oneinch = OneInchAPI()
-        # Mapping of address to value
-        balances: dict[str, str] = oneinch.get_token_balance(chain_id, wallet_address)
-
-        text += "\nBalance:\n"
-        # Mapping of address to a dict containing balance and token name
-        nonzero_balances: dict[str, dict] = {}
-        for token_address, token_value_str in balances.items():
-            # For non-zero balances, look up more info on the token
-            if token_value_str != "0":
-                # Look up info using API
-                # TODO: Actually test this
-                token_info = oneinch.get_token_info(chain_id, token_address)
-                token_name = token_info.get("symbol", token_address)
-                decimals = token_info.get("decimals")
-                nonzero_balances[token_address] = {
-                    "amount": parse_decimal(int(token_value_str), decimals),
-                    "name": token_name,
-                    "decimals": decimals,
-                }
-
-        # Append text and calculate USD equivalent
-        usd_equiv = 0
-        token0_address = user["token0_address"]
-        token1_address = user["token1_address"]
-        network_info = networks[chain_id]
-        usdc_address = network_info["usdc_address"]
-
-        for token_address, info in nonzero_balances.items():
-            amount: float = info["amount"]
-            name: str = info["name"]
-            decimals = info["decimals"]
-            if token_address.lower() == usdc_address:
-                usd_equiv += amount
-            else:
-                # Get a quote from oneinch
-                dst_amount = oneinch.quoted_swap(
-                    chain_id,
-                    token_address,
-                    usdc_address,
-                    format_decimal(amount, decimals),
-                )
-                # 6 decimals as stablecoins only up to 6 decimals
-                human_form = parse_decimal(dst_amount, 6)
-                usd_equiv += human_form
-
-            # Append text for current iterating token
-            text += f"{name}: {amount}\n"
-
-        # Show USD equivalent of all coins
-        text += f"Total Balance (USD): {usd_equiv}"
+        portfolio = await get_chain_portfolio(chain_id, wallet_address)
+        text += portfolio_text(portfolio)
 
     chart = None
-    token0_address = user.get("token0_address")
-    token1_address = user.get("token1_address")
+    token0_address = user.token0_address
+    token1_address = user.token1_address
     if chain_id and token0_address and token1_address:
-        token0_name = user["token0_name"]
-        token1_name = user["token1_name"]
-        chart = generate_chart(
-            chain_id, token0_address, token0_name, token1_address, token1_name
+        token0_name = user.token0_name
+        token1_name = user.token1_name
+        chart = await asyncio.to_thread(
+            generate_chart,
+            chain_id,
+            token0_address,
+            token0_name,
+            token1_address,
+            token1_name,
         )
         if chart is not None:
-            await context.bot.send_photo(
+            send_photo(
+                context.bot,
                 photo=chart,
                 chat_id=user_id,
                 caption=text,
@@ -198,7 +407,8 @@ async def show_main_menu(user: dict, context):
             return
 
     # In case there is no graph, we send a message without the photo
-    await context.bot.send_message(
+    send_message(
+        context.bot,
         chat_id=user_id,
         text=text,
         parse_mode=ParseMode.MARKDOWN,
@@ -210,15 +420,15 @@ async def show_main_menu(user: dict, context):
 
 
 #### WALLET ####
-async def handle_withdraw(query, context):
+@timed_handler
+async def handle_withdraw(update: Update, session: Session, data: str, context):
     """
     Withdraw command
     """
-    user_id = query.from_user.id
-    user = get_user(user_id)
-    assert user is not None
-    chain_id = user.get("chain_id")
-    derivation_path = user["derivation_path"]
+    user = session.user
+    user_id = user.id
+    chain_id = user.chain_id
+    derivation_path = user.derivation_path
     wallet = get_wallet_details(derivation_path)
     wallet_address = wallet["address"]
 
@@ -227,517 +437,1114 @@ async def handle_withdraw(query, context):
     buttons: list[list[InlineKeyboardButton]] = []
 
     # For each token that the user holds, create a new button to select it
-    balances: dict[str, str] = oneinch.get_token_balance(chain_id, wallet_address)
-    for token_address, amount_str in balances.items():
-        if amount_str != "0":
-            token_info = oneinch.get_token_info(chain_id, token_address)
-            token_name = token_info.get("symbol", token_address)
-            buttons.append(
-                [InlineKeyboardButton(token_name, callback_data=token_address)]
+    balances = get_watched_balances(chain_id, wallet_address)
+    if balances is None:
+        try:
+            balances = await asyncio.to_thread(
+                oneinch.get_token_balance, chain_id, wallet_address
+            )
+            set_cached_balances(chain_id, wallet_address, balances)
+        except OneInchAPIError as e:
+            logger.warning(
+                "Failed to get balances, using last known", extra={"error": str(e)}
             )
+            balances = get_cached_balances(chain_id, wallet_address)
+            if balances is None:
+                text = "Unable to get your balances right now, please try again later."
+                send_message(context.bot, user_id, text)
+                return
+    held = [
+        token_address
+        for token_address, amount_str in balances.items()
+        if amount_str != "0"
+    ]
+    token_infos = await asyncio.gather(
+        *(
+            asyncio.to_thread(get_token_info, chain_id, token_address)
+            for token_address in held
+        ),
+        return_exceptions=True,
+    )
+    for token_address, token_info in zip(held, token_infos):
+        if isinstance(token_info, OneInchAPIError):
+            token_info = {}
+        elif isinstance(token_info, BaseException):
+            raise token_info
+        token_name = token_info.get("symbol", token_address)
+        buttons.append([InlineKeyboardButton(token_name, callback_data=token_address)])
+
+    if buttons:
+        buttons.insert(
+            0, [InlineKeyboardButton("Withdraw All", callback_data=WITHDRAW_ALL)]
+        )
 
     # Ask user to select token
     set_user_current_stage(user_id, Command.WITHDRAW, 1)
     markup = InlineKeyboardMarkup(buttons)
     text = "Select token to withdraw"
-    await context.bot.send_message(chat_id=user_id, text=text, reply_markup=markup)
+    send_message(context.bot, chat_id=user_id, text=text, reply_markup=markup)
 
 
-async def handle_withdraw_selected_token(data: str, user: dict, context):
+@timed_handler
+async def handle_withdraw_selected_token(
+    update: Update, session: Session, data: str, context
+):
     token_address = data
-    user_id = user["id"]
-    withdrawal[user_id] = {"withdraw_token_address": token_address}
+    user_id = session.user.id
+    session.withdraw = WithdrawDraft(token_address)
 
     # Prompt user to enter withdrawal address
     text = "Enter wallet address to withdraw to:"
-    await context.bot.send_message(chat_id=user_id, text=text)
+    send_message(context.bot, user_id, text)
 
     # Update next stage: Get withdrawal address
     set_user_current_stage(user_id, Command.WITHDRAW, 2)
 
 
-async def handle_withdraw_wallet_address(data: str, user: dict, context):
+@timed_handler
+async def handle_withdraw_wallet_address(
+    update: Update, session: Session, data: str, context
+):
     wallet_address = data
-    user_id = user["id"]
-    current_withdraw_info = withdrawal[user_id]
-    withdrawal[user_id] = {
-        **current_withdraw_info,
-        "withdraw_wallet_address": wallet_address,
-    }
+    user = session.user
+    user_id = user.id
+    draft = session.withdraw
+    if draft.token_address == WITHDRAW_ALL:
+        await handle_withdraw_all(wallet_address, user, context)
+        return
+    draft.wallet_address = wallet_address
 
     # Prompt user to input withdrawal amount
-    text = "Enter amount to withdraw:"
-    await context.bot.send_message(chat_id=user_id, text=text)
+    text = "Enter amount to withdraw, or 'all':"
+    send_message(context.bot, user_id, text)
 
     # Update next stage: Get withdrawal amount
     set_user_current_stage(user_id, Command.WITHDRAW, 3)
 
 
-async def handle_withdraw_amount(data: str, user: dict, context):
-    amount_str = data
-    amount = float(amount_str)
-    user_id = user["id"]
-
-    current_withdraw_info = withdrawal[user_id]
-    withdrawal[user_id] = {**current_withdraw_info, "withdraw_amount": amount}
-    current_withdraw_info = withdrawal[user_id]
-    amount = current_withdraw_info["withdraw_amount"]
-    withdraw_wallet_address = current_withdraw_info["withdraw_wallet_address"]
-    token_address = current_withdraw_info["withdraw_token_address"]
+@timed_handler
+async def handle_withdraw_amount(update: Update, session: Session, data: str, context):
+    user = session.user
+    user_id = user.id
+    draft = session.withdraw
+    withdraw_wallet_address = draft.wallet_address
+    token_address = draft.token_address
 
-    oneinch = OneInchAPI()
-    token_info = oneinch.get_token_info(user["chain_id"], token_address)
+    try:
+        token_info = await asyncio.to_thread(
+            get_token_info, user.chain_id, token_address
+        )
+    except OneInchAPIError as e:
+        logger.warning("Failed to get token info", extra={"error": str(e)})
+        text = "Unable to get the token's details right now, please enter the amount again later:"
+        send_message(context.bot, user_id, text)
+        return
     token_name = token_info["symbol"]
-    text = f"Performing withdrawal of {amount}{token_name} to {withdraw_wallet_address}"
-    await context.bot.send_message(chat_id=user_id, text=text)
 
-    chain_id = user["chain_id"]
+    # Parsed straight into the token's smallest unit, so the amount sent is exactly the amount entered
+    if data.strip().lower() == "all":
+        amount = 0
+        amount_text = "all of your "
+    else:
+        try:
+            amount = parse_amount(data, token_info["decimals"])
+        except ValueError:
+            text = "Invalid amount, please enter a number, or 'all':"
+            send_message(context.bot, user_id, text)
+            return
+        amount_text = f"{format_amount(amount, token_info['decimals'])} "
+
+    chain_id = user.chain_id
     rpc = networks.get(chain_id).get("rpc")
-    derivation_path = user["derivation_path"]
+    derivation_path = user.derivation_path
     wallet_details = get_wallet_details(derivation_path)
-    success = withdraw_tokens(
+    if amount:
+        # Checked before sending, so the user can enter a smaller amount rather than start over
+        balance = await asyncio.to_thread(
+            get_token_balance, rpc, token_address, wallet_details["address"]
+        )
+        if amount > balance:
+            balance_text = format_amount(balance, token_info["decimals"])
+            text = f"Withdrawal amount exceeds your balance of {balance_text} {token_name}, please enter a smaller amount:"
+            send_message(context.bot, user_id, text)
+            return
+    draft.amount = amount
+
+    text = f"Performing withdrawal of {amount_text}{token_name} to {withdraw_wallet_address}"
+    send_message(context.bot, user_id, text)
+
+    private_key = await asyncio.to_thread(get_private_key, derivation_path)
+    # Waits up to a minute for the receipt, so off the event loop
+    tx_hash, tx_receipt = await asyncio.to_thread(
+        withdraw_tokens,
         rpc,
-        chain_id,
         token_address,
         withdraw_wallet_address,
-        wallet_details["private_key"],
+        private_key,
+        amount,
     )
+    # Sent or not, gas was likely spent
+    unset_cached_balances(chain_id, wallet_details["address"])
+    if tx_hash is not None:
+        if tx_receipt and tx_receipt.status:
+            # The whole balance if the user entered 'all'
+            amount = transferred_amount(
+                tx_receipt, token_address, from_address=wallet_details["address"]
+            )
+        record_in_background(
+            user_id,
+            chain_id,
+            "withdraw",
+            tx_hash,
+            tx_receipt,
+            token_address,
+            amount,
+            to_address=withdraw_wallet_address,
+        )
 
-    if not success:
+    if not (tx_receipt and tx_receipt.status):
         text = "Failed to withdraw funds"
     else:
         text = "Success!"
-    await context.bot.send_message(chat_id=user_id, text=text)
+    send_message(context.bot, user_id, text)
+
+    # Finished withdrawal, dropping the draft
+    unset_user_current_stage(user_id)
+
+    await show_main_menu(user, context)
+
+
+@timed_handler
+async def handle_withdraw_all(withdraw_wallet_address: str, user: User, context):
+    """Send every token and the native token left after gas, then report once for all of them"""
+    user_id = user.id
+    chain_id = user.chain_id
+    wallet_details = get_wallet_details(user.derivation_path)
+
+    try:
+        balances = await asyncio.to_thread(
+            OneInchAPI().get_token_balance, chain_id, wallet_details["address"]
+        )
+    except OneInchAPIError as e:
+        logger.warning("Failed to get balances", extra={"error": str(e)})
+        text = "Unable to get your balances right now, please try again later."
+        send_message(context.bot, user_id, text)
+        return
+    token_balances = {
+        token_address: int(amount)
+        for token_address, amount in balances.items()
+        if amount != "0"
+    }
+
+    text = f"Withdrawing all of your tokens to {withdraw_wallet_address}"
+    send_message(context.bot, user_id, text)
 
-    # Finished withdrawal
-    del withdrawal[user_id]
+    private_key = await asyncio.to_thread(get_private_key, user.derivation_path)
+    results = await asyncio.to_thread(
+        sweep_wallet,
+        networks[chain_id]["rpc"],
+        token_balances,
+        withdraw_wallet_address,
+        private_key,
+    )
+    unset_cached_balances(chain_id, wallet_details["address"])
+    for result in results:
+        if result["tx_hash"]:
+            record_in_background(
+                user_id,
+                chain_id,
+                "withdraw",
+                result["tx_hash"],
+                result["receipt"],
+                result["token_address"],
+                result["amount"],
+                to_address=withdraw_wallet_address,
+            )
+
+    async def describe(result: dict) -> str:
+        try:
+            token_info = await asyncio.to_thread(
+                get_token_info, chain_id, result["token_address"]
+            )
+            amount = parse_decimal(result["amount"], token_info["decimals"])
+            token = f"{amount:.6g} {token_info['symbol']}"
+        except OneInchAPIError:
+            token = result["token_address"]
+        if result["success"]:
+            return f"Sent {token}"
+        if result["tx_hash"]:
+            return f"Failed: {token} ({result['tx_hash']})"
+        return f"Not sent: {token}"
+
+    lines = await asyncio.gather(*(describe(result) for result in results))
+    text = "\n".join(lines) if lines else "Nothing to withdraw."
+    send_message(context.bot, user_id, text)
+
+    # Finished withdrawal, dropping the draft
     unset_user_current_stage(user_id)
 
     await show_main_menu(user, context)
 
 
 #### SET CHAIN ####
-async def handle_set_chain(query, context):
+@timed_handler
+async def handle_set_chain(update: Update, session: Session, data: str, context):
     """
     Set Chain command: Get Chain ID
     """
     # Get chain ID from user input
-    user = query.from_user
-    user_id = user.id
+    user_id = session.user.id
     text = "Enter chain ID:"
-    await context.bot.send_message(chat_id=user_id, text=text)
+    send_message(context.bot, user_id, text)
     set_user_current_stage(user_id, Command.SET_CHAIN, 1)
 
 
-async def set_chain(update: Update, user_id: int, text: str, context):
+@timed_handler
+async def set_chain(update: Update, session: Session, text: str, context):
+    user_id = session.user.id
     chain_id = text
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE users SET chain_id=%s, token0_address=NULL, token1_address=NULL, token0_name=NULL, token1_name=NULL WHERE id=%s",
-        (chain_id, user_id),
-    )
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with timer(
+        upstream_seconds, upstream_errors, upstream="mysql", operation="set_chain"
+    ):
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE users SET chain_id=%s, token0_address=NULL, token1_address=NULL, token0_name=NULL, token1_name=NULL WHERE id=%s",
+            (chain_id, user_id),
+        )
+        conn.commit()
+        cursor.close()
+        conn.close()
 
     # Get chain name if known
     chain_info = networks.get(int(chain_id))
     chain_name = chain_info["name"] if chain_info else chain_id
 
-    user = get_user(user_id)
-    assert user is not None
+    # The session mirrors the row, so it is updated in place rather than read back
+    user = session.user
+    user.chain_id = int(chain_id)
+    user.token0_address = user.token0_name = None
+    user.token1_address = user.token1_name = None
     text = f"Your chain has been updated to {chain_name}!\nYour token addresses have been reset.\n\nWhat else would you like to do?"
-    await context.bot.send_message(chat_id=user_id, text=text)
+    send_message(context.bot, user_id, text)
 
     unset_user_current_stage(user_id)
     await show_main_menu(user, context)
 
 
 #### Set slippage ####
-async def handle_set_slippage(query, context):
+@timed_handler
+async def handle_set_slippage(update: Update, session: Session, data: str, context):
     """
     Set Chain command: Get slippage percentage
     """
     # Get current slippage
-    user = query.from_user
+    user = session.user
     user_id = user.id
-    user = get_user(user_id)
-    assert user is not None
-    current_slippage = user.get("slippage")
+    current_slippage = user.slippage
     text = f"Your current slippage is {current_slippage}%. Enter your new value(%):"
-    await context.bot.send_message(chat_id=user_id, text=text)
+    send_message(context.bot, user_id, text)
     set_user_current_stage(user_id, Command.SET_SLIPPAGE, 1)
 
 
-async def set_slippage(update: Update, user_id: int, text: str, context):
+@timed_handler
+async def set_slippage(update: Update, session: Session, text: str, context):
+    user_id = session.user.id
     slippage = float(text)
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET slippage=%s WHERE id=%s", (slippage, user_id))
-    conn.commit()
-    cursor.close()
-    conn.close()
-
-    user = get_user(user_id)
-    assert user is not None
+    with timer(
+        upstream_seconds, upstream_errors, upstream="mysql", operation="set_slippage"
+    ):
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("UPDATE users SET slippage=%s WHERE id=%s", (slippage, user_id))
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+    user = session.user
+    user.slippage = slippage
     text = f"Your slippage has been updated to {slippage}%!"
-    await context.bot.send_message(chat_id=user_id, text=text)
+    send_message(context.bot, user_id, text)
 
     unset_user_current_stage(user_id)
     await show_main_menu(user, context)
 
 
-async def handle_set_token0(query, context):
+@timed_handler
+async def handle_set_token0(update: Update, session: Session, data: str, context):
     """Handle set token 0 command"""
-    user_id = query.from_user.id
-    text = "Paste token0 address (click here to /cancel):"
-    await context.bot.send_message(chat_id=user_id, text=text)
+    user_id = session.user.id
+    text = "Enter token0 symbol or paste its address (click here to /cancel):"
+    send_message(context.bot, user_id, text)
     set_user_current_stage(user_id, Command.SET_TOKEN0, 1)
 
 
-async def set_token0(update: Update, user_id: int, text: str, context):
-    # Get user
-    user = get_user(user_id)
-    assert user is not None
+@timed_handler
+async def set_token0(update: Update, session: Session, text: str, context):
+    user = session.user
+    user_id = user.id
+
+    # Anything but an address is a symbol to look up
+    token_address = text.strip()
+    if not ADDRESS_PATTERN.match(token_address):
+        await reply_token_search(user_id, user.chain_id, token_address, context)
+        return
 
     # Disallow setting same as token 1
-    token_address = text
-    token1_address: str | None = user.get("token1_address")
+    token1_address: str | None = user.token1_address
     if token1_address and token_address.lower() == token1_address.lower():
         text = f"Cannot be the same address as your sell token. Please enter another address."
-        await context.bot.send_message(chat_id=user_id, text=text)
+        send_message(context.bot, user_id, text)
         return
 
-    chain_id = user["chain_id"]
-    oneinch = OneInchAPI()
-    token_info = oneinch.get_token_info(chain_id, token_address)
+    chain_id = user.chain_id
+    try:
+        token_info = await asyncio.to_thread(get_token_info, chain_id, token_address)
+    except OneInchAPIError as e:
+        logger.warning("Failed to look up token", extra={"error": str(e)})
+        if is_unavailable_error(e):
+            text = "Unable to look up the token right now, please try again later."
+            send_message(context.bot, user_id, text)
+            return
+        # 1inch rejects addresses that are not tokens
+        token_info = {}
     token_name = token_info.get("symbol")
     if not token_name:
         text = f"Invalid token address. Please enter another address."
-        await context.bot.send_message(chat_id=user_id, text=text)
+        send_message(context.bot, user_id, text)
         return
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE users SET token0_address=%s, token0_name=%s WHERE id=%s",
-        (token_address.lower(), token_name, user_id),
-    )
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with timer(
+        upstream_seconds, upstream_errors, upstream="mysql", operation="set_token0"
+    ):
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE users SET token0_address=%s, token0_name=%s WHERE id=%s",
+            (token_address.lower(), token_name, user_id),
+        )
+        conn.commit()
+        cursor.close()
+        conn.close()
 
-    user = get_user(user_id)
-    assert user is not None
+    user.token0_address = token_address.lower()
+    user.token0_name = token_name
     text = "Updated!"
-    await context.bot.send_message(chat_id=user_id, text=text)
+    send_message(context.bot, user_id, text)
 
     await show_main_menu(user, context=context)
 
     unset_user_current_stage(user_id)
 
 
-async def handle_set_token1(query, context):
+@timed_handler
+async def handle_set_token1(update: Update, session: Session, data: str, context):
     """Handle set sell token command"""
     # TODO: Hide the button by default if chain not set
-    user_id = query.from_user.id
-    text = "Paste token1 address (click here to /cancel):"
-    await context.bot.send_message(chat_id=user_id, text=text)
+    user_id = session.user.id
+    text = "Enter token1 symbol or paste its address (click here to /cancel):"
+    send_message(context.bot, user_id, text)
     set_user_current_stage(user_id, Command.SET_TOKEN1, 1)
 
 
-async def set_token1(update: Update, user_id: int, text: str, context):
-    # Get user
-    user = get_user(user_id)
-    assert user is not None
+@timed_handler
+async def set_token1(update: Update, session: Session, text: str, context):
+    user = session.user
+    user_id = user.id
+
+    # Anything but an address is a symbol to look up
+    token_address = text.strip()
+    if not ADDRESS_PATTERN.match(token_address):
+        await reply_token_search(user_id, user.chain_id, token_address, context)
+        return
 
     # Disallow setting same as token 0
-    token_address = text
-    token0_address: str | None = user.get("token0_address")
+    token0_address: str | None = user.token0_address
     if token0_address and token_address.lower() == token0_address.lower():
         text = (
             f"Cannot be the same address as your token 0. Please enter another address."
         )
-        await context.bot.send_message(chat_id=user_id, text=text)
+        send_message(context.bot, user_id, text)
         return
 
-    chain_id = user["chain_id"]
-    oneinch = OneInchAPI()
-    token_info = oneinch.get_token_info(chain_id, token_address)
+    chain_id = user.chain_id
+    try:
+        token_info = await asyncio.to_thread(get_token_info, chain_id, token_address)
+    except OneInchAPIError as e:
+        logger.warning("Failed to look up token", extra={"error": str(e)})
+        if is_unavailable_error(e):
+            text = "Unable to look up the token right now, please try again later."
+            send_message(context.bot, user_id, text)
+            return
+        # 1inch rejects addresses that are not tokens
+        token_info = {}
     token_name = token_info.get("symbol")
     if not token_name:
         text = f"Invalid token address. Please enter another address."
-        await context.bot.send_message(chat_id=user_id, text=text)
+        send_message(context.bot, user_id, text)
         return
 
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE users SET token1_address=%s, token1_name=%s WHERE id=%s",
-        (token_address.lower(), token_name, user_id),
-    )
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with timer(
+        upstream_seconds, upstream_errors, upstream="mysql", operation="set_token1"
+    ):
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE users SET token1_address=%s, token1_name=%s WHERE id=%s",
+            (token_address.lower(), token_name, user_id),
+        )
+        conn.commit()
+        cursor.close()
+        conn.close()
 
-    user = get_user(user_id)
-    assert user is not None
+    user.token1_address = token_address.lower()
+    user.token1_name = token_name
     text = "Updated!"
-    await context.bot.send_message(chat_id=user_id, text=text)
+    send_message(context.bot, user_id, text)
 
     await show_main_menu(user, context=context)
 
     unset_user_current_stage(user_id)
 
 
-async def handle_refresh(query, context):
-    user_id = query.from_user.id
-    user = get_user(user_id)
-    assert user is not None
-    await show_main_menu(user, context)
+@timed_handler
+async def handle_refresh(update: Update, session: Session, data: str, context):
+    await show_main_menu(session.user, context)
 
 
-async def handle_buy(query, context):
-    user_id = query.from_user.id
-    user = get_user(user_id)
-    assert user is not None
+@timed_handler
+async def handle_portfolio(update: Update, session: Session, data: str, context):
+    """Balances on every chain in one view, whichever chain the user has selected"""
+    user = session.user
+    user_id = user.id
+    send_message(context.bot, user_id, "Loading, please wait...", transient=True)
 
-    token0_name = user["token0_name"]
-    token1_name = user["token1_name"]
+    wallet_address = get_wallet_details(user.derivation_path)["address"]
+    portfolios = await get_portfolio(wallet_address)
 
-    # Present 4 options - 25%, 50%, 75%, 100%
-    buttons: list[list[InlineKeyboardButton]] = []
+    text = f"Wallet Address: `{wallet_address}` (tap to copy)\n"
+    for portfolio in portfolios:
+        text += f"\n*{networks[portfolio['chain_id']]['name']}*"
+        text += portfolio_text(portfolio) + "\n"
 
-    buttons.append(
-        [
-            InlineKeyboardButton("25%", callback_data="25"),
-            InlineKeyboardButton("50%", callback_data="50"),
-        ]
+    total = sum(portfolio["usd_total"] for portfolio in portfolios)
+    text += f"\nTotal Balance, all chains (USD): {total}"
+    if any(
+        portfolio["usd_incomplete"] or not portfolio["balances_available"]
+        for portfolio in portfolios
+    ):
+        text += " (incomplete)"
+    elif any(portfolio["usd_stale"] for portfolio in portfolios):
+        text += " (using last known prices)"
+
+    send_message(
+        context.bot,
+        chat_id=user_id,
+        text=text,
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=main_menu_keyboard(user),
     )
 
-    buttons.append(
+
+#### Price alerts ####
+@timed_handler
+async def handle_alerts(update: Update, session: Session, data: str, context):
+    """Show the current token0 price and the user's alerts, and ask for a new alert price"""
+    user = session.user
+    user_id = user.id
+    chain_id = user.chain_id
+    token0_name = user.token0_name
+    token1_name = user.token1_name
+
+    try:
+        price = await get_pair_price(chain_id, user.token0_address, user.token1_address)
+    except OneInchAPIError as e:
+        logger.warning("Failed to get price for alerts", extra={"error": str(e)})
+        text = "Unable to get the price right now, please try again later."
+        send_message(context.bot, user_id, text)
+        return
+
+    alerts = await asyncio.to_thread(get_active_alerts, user_id)
+    buttons = [
         [
-            InlineKeyboardButton("75%", callback_data="75"),
-            InlineKeyboardButton("100%", callback_data="100"),
+            InlineKeyboardButton(
+                f"Delete: {alert['token0_name']} {'>=' if alert['above'] else '<='} "
+                f"{alert['threshold']:.6g} {alert['token1_name']}",
+                callback_data=str(alert["id"]),
+            )
         ]
+        for alert in alerts
+    ]
+
+    text = f"1 {token0_name} = {price:.6g} {token1_name}\n\n"
+    text += f"Enter a price in {token1_name} to be alerted when {token0_name} reaches it (click here to /cancel):"
+    send_message(
+        context.bot,
+        chat_id=user_id,
+        text=text,
+        reply_markup=InlineKeyboardMarkup(buttons) if buttons else None,
     )
+    set_user_current_stage(user_id, Command.ALERTS, 1)
 
-    markup = InlineKeyboardMarkup(buttons)
 
-    text = (
-        f"How much {token1_name} to convert to {token0_name}? (click here to /cancel)"
-    )
-    await context.bot.send_message(chat_id=user_id, text=text, reply_markup=markup)
+@timed_handler
+async def add_price_alert(update: Update, session: Session, text: str, context):
+    user = session.user
+    user_id = user.id
 
-    # Set to stage 1: Get amount
-    set_user_current_stage(user_id, Command.BUY, 1)
+    try:
+        threshold = float(text)
+        assert threshold > 0
+    except (ValueError, AssertionError):
+        text = "Please enter a valid price, e.g. 2500"
+        send_message(context.bot, user_id, text)
+        return
 
+    chain_id = user.chain_id
+    try:
+        price = await get_pair_price(
+            chain_id,
+            user.token0_address,
+            user.token1_address,
+            max_age=ALERT_CHECK_INTERVAL,
+        )
+    except OneInchAPIError as e:
+        logger.warning("Failed to get price for alerts", extra={"error": str(e)})
+        text = "Unable to get the price right now, please try again later."
+        send_message(context.bot, user_id, text)
+        return
 
-async def handle_buy_amount(data: str, user: dict, context):
-    user_id = user["id"]
-    text = "Processing..."
-    await context.bot.send_message(chat_id=user_id, text=text)
+    # Alert on crossing the threshold from wherever the price is now
+    above = threshold > price
+    alert_id = await asyncio.to_thread(
+        add_alert,
+        user_id,
+        chain_id,
+        user.token0_address,
+        user.token0_name,
+        user.token1_address,
+        user.token1_name,
+        threshold,
+        above,
+    )
+    index_alert(
+        {
+            "id": alert_id,
+            "user_id": user_id,
+            "chain_id": chain_id,
+            "token0_address": user.token0_address,
+            "token0_name": user.token0_name,
+            "token1_address": user.token1_address,
+            "token1_name": user.token1_name,
+            "threshold": threshold,
+            "above": above,
+        }
+    )
 
-    token1_percentage = int(data)
-    chain_id = user["chain_id"]
-    token0_address = user["token0_address"]
-    token0_name = user["token0_name"]
-    token1_address = user["token1_address"]
-    token1_name = user["token1_name"]
+    direction = "rises to" if above else "falls to"
+    text = f"Alert set! You will be notified when {user.token0_name} {direction} {threshold:.6g} {user.token1_name}."
+    send_message(context.bot, user_id, text)
+    unset_user_current_stage(user_id)
+    await show_main_menu(user, context)
 
-    # Get a quote for how much token1 is required to buy token0
-    oneinch = OneInchAPI()
-    token1_info = oneinch.get_token_info(chain_id, token1_address)
-    token1_decimals = token1_info["decimals"]
-    token0_info = oneinch.get_token_info(chain_id, token0_address)
-    token0_decimals = token0_info["decimals"]
 
-    derivation_path = user["derivation_path"]
-    wallet_details = get_wallet_details(derivation_path)
-    wallet_address = wallet_details["address"]
-    slippage = 1  # 1 because we don't understand the min 1 max 50 in Swagger docs
-
-    # Check balance
-    balances = oneinch.get_token_balance(chain_id, wallet_address, [token1_address])
-    assert isinstance(balances, dict)
-    token_address, balance = list(balances.items())[0]
-    token1_balance = parse_decimal(balance, token1_decimals)
-    if token1_balance == 0:
-        amount_to_convert = 0
-    elif token1_percentage == 100:
-        amount_to_convert = token1_balance
+@timed_handler
+async def handle_delete_alert(update: Update, session: Session, data: str, context):
+    user_id = session.user.id
+    alert_id = int(data)
+    if await asyncio.to_thread(delete_alert, user_id, alert_id):
+        alert_index.remove(alert_id)
+        text = "Alert deleted."
     else:
-        amount_to_convert = token1_balance / 100 * token1_percentage
+        text = "Alert not found, it may have already been triggered."
+    send_message(context.bot, user_id, text)
+    unset_user_current_stage(user_id)
 
-    if amount_to_convert == 0:
-        text = "Not enough funds."
-        await context.bot.send_message(chat_id=user_id, text=text)
-    else:
-        # Proceed with the transaction
-        rpc = networks[chain_id]["rpc"]
-        private_key = wallet_details["private_key"].hex()
 
-        amount_to_convert_str = format_decimal(amount_to_convert, token1_decimals)
-        transaction = oneinch.approve_swap_calldata(
-            chain_id, token1_address, amount_to_convert_str
-        )
-        success = execute_transaction(rpc, transaction, private_key)
-        if success:
-            transaction = oneinch.perform_swap_calldata(
-                chain_id,
-                token1_address,
-                token0_address,
-                amount_to_convert_str,
-                wallet_address,
-                slippage,
+#### Limit/stop orders ####
+@timed_handler
+async def handle_orders(update: Update, session: Session, data: str, context):
+    """Show the user's open orders and ask for a new one"""
+    user = session.user
+    user_id = user.id
+    token0_name = user.token0_name
+    token1_name = user.token1_name
+
+    orders = await asyncio.to_thread(get_orders, "open", user_id)
+    buttons = [
+        [
+            InlineKeyboardButton(
+                f"Cancel: {describe_order(order)}", callback_data=str(order["id"])
             )
-            success = execute_transaction(rpc, transaction["tx"], private_key)
-            if success:
-                text = "Success!"
-                await context.bot.send_message(chat_id=user_id, text=text)
-                unset_user_current_stage(user_id)
-                await show_main_menu(user, context)
-                return
+        ]
+        for order in orders
+    ]
+
+    text = ""
+    try:
+        price = await get_pair_price(
+            user.chain_id,
+            user.token0_address,
+            user.token1_address,
+            max_age=ORDER_CHECK_INTERVAL,
+        )
+        text += f"1 {token0_name} = {price:.6g} {token1_name}\n\n"
+    except OneInchAPIError as e:
+        logger.warning("Failed to get price for orders", extra={"error": str(e)})
+    text += (
+        f"Enter an order as: buy|sell limit|stop <price in {token1_name}> <{'|'.join(map(str, PRESET_PERCENTAGES))}>\n"
+        f"e.g. 'buy limit 2400 50' buys {token0_name} with 50% of your {token1_name} once {token0_name} falls to 2400.\n"
+        "(click here to /cancel)"
+    )
+    send_message(
+        context.bot,
+        chat_id=user_id,
+        text=text,
+        reply_markup=InlineKeyboardMarkup(buttons) if buttons else None,
+    )
+    set_user_current_stage(user_id, Command.ORDERS, 1)
+
+
+@timed_handler
+async def place_order(update: Update, session: Session, text: str, context):
+    user = session.user
+    user_id = user.id
+
+    try:
+        side, order_type, trigger_price, percentage = text.lower().split()
+        trigger_price = float(trigger_price)
+        percentage = int(percentage)
+        assert side in ("buy", "sell")
+        assert order_type in ("limit", "stop")
+        assert trigger_price > 0
+        assert percentage in PRESET_PERCENTAGES
+    except (ValueError, AssertionError):
+        text = "Invalid order, please enter it as e.g. 'buy limit 2400 50'"
+        send_message(context.bot, user_id, text)
+        return
+
+    order_id = await asyncio.to_thread(
+        add_order,
+        user_id,
+        user.chain_id,
+        side,
+        order_type,
+        user.token0_address,
+        user.token0_name,
+        user.token1_address,
+        user.token1_name,
+        trigger_price,
+        percentage,
+    )
+    order = {
+        "id": order_id,
+        "user_id": user_id,
+        "chain_id": user.chain_id,
+        "side": side,
+        "order_type": order_type,
+        "token0_address": user.token0_address.lower(),
+        "token0_name": user.token0_name,
+        "token1_address": user.token1_address.lower(),
+        "token1_name": user.token1_name,
+        "trigger_price": trigger_price,
+        "percentage": percentage,
+        "status": "open",
+        "tx_hash": None,
+    }
+    index_order(order)
 
-    fail_text = "Transaction Failed."
-    await context.bot.send_message(chat_id=user_id, text=fail_text)
+    text = f"Order placed: {describe_order(order)}"
+    send_message(context.bot, user_id, text)
     unset_user_current_stage(user_id)
     await show_main_menu(user, context)
 
 
-async def handle_sell(query, context):
-    user_id = query.from_user.id
-    user = get_user(user_id)
-    assert user is not None
+@timed_handler
+async def handle_cancel_order(update: Update, session: Session, data: str, context):
+    user_id = session.user.id
+    order_id = int(data)
+    if await asyncio.to_thread(cancel_order, user_id, order_id):
+        order_book.remove(order_id)
+        text = "Order cancelled."
+    else:
+        text = "Order not found, it may have already been executed."
+    send_message(context.bot, user_id, text)
+    unset_user_current_stage(user_id)
 
-    token0_name = user["token0_name"]
-    token1_name = user["token1_name"]
 
-    # Present 4 options - 25%, 50%, 75%, 100%
-    buttons: list[list[InlineKeyboardButton]] = []
+#### Recurring buys (DCA) ####
+@timed_handler
+async def handle_dca(update: Update, session: Session, data: str, context):
+    """Show the user's recurring buys and ask for a new one"""
+    user = session.user
+    user_id = user.id
+    token0_name = user.token0_name
+    token1_name = user.token1_name
 
-    buttons.append(
+    plans = await asyncio.to_thread(get_user_dca_plans, user_id)
+    buttons = [
         [
-            InlineKeyboardButton("25%", callback_data="25"),
-            InlineKeyboardButton("50%", callback_data="50"),
+            InlineKeyboardButton(
+                f"Cancel: {describe_plan(plan)}", callback_data=str(plan["id"])
+            )
         ]
+        for plan in plans
+    ]
+
+    text = (
+        f"Enter a recurring buy as: <amount of {token1_name}> <every N hours>\n"
+        f"e.g. '100 24' buys {token0_name} with 100 {token1_name} every 24 hours, starting now.\n"
+        "(click here to /cancel)"
     )
+    send_message(
+        context.bot,
+        chat_id=user_id,
+        text=text,
+        reply_markup=InlineKeyboardMarkup(buttons) if buttons else None,
+    )
+    set_user_current_stage(user_id, Command.DCA, 1)
 
-    buttons.append(
-        [
-            InlineKeyboardButton("75%", callback_data="75"),
-            InlineKeyboardButton("100%", callback_data="100"),
-        ]
+
+@timed_handler
+async def add_recurring_buy(update: Update, session: Session, text: str, context):
+    user = session.user
+    user_id = user.id
+
+    try:
+        amount_text, interval_hours = text.split()
+        interval_hours = int(interval_hours)
+        assert interval_hours > 0
+    except (ValueError, AssertionError):
+        text = "Invalid recurring buy, please enter it as e.g. '100 24'"
+        send_message(context.bot, user_id, text)
+        return
+
+    try:
+        token1_info = await asyncio.to_thread(
+            get_token_info, user.chain_id, user.token1_address
+        )
+    except OneInchAPIError as e:
+        logger.warning("Failed to get token info", extra={"error": str(e)})
+        text = "Unable to set up the recurring buy right now, please try again later."
+        send_message(context.bot, user_id, text)
+        return
+    try:
+        amount = parse_amount(amount_text, token1_info["decimals"])
+    except ValueError:
+        text = "Invalid recurring buy, please enter it as e.g. '100 24'"
+        send_message(context.bot, user_id, text)
+        return
+
+    plan = {
+        "user_id": user_id,
+        "chain_id": user.chain_id,
+        "token0_address": user.token0_address,
+        "token0_name": user.token0_name,
+        "token1_address": user.token1_address,
+        "token1_name": user.token1_name,
+        "token1_decimals": token1_info["decimals"],
+        "amount": amount,
+        "interval_hours": interval_hours,
+        # First buy in the next scheduling window
+        "next_run_at": utcnow(),
+    }
+    await asyncio.to_thread(add_dca_plan, **plan)
+
+    text = f"Recurring buy set up: {describe_plan(plan)}"
+    send_message(context.bot, user_id, text)
+    unset_user_current_stage(user_id)
+    await show_main_menu(user, context)
+
+
+@timed_handler
+async def handle_cancel_dca(update: Update, session: Session, data: str, context):
+    user_id = session.user.id
+    if await asyncio.to_thread(cancel_dca_plan, user_id, int(data)):
+        text = "Recurring buy cancelled."
+    else:
+        text = "Recurring buy not found."
+    send_message(context.bot, user_id, text)
+    unset_user_current_stage(user_id)
+
+
+#### Transaction history ####
+async def show_history_page(
+    user_id: int, context, before: tuple[datetime, int] | None = None
+):
+    """A page of the user's ledger, with a button for the one before it if there is one"""
+    # One more than the page, to tell whether there is another
+    entries = await asyncio.to_thread(get_ledger_page, user_id, PAGE_SIZE + 1, before)
+    page = entries[:PAGE_SIZE]
+    if not page:
+        text = "No transactions yet." if before is None else "No older transactions."
+        send_message(context.bot, user_id, text)
+        unset_user_current_stage(user_id)
+        return
+
+    text = "\n".join(await describe_entries(page))
+    buttons = []
+    if len(entries) > PAGE_SIZE:
+        buttons.append(
+            [InlineKeyboardButton("Older", callback_data=encode_cursor(page[-1]))]
+        )
+    send_message(
+        context.bot,
+        chat_id=user_id,
+        text=text,
+        reply_markup=InlineKeyboardMarkup(buttons) if buttons else None,
     )
+    set_user_current_stage(user_id, Command.HISTORY, 1)
+
+
+@timed_handler
+async def handle_history(update: Update, session: Session, data: str, context):
+    """Show the user's realized PnL and their latest transactions"""
+    user_id = session.user.id
+    positions = await asyncio.to_thread(get_pnl_positions, user_id)
+    if positions:
+        send_message(context.bot, user_id, await describe_pnl(positions))
+    await show_history_page(user_id, context)
 
-    markup = InlineKeyboardMarkup(buttons)
+
+@timed_handler
+async def handle_history_page(update: Update, session: Session, data: str, context):
+    await show_history_page(session.user.id, context, decode_cursor(data))
+
+
+@timed_handler
+async def handle_buy(update: Update, session: Session, data: str, context):
+    user = session.user
+    user_id = user.id
+
+    token0_name = user.token0_name
+    token1_name = user.token1_name
+
+    # Present 4 options - 25%, 50%, 75%, 100%, each showing what it would return
+    wallet = get_wallet_details(user.derivation_path)
+    try:
+        preset_quotes = await get_preset_quotes(
+            user_id,
+            user.chain_id,
+            wallet["address"],
+            user.token1_address,
+            user.token0_address,
+        )
+    except OneInchAPIError as e:
+        logger.warning("Failed to get preset quotes", extra={"error": str(e)})
+        text = "Unable to get quotes right now, please try again later."
+        send_message(context.bot, user_id, text)
+        return
+    markup = preset_amount_keyboard(preset_quotes, token0_name)
 
     text = (
-        f"How much {token0_name} to convert to {token1_name}? (click here to /cancel)"
+        f"How much {token1_name} to convert to {token0_name}? (click here to /cancel)"
     )
-    await context.bot.send_message(chat_id=user_id, text=text, reply_markup=markup)
+    send_message(context.bot, chat_id=user_id, text=text, reply_markup=markup)
 
-    # Set to stage 1: Get amount
-    set_user_current_stage(user_id, Command.SELL, 1)
+    # Set to stage 1: Get amount, swapping the tokens the presets were quoted for
+    set_user_current_stage(user_id, Command.BUY, 1)
+    session.swap = SwapDraft(user.token1_address, user.token0_address)
+
+    # Prefetch the approval while the user decides
+    if preset_quotes["balance"]:
+        context.application.create_task(
+            prefetch_approve_calldata(
+                user_id,
+                user.chain_id,
+                networks[user.chain_id]["rpc"],
+                user.token1_address,
+                preset_quotes["balance"],
+            )
+        )
 
 
-async def handle_sell_amount(data: str, user: dict, context):
-    user_id = user["id"]
+@timed_handler
+async def handle_swap_amount(
+    data: str, user: User, src_token_address: str, dst_token_address: str, context
+):
+    """Swap the selected percentage of src token into dst token (shared by buy and sell)"""
+    user_id = user.id
+    percentage = int(data)
+
+    # Updates are handled one at a time (the Application has no concurrent_updates), so a double tap is
+    # only read once this swap has finished and reset the stage. This guard and execute_swap's coalescing
+    # only come into play with concurrent updates, e.g. the bench's --concurrent-updates.
+    if is_swap_in_flight(user):
+        return
+
     text = "Processing..."
-    await context.bot.send_message(chat_id=user_id, text=text)
+    send_message(context.bot, user_id, text, transient=True)
+
+    result = await execute_swap(user, src_token_address, dst_token_address, percentage)
+    if result["coalesced"]:
+        return
 
-    token0_percentage = int(data)
-    chain_id = user["chain_id"]
-    token0_address = user["token0_address"]
-    token0_name = user["token0_name"]
-    token1_address = user["token1_address"]
-    token1_name = user["token1_name"]
+    text = "Success!" if result["success"] else result["error"]
+    send_message(context.bot, user_id, text)
+    unset_user_current_stage(user_id)
+    await show_main_menu(user, context)
 
-    # Get a quote for how much token1 is required to buy token0
-    oneinch = OneInchAPI()
-    token1_info = oneinch.get_token_info(chain_id, token1_address)
-    token1_decimals = token1_info["decimals"]
-    token0_info = oneinch.get_token_info(chain_id, token0_address)
-    token0_decimals = token0_info["decimals"]
 
-    derivation_path = user["derivation_path"]
-    wallet_details = get_wallet_details(derivation_path)
-    wallet_address = wallet_details["address"]
-    slippage = 1  # 1 because we don't understand the min 1 max 50 in Swagger docs
-
-    # Check balance
-    balances = oneinch.get_token_balance(chain_id, wallet_address, [token0_address])
-    assert isinstance(balances, dict)
-    token_address, balance = list(balances.items())[0]
-    token0_balance = parse_decimal(balance, token0_decimals)
-    if token0_balance == 0:
-        amount_to_convert = 0
-    elif token0_percentage == 100:
-        amount_to_convert = token0_balance
-    else:
-        amount_to_convert = token0_balance / 100 * token0_percentage
+@timed_handler
+async def handle_buy_amount(update: Update, session: Session, data: str, context):
+    # Buying token0 with token1
+    swap = session.swap or SwapDraft(
+        session.user.token1_address, session.user.token0_address
+    )
+    await handle_swap_amount(
+        data, session.user, swap.src_token_address, swap.dst_token_address, context
+    )
 
-    if amount_to_convert == 0:
-        text = "Not enough funds."
-        await context.bot.send_message(chat_id=user_id, text=text)
-    else:
-        # Proceed with the transaction
-        rpc = networks[chain_id]["rpc"]
-        private_key = wallet_details["private_key"].hex()
 
-        amount_to_convert_str = format_decimal(amount_to_convert, token0_decimals)
-        transaction = oneinch.approve_swap_calldata(
-            chain_id, token0_address, amount_to_convert_str
+@timed_handler
+async def handle_sell(update: Update, session: Session, data: str, context):
+    user = session.user
+    user_id = user.id
+
+    token0_name = user.token0_name
+    token1_name = user.token1_name
+
+    # Present 4 options - 25%, 50%, 75%, 100%, each showing what it would return
+    wallet = get_wallet_details(user.derivation_path)
+    try:
+        preset_quotes = await get_preset_quotes(
+            user_id,
+            user.chain_id,
+            wallet["address"],
+            user.token0_address,
+            user.token1_address,
         )
-        success = execute_transaction(rpc, transaction, private_key)
-        if success:
-            transaction = oneinch.perform_swap_calldata(
-                chain_id,
-                token0_address,
-                token1_address,
-                amount_to_convert_str,
-                wallet_address,
-                slippage,
+    except OneInchAPIError as e:
+        logger.warning("Failed to get preset quotes", extra={"error": str(e)})
+        text = "Unable to get quotes right now, please try again later."
+        send_message(context.bot, user_id, text)
+        return
+    markup = preset_amount_keyboard(preset_quotes, token1_name)
+
+    text = (
+        f"How much {token0_name} to convert to {token1_name}? (click here to /cancel)"
+    )
+    send_message(context.bot, chat_id=user_id, text=text, reply_markup=markup)
+
+    # Set to stage 1: Get amount, swapping the tokens the presets were quoted for
+    set_user_current_stage(user_id, Command.SELL, 1)
+    session.swap = SwapDraft(user.token0_address, user.token1_address)
+
+    # Prefetch the approval while the user decides
+    if preset_quotes["balance"]:
+        context.application.create_task(
+            prefetch_approve_calldata(
+                user_id,
+                user.chain_id,
+                networks[user.chain_id]["rpc"],
+                user.token0_address,
+                preset_quotes["balance"],
             )
-            success = execute_transaction(rpc, transaction["tx"], private_key)
-            if success:
-                text = "Success!"
-                await context.bot.send_message(chat_id=user_id, text=text)
-                unset_user_current_stage(user_id)
-                await show_main_menu(user, context)
-                return
+        )
 
-    fail_text = "Transaction Failed."
-    await context.bot.send_message(chat_id=user_id, text=fail_text)
-    unset_user_current_stage(user_id)
-    await show_main_menu(user, context)
+
+@timed_handler
+async def handle_sell_amount(update: Update, session: Session, data: str, context):
+    # Selling token0 for token1
+    swap = session.swap or SwapDraft(
+        session.user.token0_address, session.user.token1_address
+    )
+    await handle_swap_amount(
+        data, session.user, swap.src_token_address, swap.dst_token_address, context
+    )
 
 
 ### Command Handlers END ###
 
-# Map command to stage 0 functions
-handlers: dict[str, Callable] = {
-    Command.WITHDRAW.value: handle_withdraw,
-    Command.SET_CHAIN.value: handle_set_chain,
-    Command.SET_SLIPPAGE.value: handle_set_slippage,
-    Command.SET_TOKEN0.value: handle_set_token0,
-    Command.SET_TOKEN1.value: handle_set_token1,
-    Command.REFRESH.value: handle_refresh,
-    Command.BUY.value: handle_buy,
-    Command.SELL.value: handle_sell,
-}
+
+@timed_handler
+async def handle_stage_expired(update: Update, session: Session, data: str, context):
+    text = "That took too long, please start again."
+    send_message(context.bot, chat_id=session.user.id, text=text)
+    await show_main_menu(session.user, context)
+
+
+# Map (command, stage, input kind) to its handler. Stage 0 is the command's main menu button.
+machine = StateMachine(
+    {
+        (Command.WITHDRAW, 0, InputKind.BUTTON): Transition(handle_withdraw),
+        # Withdraw stage 1: data is token selected
+        (Command.WITHDRAW, 1, InputKind.BUTTON): Transition(
+            handle_withdraw_selected_token, validate_withdraw_token
+        ),
+        (Command.WITHDRAW, 2, InputKind.TEXT): Transition(
+            handle_withdraw_wallet_address, validate_address
+        ),
+        (Command.WITHDRAW, 3, InputKind.TEXT): Transition(handle_withdraw_amount),
+        (Command.SET_CHAIN, 0, InputKind.BUTTON): Transition(handle_set_chain),
+        (Command.SET_CHAIN, 1, InputKind.TEXT): Transition(
+            set_chain, validate_chain_id
+        ),
+        (Command.SET_SLIPPAGE, 0, InputKind.BUTTON): Transition(handle_set_slippage),
+        (Command.SET_SLIPPAGE, 1, InputKind.TEXT): Transition(
+            set_slippage, validate_slippage
+        ),
+        (Command.SET_TOKEN0, 0, InputKind.BUTTON): Transition(handle_set_token0),
+        (Command.SET_TOKEN0, 1, InputKind.TEXT): Transition(set_token0),
+        # Set token0 stage 1: data is the address of the token picked from search results
+        (Command.SET_TOKEN0, 1, InputKind.BUTTON): Transition(set_token0),
+        (Command.SET_TOKEN1, 0, InputKind.BUTTON): Transition(handle_set_token1),
+        (Command.SET_TOKEN1, 1, InputKind.TEXT): Transition(set_token1),
+        (Command.SET_TOKEN1, 1, InputKind.BUTTON): Transition(set_token1),
+        (Command.REFRESH, 0, InputKind.BUTTON): Transition(handle_refresh),
+        (Command.PORTFOLIO, 0, InputKind.BUTTON): Transition(handle_portfolio),
+        (Command.ALERTS, 0, InputKind.BUTTON): Transition(handle_alerts),
+        (Command.ALERTS, 1, InputKind.TEXT): Transition(add_price_alert),
+        # Price alerts stage 1: data is the id of the alert to delete
+        (Command.ALERTS, 1, InputKind.BUTTON): Transition(
+            handle_delete_alert, validate_id
+        ),
+        (Command.ORDERS, 0, InputKind.BUTTON): Transition(handle_orders),
+        (Command.ORDERS, 1, InputKind.TEXT): Transition(place_order),
+        # Orders stage 1: data is the id of the order to cancel
+        (Command.ORDERS, 1, InputKind.BUTTON): Transition(
+            handle_cancel_order, validate_id
+        ),
+        (Command.DCA, 0, InputKind.BUTTON): Transition(handle_dca),
+        (Command.DCA, 1, InputKind.TEXT): Transition(add_recurring_buy),
+        # Recurring buys stage 1: data is the id of the plan to cancel
+        (Command.DCA, 1, InputKind.BUTTON): Transition(handle_cancel_dca, validate_id),
+        (Command.HISTORY, 0, InputKind.BUTTON): Transition(handle_history),
+        # History stage 1: data is the cursor of the last entry shown
+        (Command.HISTORY, 1, InputKind.BUTTON): Transition(
+            handle_history_page, validate_history_cursor
+        ),
+        (Command.BUY, 0, InputKind.BUTTON): Transition(handle_buy),
+        # Buy stage 1: user selects percentage of token1 to convert
+        (Command.BUY, 1, InputKind.BUTTON): Transition(
+            handle_buy_amount, validate_percentage
+        ),
+        (Command.SELL, 0, InputKind.BUTTON): Transition(handle_sell),
+        # Sell stage 1: user selects percentage of token0 to convert
+        (Command.SELL, 1, InputKind.BUTTON): Transition(
+            handle_sell_amount, validate_percentage
+        ),
+    },
+    on_expired=handle_stage_expired,
+)
 
 
 # Handle /start command
+@timed_handler
 async def start(update: Update, context) -> None:
     user_id = update.effective_user.id
 
     # Create user in database
-    if not get_user(user_id):
+    if load_user(user_id) is None:
         add_user(user_id)
+        new_user = True
+    else:
+        new_user = False
 
-    user = get_user(user_id)
+    user = load_user(user_id)
     assert user is not None
+    if new_user:
+        # Follow transfers to the new wallet too
+        watch_user(user_id, user.derivation_path)
 
     # Reset current prompt if it exists, as the user may use this command to cancel
     unset_user_current_stage(user_id)
@@ -746,81 +1553,159 @@ async def start(update: Update, context) -> None:
 
 
 # Callback handlers for each button
+@timed_handler
 async def button_callback(update: Update, context) -> None:
     query = update.callback_query
     await query.answer()
 
-    # If user is in nested stage
-    user_id = query.from_user.id
-    data = query.data
-    command_stage = get_user_current_stage(user_id) or {}
-    command = command_stage.get("command")
-    stage = command_stage.get("stage")
-
-    if not (command and stage):
-        # If user on main menu
-        command = query.data
-        callback = handlers.get(command)
-
-        if callback:
-            await callback(query, context=context)
-    elif command == Command.WITHDRAW and stage == 1:
-        # Withdraw stage 1: data is token selected
-        user = get_user(user_id)
-        assert user is not None
-        await handle_withdraw_selected_token(data, user, context)
-    elif command == Command.BUY and stage == 1:
-        # Buy stage 1: user selects percentage of token1 to convert
-        user = get_user(user_id)
-        assert user is not None
-        await handle_buy_amount(data, user, context)
-    elif command == Command.SELL and stage == 1:
-        # Buy stage 1: user selects percentage of token1 to convert
-        user = get_user(user_id)
-        assert user is not None
-        await handle_sell_amount(data, user, context)
+    session = get_session(query.from_user.id)
+    if session is None:
+        return
+    await machine.dispatch(update, session, InputKind.BUTTON, query.data, context)
 
 
+@timed_handler
 async def message_handler(update: Update, context) -> None:
-    user = update.effective_user
-    user_id = user.id
+    user_id = update.effective_user.id
 
     # Check that the user has initialized with /start
-    user = get_user(user_id)
-    if not user:
+    session = get_session(user_id)
+    if session is None:
         text = "Hi there, let's get started by typing /start!"
-        await context.bot.send_message(chat_id=user_id, text=text)
+        send_message(context.bot, user_id, text)
         return
 
-    current_prompt = get_user_current_stage(user_id)
+    handled = await machine.dispatch(
+        update, session, InputKind.TEXT, update.message.text, context
+    )
 
     # Nothing to handle
-    if not current_prompt:
-        await show_main_menu(user, context=context)
+    if not handled:
+        await show_main_menu(session.user, context=context)
+
+
+# Wait this long (seconds) for the user to stop typing before searching
+INLINE_QUERY_DEBOUNCE = 0.3
+# How long Telegram may reuse an answer for the same user and query
+INLINE_QUERY_CACHE_TIME = 300
+
+# Map user id to the id of their latest inline query, so superseded ones can be dropped
+latest_inline_queries: dict[int, str] = {}
+
+
+@timed_handler
+async def inline_query(update: Update, context) -> None:
+    """Token search on the user's chain from any chat: @bot usdc"""
+    query = update.inline_query
+    user_id = query.from_user.id
+    text = query.query.strip()
+    if len(text) < 2:
         return
 
-    text = update.message.text
+    # Telegram sends a query per keystroke, only answer once the user pauses
+    latest_inline_queries[user_id] = query.id
+    await asyncio.sleep(INLINE_QUERY_DEBOUNCE)
+    if latest_inline_queries.get(user_id) != query.id:
+        return
+    del latest_inline_queries[user_id]
 
-    if current_prompt["command"] == Command.WITHDRAW and current_prompt["stage"] == 2:
-        await handle_withdraw_wallet_address(text, user, context=context)
-    elif current_prompt["command"] == Command.WITHDRAW and current_prompt["stage"] == 3:
-        await handle_withdraw_amount(text, user, context=context)
-    elif (
-        current_prompt["command"] == Command.SET_CHAIN and current_prompt["stage"] == 1
-    ):
-        await set_chain(update, user_id, text, context=context)
-    elif current_prompt["command"] == Command.SET_SLIPPAGE:
-        await set_slippage(update, user_id, text, context=context)
-    elif current_prompt["command"] == Command.SET_TOKEN0:
-        await set_token0(update, user_id, text, context=context)
-    elif current_prompt["command"] == Command.SET_TOKEN1:
-        await set_token1(update, user_id, text, context=context)
+    user = load_user(user_id)
+    chain_id = user.chain_id if user else None
+    if not chain_id:
+        await query.answer([], cache_time=0, is_personal=True)
+        return
+
+    try:
+        tokens = await find_tokens(chain_id, text)
+    except OneInchAPIError as e:
+        logger.warning("Failed to search tokens", extra={"error": str(e)})
+        await query.answer([], cache_time=0, is_personal=True)
+        return
+
+    # Choosing a result sends its address, which set_token0/set_token1 accept
+    results = [
+        InlineQueryResultArticle(
+            id=token["address"],
+            title=token["symbol"],
+            description=f"{token.get('name', '')}\n{token['address']}",
+            input_message_content=InputTextMessageContent(token["address"]),
+        )
+        for token in tokens
+    ]
+    # Results depend on the user's chain, so Telegram must not share them between users
+    await query.answer(results, cache_time=INLINE_QUERY_CACHE_TIME, is_personal=True)
+
+
+async def warm_up():
+    """
+    Pay for the slow first uses (imports, RPC connections, mnemonic seed, matplotlib font cache)
+    in the background, once the bot is already taking updates, rather than before it starts polling.
+    """
+    start = perf_counter()
+    results = await asyncio.gather(
+        asyncio.to_thread(wallet.warm_up),
+        asyncio.to_thread(charts.warm_up),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            logger.error("Failed to warm up", exc_info=result)
+    logger.info("Warmed up", extra={"seconds": perf_counter() - start})
+
+
+async def post_init(application: Application) -> None:
+    # Start from the caches the last process left, set CACHE_SNAPSHOT_PATH to enable
+    if SNAPSHOT_PATH:
+        await asyncio.to_thread(load_snapshot)
+        application.create_task(save_snapshots_forever())
+    application.create_task(warm_up())
+    # Report sync calls that block the event loop, set LOOP_MONITOR=off to disable
+    application.bot_data["loop_monitor"] = start_loop_monitor()
+    # Keep the token registries used for symbol search in sync with 1inch
+    application.create_task(sync_registries_forever())
+    # One job checks every price alert, pricing each distinct pair once per tick
+    application.create_task(check_alerts_forever(application.bot))
+    # Execute limit/stop orders as they trigger
+    application.create_task(OrderExecutor(application.bot).run_forever())
+    # Run recurring buys, grouped into windows so plans due together share quotes
+    application.create_task(DcaScheduler(application.bot).run_forever())
+    # Keep cached balances up to date from transfer logs, set BALANCE_WATCH_INTERVAL=0 to disable
+    if POLL_INTERVAL:
+        application.create_task(watch_balances_forever(application.bot))
+
+
+async def post_stop(application: Application) -> None:
+    # Send the messages still queued, e.g. swap and withdrawal confirmations. Here rather than in
+    # post_shutdown, as by then the bot can no longer send.
+    await get_outbox(application.bot).drain()
+
+
+async def post_shutdown(application: Application) -> None:
+    # Finish writing the transactions just sent to the ledger
+    await flush_ledger()
+    if SNAPSHOT_PATH:
+        await asyncio.to_thread(save_snapshot)
 
 
 def main() -> None:
+    setup_logging()
+
+    # Expose latency metrics on /metrics, set METRICS_PORT=0 to disable
+    metrics_port = int(getenv("METRICS_PORT", "9100"))
+    if metrics_port:
+        start_metrics_server(getenv("METRICS_HOST", "127.0.0.1"), metrics_port)
+
     # Replace 'TOKEN' with your bot token
     bot_token = getenv("BOT_TOKEN")
-    application = Application.builder().token(bot_token).build()
+    application = (
+        Application.builder()
+        .token(bot_token)
+        .request(TimedRequest())
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Start command to display the main menu
     application.add_handler(CommandHandler("start", start))
@@ -832,6 +1717,10 @@ def main() -> None:
     # MessageHandler to handle arbitrary messages, based on user's main menu selection
     application.add_handler(MessageHandler(filters.ALL, message_handler))
 
+    # Inline mode (enable it with BotFather's /setinline) for token search.
+    # Not blocking, so debouncing doesn't hold up other updates
+    application.add_handler(InlineQueryHandler(inline_query, block=False))
+
     # Run the bot until the user presses Ctrl-C
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
@@ -0,0 +1,187 @@
+# Minimal Prometheus style metrics (counters and histograms) and a /metrics endpoint to scrape them.
+# Kept dependency free so it can be imported from anywhere in the bot.
+import asyncio
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter
+
+# Upper bounds (in seconds) of histogram buckets, from a fast cache hit to a slow receipt wait
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...], extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values: dict[tuple[tuple[str, str], ...], float] = {}
+        self.lock = Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def expose(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self.lock:
+            for labels, value in self.values.items():
+                lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # Map labels to (count per bucket, sum, count)
+        self.values: dict[tuple[tuple[str, str], ...], list] = {}
+        self.lock = Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self.lock:
+            bucket_counts, total, count = self.values.get(
+                key, [[0] * len(self.buckets), 0.0, 0]
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    bucket_counts[i] += 1
+            self.values[key] = [bucket_counts, total + value, count + 1]
+
+    def expose(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self.lock:
+            for labels, (bucket_counts, total, count) in self.values.items():
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    label_str = _format_labels(labels, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{label_str} {bucket_count}")
+                label_str = _format_labels(labels, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{label_str} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+# Map metric name to metric
+registry: dict[str, Counter | Histogram] = {}
+
+
+def counter(name: str, description: str) -> Counter:
+    if name not in registry:
+        registry[name] = Counter(name, description)
+    return registry[name]
+
+
+def histogram(name: str, description: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+    if name not in registry:
+        registry[name] = Histogram(name, description, buckets)
+    return registry[name]
+
+
+def expose() -> str:
+    lines = []
+    for metric in registry.values():
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+# Metrics shared across modules
+handler_seconds = histogram(
+    "bot_handler_seconds", "Time spent handling a Telegram update, by handler"
+)
+handler_errors = counter(
+    "bot_handler_errors_total", "Telegram handlers that raised, by handler"
+)
+upstream_seconds = histogram(
+    "bot_upstream_seconds",
+    "Time spent on calls to other services (1inch, RPC, MySQL, Telegram), by upstream and operation",
+)
+upstream_errors = counter(
+    "bot_upstream_errors_total",
+    "Failed calls to other services, by upstream and operation",
+)
+cpu_seconds = histogram(
+    "bot_cpu_bound_seconds", "Time spent on CPU heavy work (charts, key derivation)"
+)
+
+
+@contextmanager
+def timer(metric: Histogram, errors: Counter | None = None, **labels):
+    """Observe how long the block took. If it raises, also count it in errors."""
+    start = perf_counter()
+    try:
+        yield
+    except BaseException:
+        if errors is not None:
+            errors.inc(**labels)
+        raise
+    finally:
+        metric.observe(perf_counter() - start, **labels)
+
+
+def timed(metric: Histogram, errors: Counter | None = None, **labels):
+    """Decorator version of timer, works on both sync and async functions"""
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with timer(metric, errors, **labels):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(metric, errors, **labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def timed_handler(func):
+    """Time a Telegram handler, labelled with its function name"""
+    return timed(handler_seconds, handler_errors, handler=func.__name__)(func)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = expose().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent, don't log them
+        pass
+
+
+def start_metrics_server(host: str = "127.0.0.1", port: int = 9100):
+    """Serve /metrics on a background thread"""
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+    return server
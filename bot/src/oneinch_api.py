@@ -1,71 +1,263 @@
+import json
+import logging
+import random
 import requests
+from concurrent.futures import Future
+from email.utils import parsedate_to_datetime
 from os import getenv
-from time import sleep
-from web3 import Web3
+from threading import Lock
+from time import sleep, monotonic, time
+from metrics import timed, upstream_seconds, upstream_errors, counter
+
+logger = logging.getLogger(__name__)
+
+responses_total = counter("bot_oneinch_responses_total", "Responses from 1inch, by status code")
 
 class NoAPIKeyError(Exception):
     def __init__(self, message):
         super().__init__(message)
 
 
+class OneInchAPIError(Exception):
+    """Request to 1inch failed. status_code is None if no response was received."""
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class RateLimitedError(OneInchAPIError):
+    """Still rate limited (429) after retrying"""
+
+
+class CircuitOpenError(OneInchAPIError):
+    """1inch has been failing, so requests are not being sent for now"""
+
+
+# Status codes worth retrying: rate limited or server side errors
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def is_unavailable_error(error: OneInchAPIError) -> bool:
+    """True if the request failed because of 1inch (or the network), rather than because it was invalid"""
+    return error.status_code is None or error.status_code in RETRY_STATUS_CODES
+
+
+class CircuitBreaker:
+    """
+    Stop sending requests after failure_threshold consecutive failures.
+    After reset_timeout seconds, a single trial request is let through; if it succeeds the circuit closes again.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+        self.lock = Lock()
+
+    def before_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if monotonic() - self.opened_at < self.reset_timeout or self.trial_in_progress:
+                raise CircuitOpenError("1inch API is unavailable, please try again later.")
+            self.trial_in_progress = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_progress = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = monotonic()
+
+
 class OneInchAPI:
-    def __init__(self, post_delay=1):
+    # Requests currently being made, so identical concurrent requests share one network call.
+    # Shared by all instances as each call site creates its own instance.
+    _in_flight: dict[str, Future] = {}
+    _in_flight_lock = Lock()
+
+    # Shared by all instances as they all talk to the same API
+    _circuit_breaker = CircuitBreaker()
+
+    def __init__(self, post_delay=None, max_retries=3, backoff_base=0.5, backoff_cap=8, timeout=10):
         """
         Debounce parameter is a delay in seconds to wait before executing the rest of the code.
         This may be needed in development purposes using a free API key due to the RPS limit.
         For now, each method will be in charge of implementing the debounce.
+
+        429 and 5xx responses are retried up to max_retries times, with exponential backoff
+        (backoff_base * 2^attempt, capped at backoff_cap, with full jitter) unless 1inch says how long
+        to wait with Retry-After. Methods raise OneInchAPIError (or a subclass) instead of returning
+        placeholder values when the request fails.
+
+        ONEINCH_API_BASE_URL and ONEINCH_POST_DELAY can point the bot at a local stand-in (see bench/).
         """
-        self.api_base_url = "https://api.1inch.dev"
+        self.api_base_url = getenv("ONEINCH_API_BASE_URL", "https://api.1inch.dev")
         api_key = getenv('ONEINCH_API_KEY')
         if not api_key:
             raise NoAPIKeyError("Set up your ONEINCH_API_KEY to initialise this class!")
         self.headers = {
                 "Authorization": f"Bearer {api_key}"
             }
-        self.post_delay = post_delay
+        self.post_delay = post_delay if post_delay is not None else float(getenv("ONEINCH_POST_DELAY", 1))
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.timeout = timeout
 
     def _build_api_url(self, api_name, version_number, chain_id, method_name):
         return f"{self.api_base_url}/{api_name}/v{version_number}/{chain_id}/{method_name}"
 
-    def quoted_swap(self, chain_id, src_token_address, dst_token_address, amount) -> float:
+    def _request(self, method, url, params=None, body=None) -> requests.Response:
+        """
+        Single-flight request: if an identical request is already in flight,
+        wait for it and share its response instead of sending another one.
+        """
+        key = json.dumps([method, url, params, body], sort_keys=True, default=str)
+        with self._in_flight_lock:
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._in_flight[key] = Future()
+
+        if not is_leader:
+            return future.result()
+
+        try:
+            response = self._send_with_retries(method, url, params, body)
+            future.set_result(response)
+            return response
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._in_flight_lock:
+                self._in_flight.pop(key, None)
+
+    def _send_with_retries(self, method, url, params=None, body=None) -> requests.Response:
+        self._circuit_breaker.before_request()
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                response = requests.request(
+                    method, url, headers=self.headers, params=params, json=body, timeout=self.timeout
+                )
+                responses_total.inc(status=response.status_code)
+                sleep(self.post_delay)
+                upstream_seconds.observe(self.post_delay, upstream="1inch", operation="post_delay")
+                if response.status_code not in RETRY_STATUS_CODES:
+                    break
+                retry_after = self._parse_retry_after(response.headers.get("Retry-After"))
+                error = (RateLimitedError if response.status_code == 429 else OneInchAPIError)(
+                    f"{method} {url} failed with {response.status_code}: {response.text}", response.status_code
+                )
+            except requests.RequestException as e:
+                responses_total.inc(status="none")
+                error = OneInchAPIError(f"{method} {url} failed: {e}")
+
+            if attempt == self.max_retries:
+                self._circuit_breaker.record_failure()
+                raise error
+            if retry_after is None:
+                retry_after = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2**attempt))
+            logger.warning(
+                "1inch request failed, retrying",
+                extra={"error": str(error), "status_code": error.status_code, "retry_after": retry_after},
+            )
+            sleep(retry_after)
+
+        # Client errors (e.g. invalid token address) mean 1inch itself is fine
+        self._circuit_breaker.record_success()
+        if not response.ok:
+            raise OneInchAPIError(
+                f"{method} {url} failed with {response.status_code}: {response.text}", response.status_code
+            )
+        return response
+
+    @staticmethod
+    def _parse_retry_after(value) -> float | None:
+        """Retry-After is either a number of seconds or a HTTP date"""
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _parse_json(response: requests.Response):
+        try:
+            return response.json()
+        except ValueError:
+            raise OneInchAPIError(f"Invalid response from 1inch: {response.text}", response.status_code)
+
+    @timed(upstream_seconds, upstream_errors, upstream="1inch", operation="quoted_swap")
+    def quoted_swap(self, chain_id, src_token_address, dst_token_address, amount) -> int:
+        """ Amount of dst token (bigint) that amount of src token swaps for """
         url = self._build_api_url("swap", 6.0, chain_id, "quote")
         params = {
             "src": src_token_address,
             "dst": dst_token_address,
             "amount": amount
         }
-        response = requests.get(url, headers=self.headers, params=params)
-        sleep(self.post_delay)
+        response = self._request("GET", url, params=params)
         try:
-            return float(response.json().get("dstAmount"))
-        except Exception as e:
-            print(e)
-            print(response)
-            print(response.text)
-            return 0.0
+            # int straight from the string, via float would lose precision above 2**53 (~0.009 of an 18 decimal token)
+            return int(self._parse_json(response)["dstAmount"])
+        except (KeyError, TypeError, ValueError):
+            raise OneInchAPIError(f"Unexpected quote response: {response.text}", response.status_code)
 
+    @timed(upstream_seconds, upstream_errors, upstream="1inch", operation="approve_swap_calldata")
     def approve_swap_calldata(self, chain_id, token_address, amount):
         url = self._build_api_url("swap", 6.0, chain_id, "approve/transaction")
         params = {
             "tokenAddress": token_address,
             "amount": amount
         }
-        response = requests.get(url, headers=self.headers, params=params)
-        sleep(self.post_delay)
+        response = self._request("GET", url, params=params)
+        calldata = self._parse_json(response)
+        # Imported here, web3 is slow to import and only needed once calldata is fetched
+        from web3 import Web3
         try:
             # Clean up tx response to be sent onchain
-            calldata = response.json()
             calldata["to"] = Web3.to_checksum_address(calldata["to"])
             calldata["gasPrice"] = int(calldata["gasPrice"])
             calldata["chainId"] = chain_id
             del calldata["value"]
             return calldata
-        except Exception as e:
-            print(e)
-            print(response)
-            print(response.text)
+        except (KeyError, TypeError, ValueError):
+            raise OneInchAPIError(f"Unexpected approve response: {response.text}", response.status_code)
+
+    @timed(upstream_seconds, upstream_errors, upstream="1inch", operation="get_allowance")
+    def get_allowance(self, chain_id, token_address, wallet_address) -> int:
+        url = self._build_api_url("swap", 6.0, chain_id, "approve/allowance")
+        params = {
+            "tokenAddress": token_address,
+            "walletAddress": wallet_address
+        }
+        response = self._request("GET", url, params=params)
+        try:
+            return int(self._parse_json(response)["allowance"])
+        except (KeyError, TypeError, ValueError):
+            raise OneInchAPIError(f"Unexpected allowance response: {response.text}", response.status_code)
 
-    def perform_swap_calldata(self, chain_id, src_token_address, dst_token_address, amount, from_origin, slippage):
+    @timed(upstream_seconds, upstream_errors, upstream="1inch", operation="perform_swap_calldata")
+    def perform_swap_calldata(self, chain_id, src_token_address, dst_token_address, amount, from_origin, slippage, disable_estimate=False):
+        """
+        disable_estimate should be set when the allowance is not onchain yet (e.g. approval still pending),
+        otherwise 1inch rejects the request. Gas is estimated again before sending anyway.
+        """
         url = self._build_api_url("swap", 6.0, chain_id, "swap")
         params = {
             "src": src_token_address,
@@ -75,78 +267,63 @@ class OneInchAPI:
             "origin": from_origin,
             "slippage": slippage,
             "includeGas": "true",
-            "disableEstimate": "false"
+            "disableEstimate": "true" if disable_estimate else "false"
         }
-        response = requests.get(url, headers=self.headers, params=params)
-        sleep(self.post_delay)
+        response = self._request("GET", url, params=params)
+        calldata = self._parse_json(response)
+        from web3 import Web3
         try:
             # Clean up tx response to be sent onchain
-            calldata = response.json()
             calldata["tx"]["to"] = Web3.to_checksum_address(calldata["tx"]["to"])
             calldata["tx"]["from"] = Web3.to_checksum_address(calldata["tx"]["from"])
             calldata["tx"]["gasPrice"] = int(calldata["tx"]["gasPrice"])
             calldata["tx"]["chainId"] = chain_id
-            del calldata["tx"]["value"]
+            # Non-zero when swapping from the native token, which is sent along with the call
+            calldata["tx"]["value"] = int(calldata["tx"]["value"])
             return calldata
-        except Exception as e:
-            print(e)
-            print(response)
-            print(response.text)
+        except (KeyError, TypeError, ValueError):
+            raise OneInchAPIError(f"Unexpected swap response: {response.text}", response.status_code)
 
+    @timed(upstream_seconds, upstream_errors, upstream="1inch", operation="get_historical_chart_data")
     def get_historical_chart_data(self, chain_id, token0, token1, period="24H"):
         assert period in ["24H", "1W", "1Y", "AllTime"], 'Please select period from ["24H", "1W", "1Y", "AllTime"]'
         url = f"{self.api_base_url}/charts/v1.0/chart/line/{token0}/{token1}/{period}/{chain_id}"
-        response = requests.get(url, headers=self.headers)
-        sleep(self.post_delay)
-        try:
-            return response.json()
-        except Exception as e:
-            print(e)
-            print(response)
-            print(response.text)
+        response = self._request("GET", url)
+        return self._parse_json(response)
 
+    @timed(upstream_seconds, upstream_errors, upstream="1inch", operation="search_tokens")
     def search_tokens(self, chain_id, token_query, include_unrated="true"):
         url = self._build_api_url("token", 1.2, chain_id, "search")
         params = {
             "query": token_query,
             "only_positive_rating": include_unrated
         }
-        response = requests.get(url, headers=self.headers, params=params)
-        sleep(self.post_delay)
-        try:
-           return response.json()
-        except Exception as e:
-            print(e)
-            print(response)
-            print(response.text)
+        response = self._request("GET", url, params=params)
+        return self._parse_json(response)
+
+    @timed(upstream_seconds, upstream_errors, upstream="1inch", operation="get_token_list")
+    def get_token_list(self, chain_id) -> dict:
+        """ All tokens 1inch lists on the chain, as a map of address to token info """
+        url = f"{self.api_base_url}/token/v1.2/{chain_id}"
+        response = self._request("GET", url)
+        return self._parse_json(response)
 
+    @timed(upstream_seconds, upstream_errors, upstream="1inch", operation="get_token_balance")
     def get_token_balance(self, chain_id, wallet_address, token_addresses=[]):
         url = self._build_api_url("balance", 1.2, chain_id, "balances")
         url += f"/{wallet_address}"
         if token_addresses:
-            response = requests.post(url, json={"tokens": token_addresses}, headers=self.headers)
+            response = self._request("POST", url, body={"tokens": token_addresses})
         else:
-            response = requests.get(url, headers=self.headers)
-        sleep(self.post_delay)
-        try:
-            return response.json()
-        except Exception as e:
-            print(e)
-            print(response)
-            print(response.text)
+            response = self._request("GET", url)
+        return self._parse_json(response)
     
+    @timed(upstream_seconds, upstream_errors, upstream="1inch", operation="get_token_info")
     def get_token_info(self, chain_id, token_address: str) -> dict:
         url = self._build_api_url("token", 1.2, chain_id, f"custom")
         url += f"/{token_address}"
-        response = requests.get(url, headers=self.headers)
-        sleep(self.post_delay)
-        try:
-            return response.json()
-        except Exception as e:
-            print(e)
-            print(response)
-            print(response.text)
-            return {}
+        response = self._request("GET", url)
+        return self._parse_json(response)
 
 
 if __name__ == '__main__':
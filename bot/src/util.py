@@ -1,3 +1,6 @@
+from decimal import Decimal, InvalidOperation, ROUND_DOWN, localcontext
+
+
 def tuple_to_dict(tup, names: list[str]):
     """ Convert tuple to dict """
     return {k: v for k, v in zip(names, tup)}
@@ -8,11 +11,55 @@ def tuples_to_dicts(tups, names: list[str]):
     return list(map(lambda tup: tuple_to_dict(tup, names), tups))
 
 
+# Amounts are bigints in the token's smallest unit from balance to transaction.
+# Human amounts are Decimal (or float, only for display and valuation).
+
+# Enough digits for any uint256 amount, the default 28 would round large 18 decimal amounts
+AMOUNT_PRECISION = 80
+
+
 def parse_decimal(value, decimal) -> float:
-    """ Parse bigint into human amount. """
+    """ Parse bigint into human amount, for display and valuation only. """
     return int(value) / (10**decimal)
 
 
-def format_decimal(value, decimal):
-    """ format human amount into bigint. """
-    return int(value * (10**decimal))
+def to_decimal(value, decimal) -> Decimal:
+    """ Parse bigint into exact human amount. """
+    with localcontext() as ctx:
+        ctx.prec = AMOUNT_PRECISION
+        return Decimal(int(value)).scaleb(-decimal)
+
+
+def format_decimal(value, decimal) -> int:
+    """ format human amount (str, Decimal, int or float) into bigint, rounding down so it never exceeds the amount. """
+    if isinstance(value, float):
+        # Its shortest repr, 0.1 rather than 0.1000000000000000055...
+        value = repr(value)
+    with localcontext() as ctx:
+        ctx.prec = AMOUNT_PRECISION
+        return int(Decimal(value).scaleb(decimal).to_integral_value(rounding=ROUND_DOWN))
+
+
+def parse_amount(text: str, decimal) -> int:
+    """ Parse an amount entered by the user into bigint. Raises ValueError unless it is a positive number. """
+    try:
+        value = Decimal(text.strip())
+    except InvalidOperation:
+        raise ValueError(f"Invalid amount: {text}")
+    if not value.is_finite() or value <= 0:
+        raise ValueError(f"Invalid amount: {text}")
+    amount = format_decimal(value, decimal)
+    if amount == 0:
+        raise ValueError(f"Amount smaller than the token allows: {text}")
+    return amount
+
+
+def format_amount(value, decimal) -> str:
+    """ Exact human amount of a bigint, without trailing zeros, e.g. 1.5 """
+    text = f"{to_decimal(value, decimal):f}"
+    return text.rstrip("0").rstrip(".") if "." in text else text
+
+
+def percentage_of(amount: int, percentage: int) -> int:
+    """ Percentage of a bigint amount in integers, rounded down: 100% is exactly the whole amount. """
+    return amount * percentage // 100
@@ -1,95 +1,352 @@
+import logging
+from functools import lru_cache
 from os import getenv
-from eth_account import Account
-from web3 import Web3
-from web3.middleware import ExtraDataToPOAMiddleware
-from web3.exceptions import TransactionNotFound
+from threading import Lock
 from time import sleep
 from constants import erc20_abi
-from util import parse_decimal, format_decimal
-from constants import networks
-from oneinch_api import OneInchAPI
+from constants import networks, NATIVE_TOKEN_ADDRESS
+from metrics import timed, timer, upstream_seconds, upstream_errors, cpu_seconds
 
+logger = logging.getLogger(__name__)
+
+# web3 and eth_account take about a second to import, so they are imported on first use
+# and warm_up pays for that in the background after startup.
+
+# Map RPC url to its connected Web3, shared by every call for that RPC
+providers: dict = {}
+providers_lock = Lock()
+
+
+@timed(upstream_seconds, upstream_errors, upstream="rpc", operation="connect")
+def _connect(rpc):
+    from web3 import Web3
+    from web3.middleware import ExtraDataToPOAMiddleware
 
-def initialise_w3(rpc):
     provider = rpc
     assert provider, "Please configure your ALCHEMY_API_KEY"
     w3 = Web3(Web3.HTTPProvider(provider))
     if not w3.is_connected():
         raise Exception("Failed to conenct to your configured RPC_PROVIDER")
+    # PoA chains (e.g. Polygon) have extra data in their blocks
+    w3.middleware_onion.inject(ExtraDataToPOAMiddleware, layer=0)
     return w3
 
 
-def execute_transaction(rpc, transaction, private_key):
+def initialise_w3(rpc):
+    """Connected Web3 for the RPC, from the pool. Must not be put into batch mode, that is shared state."""
+    w3 = providers.get(rpc)
+    if w3 is None:
+        with providers_lock:
+            w3 = providers.get(rpc)
+            if w3 is None:
+                w3 = providers[rpc] = _connect(rpc)
+    return w3
+
+
+@timed(upstream_seconds, upstream_errors, upstream="rpc", operation="block_number")
+def get_block_number(rpc) -> int:
+    w3 = initialise_w3(rpc)
+    return w3.eth.block_number
+
+
+@timed(upstream_seconds, upstream_errors, upstream="rpc", operation="gas_price")
+def get_gas_price(rpc) -> int:
+    """Current gas price in wei"""
+    w3 = initialise_w3(rpc)
+    return w3.eth.gas_price
+
+
+@timed(upstream_seconds, upstream_errors, upstream="rpc", operation="balance_of")
+def get_token_balance(rpc, token_address, address) -> int:
+    """ERC-20 balance of the address, in the token's smallest unit"""
+    from web3 import Web3
+
+    w3 = initialise_w3(rpc)
+    token_contract = w3.eth.contract(
+        address=Web3.to_checksum_address(token_address), abi=erc20_abi
+    )
+    return token_contract.functions.balanceOf(Web3.to_checksum_address(address)).call()
+
+
+# keccak("Transfer(address,address,uint256)")
+TRANSFER_TOPIC = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+
+
+@timed(upstream_seconds, upstream_errors, upstream="rpc", operation="get_logs")
+def get_transfer_logs(
+    rpc, from_block: int, to_block: int, address_topics: list[list[str]]
+) -> list:
+    """
+    ERC-20 Transfer logs in the block range from or to any of the addresses, given as 32 byte topics in chunks.
+    Each chunk takes one filter per direction, whatever the number of addresses in it.
+    """
+    w3 = initialise_w3(rpc)
+    logs = []
+    for chunk in address_topics:
+        for topics in ([TRANSFER_TOPIC, chunk], [TRANSFER_TOPIC, None, chunk]):
+            logs += w3.eth.get_logs(
+                {"fromBlock": from_block, "toBlock": to_block, "topics": topics}
+            )
+    return logs
+
+
+@timed(upstream_seconds, upstream_errors, upstream="rpc", operation="get_transaction")
+def get_transaction_sender(rpc, tx_hash) -> str:
+    w3 = initialise_w3(rpc)
+    return w3.eth.get_transaction(tx_hash)["from"]
+
+
+def send_transaction(rpc, transaction, private_key, on_signed=None) -> str:
+    """
+    Sign and broadcast a transaction without waiting for it to be mined. Returns tx hash.
+    on_signed is called with the tx hash before broadcasting, e.g. to record it in case the process dies.
+    """
     w3 = initialise_w3(rpc)
     account = w3.eth.account.from_key(private_key)
 
     # Estimate Gas
-    print("DEBUG!")
-    print(transaction)
-    transaction = {
-        **transaction,
-        "from": account.address,
-        "nonce": w3.eth.get_transaction_count(str(account.address)),
-    }
-    print("DEBUG GAS!!")
-    print(transaction)
-    gas = w3.eth.estimate_gas(transaction)
-    print("DEBUG GAS 2!")
-    print(gas)
-    transaction = {
-        **transaction,
-        "nonce": w3.eth.get_transaction_count(str(account.address)),
-        "gas": gas,
-    }
-    signed_tx = w3.eth.account.sign_transaction(transaction, private_key)
-    tx_hash = w3.eth.send_raw_transaction(signed_tx.raw_transaction).hex()
+    with timer(
+        upstream_seconds, upstream_errors, upstream="rpc", operation="estimate_gas"
+    ):
+        transaction = {
+            **transaction,
+            "from": account.address,
+            "nonce": w3.eth.get_transaction_count(str(account.address)),
+        }
+        gas = w3.eth.estimate_gas(transaction)
+    logger.debug("Estimated gas", extra={"transaction": transaction, "gas": gas})
+    with timer(
+        upstream_seconds, upstream_errors, upstream="rpc", operation="send_transaction"
+    ):
+        transaction = {
+            **transaction,
+            "nonce": w3.eth.get_transaction_count(str(account.address)),
+            "gas": gas,
+        }
+        signed_tx = w3.eth.account.sign_transaction(transaction, private_key)
+        if on_signed is not None:
+            on_signed(signed_tx.hash.hex())
+        tx_hash = w3.eth.send_raw_transaction(signed_tx.raw_transaction).hex()
+    logger.info("Sent transaction", extra={"tx_hash": tx_hash, "from": account.address})
+    return tx_hash
+
+
+@timed(
+    upstream_seconds, upstream_errors, upstream="rpc", operation="wait_for_transaction"
+)
+def wait_for_transaction(rpc, tx_hash):
+    """Wait up to 60 seconds for the transaction to be mined. Returns the receipt, or None."""
+    from web3.exceptions import TransactionNotFound
+
+    w3 = initialise_w3(rpc)
     for i in range(60):
         try:
-            print(tx_receipt := w3.eth.get_transaction_receipt(tx_hash))
-            print(tx_receipt.status)
-            print(tx_receipt["status"])
-            return tx_receipt.status
+            tx_receipt = w3.eth.get_transaction_receipt(tx_hash)
+            logger.info(
+                "Transaction mined",
+                extra={
+                    "tx_hash": tx_hash,
+                    "status": tx_receipt.status,
+                    "block_number": tx_receipt.blockNumber,
+                },
+            )
+            return tx_receipt
         except TransactionNotFound:
-            print("tx not found onchain, waiting")
+            logger.debug("tx not found onchain, waiting", extra={"tx_hash": tx_hash})
             sleep(1)
         except KeyboardInterrupt:
-            print("quitting retries")
-            return 0
+            logger.info("quitting retries", extra={"tx_hash": tx_hash})
+            return None
+    logger.warning("Transaction not mined in time", extra={"tx_hash": tx_hash})
+
+
+def wait_for_transactions(rpc, tx_hashes: list[str]) -> dict[str, object]:
+    """
+    Wait for transactions sent from one account with consecutive nonces, in nonce order.
+    They are mined in that order, so only the last is polled and the rest are then fetched in one batch request.
+    Returns a map of tx hash to receipt, or None if not mined in time.
+    """
+    from web3.exceptions import TransactionNotFound
 
+    if not tx_hashes:
+        return {}
+    receipts = {tx_hashes[-1]: wait_for_transaction(rpc, tx_hashes[-1])}
+    earlier = tx_hashes[:-1]
+    if not earlier:
+        return receipts
+
+    # Its own connection, batch mode would catch other threads' calls on a pooled one
+    w3 = _connect(rpc)
+    with timer(
+        upstream_seconds, upstream_errors, upstream="rpc", operation="get_receipts"
+    ):
+        if receipts[tx_hashes[-1]] is not None:
+            try:
+                with w3.batch_requests() as batch:
+                    for tx_hash in earlier:
+                        batch.add(w3.eth.get_transaction_receipt(tx_hash))
+                    return {**dict(zip(earlier, batch.execute())), **receipts}
+            except Exception as e:
+                # Not every node supports batching
+                logger.warning("Batched receipts failed", extra={"error": str(e)})
+        for tx_hash in earlier:
+            try:
+                receipts[tx_hash] = w3.eth.get_transaction_receipt(tx_hash)
+            except TransactionNotFound:
+                receipts[tx_hash] = None
+    return receipts
+
+
+def sweep_wallet(rpc, token_balances: dict[str, int], to_address, private_key):
+    """
+    Send every ERC-20 balance, then the native token left after gas, to to_address.
+    Transfers are pipelined: signed with consecutive nonces and broadcast without waiting for each other,
+    then confirmed with one wait. token_balances maps ERC-20 address to amount, native balance is read on chain.
+    Returns a result per transfer: token_address, amount, tx_hash (None if not sent), receipt (None if not mined) and success.
+    """
+    from web3 import Web3
+
+    w3 = initialise_w3(rpc)
+    account = w3.eth.account.from_key(private_key)
+    to_address = Web3.to_checksum_address(to_address)
+    # Legacy gas price so the gas the transfers can use, and so the native amount left over, is exact
+    gas_price = w3.eth.gas_price
+    nonce = w3.eth.get_transaction_count(account.address, "pending")
+
+    results = []
+    gas_reserved = 0
+
+    def send(token_address, amount, build_transaction):
+        """Build the transfer for the next nonce (estimating its gas), sign and broadcast it"""
+        nonlocal nonce, gas_reserved
+        result = {
+            "token_address": token_address,
+            "amount": amount,
+            "tx_hash": None,
+            "receipt": None,
+            "success": False,
+        }
+        results.append(result)
+        try:
+            with timer(
+                upstream_seconds,
+                upstream_errors,
+                upstream="rpc",
+                operation="send_transaction",
+            ):
+                transaction = build_transaction(
+                    {"from": account.address, "nonce": nonce, "gasPrice": gas_price}
+                )
+                signed_txn = w3.eth.account.sign_transaction(transaction, private_key)
+                result["tx_hash"] = w3.eth.send_raw_transaction(
+                    signed_txn.raw_transaction
+                ).hex()
+        except Exception as e:
+            # Not sent, so the next transfer takes its nonce
+            logger.warning(
+                "Failed to send sweep transfer",
+                extra={"token_address": token_address, "error": str(e)},
+            )
+            return
+        nonce += 1
+        gas_reserved += transaction["gas"] * gas_price
+
+    for token_address, amount in token_balances.items():
+        if token_address.lower() == NATIVE_TOKEN_ADDRESS or amount <= 0:
+            continue
+        token_contract = w3.eth.contract(
+            address=Web3.to_checksum_address(token_address), abi=erc20_abi
+        )
+        send(
+            token_address,
+            amount,
+            token_contract.functions.transfer(to_address, amount).build_transaction,
+        )
+
+    # Native last, less the most gas every transfer (including this one) can use
+    native_gas = 21000
+    value = w3.eth.get_balance(account.address) - gas_reserved - native_gas * gas_price
+    if value > 0:
+        send(
+            NATIVE_TOKEN_ADDRESS,
+            value,
+            lambda params: {
+                **params,
+                "to": to_address,
+                "value": value,
+                "gas": native_gas,
+                "chainId": w3.eth.chain_id,
+            },
+        )
+
+    sent = [result["tx_hash"] for result in results if result["tx_hash"]]
+    logger.info("Sent sweep", extra={"tx_hashes": sent, "from": account.address})
+    receipts = wait_for_transactions(rpc, sent)
+    for result in results:
+        receipt = receipts.get(result["tx_hash"])
+        result["receipt"] = receipt
+        result["success"] = bool(receipt and receipt["status"])
+    return results
+
+
+def execute_transaction(rpc, transaction, private_key):
+    tx_hash = send_transaction(rpc, transaction, private_key)
+    tx_receipt = wait_for_transaction(rpc, tx_hash)
+    return tx_receipt.status if tx_receipt else 0
+
+
+def withdraw_tokens(rpc, token_address, to_address, private_key, amount=0):
+    """
+    Transfer amount (bigint, in the token's smallest unit) of an ERC-20 token, or the whole balance if 0.
+    Returns (tx hash, receipt), (None, None) if the balance is too low and the receipt None if not mined in time.
+    """
+    from web3 import Web3
 
-def withdraw_tokens(rpc, chain_id, token_address, to_address, private_key, amount=0):
     w3 = initialise_w3(rpc)
-    w3.middleware_onion.inject(ExtraDataToPOAMiddleware, layer=0)
-    oneinch = OneInchAPI()
-    token_info = oneinch.get_token_info(chain_id, token_address)
-    token_decimals = token_info["decimals"]
     account = w3.eth.account.from_key(private_key)
     token_contract = w3.eth.contract(
         address=Web3.to_checksum_address(token_address), abi=erc20_abi
     )
+    balance = token_contract.functions.balanceOf(account.address).call()
     if amount == 0:
-        amount = token_contract.functions.balanceOf(account.address).call()
-    else:
-        amount = format_decimals(amount, token_decimals)
+        amount = balance
+    elif amount > balance:
+        logger.info(
+            "Withdrawal exceeds balance", extra={"amount": amount, "balance": balance}
+        )
+        return None, None
     # Get the nonce (transaction count) for the sending account
     nonce = w3.eth.get_transaction_count(account.address)
     transaction = token_contract.functions.transfer(
         Web3.to_checksum_address(to_address), amount
     ).build_transaction({"from": account.address, "nonce": nonce})
-    signed_txn = w3.eth.account.sign_transaction(transaction, private_key)
-    tx_hash = w3.eth.send_raw_transaction(signed_txn.raw_transaction)
-    for i in range(60):
-        try:
-            print(tx_receipt := w3.eth.get_transaction_receipt(tx_hash))
-            print(tx_receipt.status)
-            print(tx_receipt["status"])
-            return tx_receipt.status
-        except TransactionNotFound:
-            print("tx not found onchain, waiting")
-            sleep(1)
-        except KeyboardInterrupt:
-            print("quitting retries")
-            return 0
+    with timer(
+        upstream_seconds, upstream_errors, upstream="rpc", operation="send_transaction"
+    ):
+        signed_txn = w3.eth.account.sign_transaction(transaction, private_key)
+        tx_hash = w3.eth.send_raw_transaction(signed_txn.raw_transaction).hex()
+    logger.info("Sent withdrawal", extra={"tx_hash": tx_hash, "from": account.address})
+    return tx_hash, wait_for_transaction(rpc, tx_hash)
+
+
+@timed(cpu_seconds, operation="derive_wallet")
+def _derive_account(derivation_path_int: int, master_key: str):
+    """
+    Each derivation is 2048 rounds of PBKDF2, so only the addresses are kept, see _derive_address.
+    The path goes in as the mnemonic passphrase (with the default account path): that is how every
+    existing wallet was derived, so it must stay that way.
+    """
+    from eth_account import Account
+
+    Account.enable_unaudited_hdwallet_features()
+    derivation_path_str = f"m/0'/{derivation_path_int}"
+    return Account.from_mnemonic(master_key, derivation_path_str)
+
+
+@lru_cache(maxsize=4096)
+def _derive_address(derivation_path_int: int, master_key: str) -> str:
+    # The address is all the index and menus need, the private key is derived again to sign
+    return _derive_account(derivation_path_int, master_key).address
 
 
 def get_wallet_details(derivation_path_int: int, master_key: str | None = None):
@@ -100,21 +357,40 @@ def get_wallet_details(derivation_path_int: int, master_key: str | None = None):
     """
     if not master_key:
         master_key = getenv("DERIVATION_MASTER_KEY")
-    derivation_path_str = f"m/0'/{derivation_path_int}"
-    account = Account.from_mnemonic(master_key, derivation_path_str)
 
-    return {"address": account.address, "private_key": account.key}
+    return {"address": _derive_address(derivation_path_int, master_key)}
+
+
+def get_private_key(derivation_path_int: int, master_key: str | None = None):
+    """The wallet's private key, derived on every call so it is not kept in memory. Slow, run in a thread."""
+    if not master_key:
+        master_key = getenv("DERIVATION_MASTER_KEY")
+    return _derive_account(derivation_path_int, master_key).key
+
+
+def warm_up():
+    """Import web3 and eth_account, connect to every chain's RPC and load the mnemonic word lists"""
+    master_key = getenv("DERIVATION_MASTER_KEY")
+    if master_key:
+        _derive_address(0, master_key)
+    for chain_id, network in networks.items():
+        try:
+            initialise_w3(network["rpc"])
+        except Exception as e:
+            # Not fatal, it connects again on first use
+            logger.warning(
+                "Failed to connect to RPC",
+                extra={"chain_id": chain_id, "error": str(e)},
+            )
 
 
 if __name__ == "__main__":
     from oneinch_api import OneInchAPI
-    from util import parse_decimal, format_decimal
 
     oneinch = OneInchAPI()
     rpc = networks[137]["rpc"]
     withdraw_tokens(
         rpc,
-        137,
         "0x3c499c542cEF5E3811e1192ce70d8cC03d5c3359",
         "0xB73f259E3d061e21b8725950d8aEFc8449A64c35",
         getenv("PK"),
@@ -0,0 +1,11 @@
+-- CreateTable
+CREATE TABLE `tokens` (
+    `chain_id` INTEGER NOT NULL,
+    `address` VARCHAR(42) NOT NULL,
+    `symbol` VARCHAR(191) NOT NULL,
+    `name` VARCHAR(191) NOT NULL,
+    `decimals` INTEGER NOT NULL,
+    `updated_at` DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+
+    PRIMARY KEY (`chain_id`, `address`)
+) DEFAULT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
@@ -0,0 +1,18 @@
+-- CreateTable
+CREATE TABLE `price_alerts` (
+    `id` INTEGER NOT NULL AUTO_INCREMENT,
+    `user_id` INTEGER NOT NULL,
+    `chain_id` INTEGER NOT NULL,
+    `token0_address` VARCHAR(42) NOT NULL,
+    `token0_name` VARCHAR(191) NOT NULL,
+    `token1_address` VARCHAR(42) NOT NULL,
+    `token1_name` VARCHAR(191) NOT NULL,
+    `threshold` DOUBLE NOT NULL,
+    `above` BOOLEAN NOT NULL,
+    `created_at` DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+    `triggered_at` DATETIME(3) NULL,
+
+    INDEX `price_alerts_user_id_idx`(`user_id`),
+    INDEX `price_alerts_triggered_at_chain_id_token0_address_token1_address_idx`(`triggered_at`, `chain_id`, `token0_address`, `token1_address`),
+    PRIMARY KEY (`id`)
+) DEFAULT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
@@ -0,0 +1,23 @@
+-- CreateTable
+CREATE TABLE `orders` (
+    `id` INTEGER NOT NULL AUTO_INCREMENT,
+    `user_id` INTEGER NOT NULL,
+    `chain_id` INTEGER NOT NULL,
+    `side` VARCHAR(4) NOT NULL,
+    `order_type` VARCHAR(5) NOT NULL,
+    `token0_address` VARCHAR(42) NOT NULL,
+    `token0_name` VARCHAR(191) NOT NULL,
+    `token1_address` VARCHAR(42) NOT NULL,
+    `token1_name` VARCHAR(191) NOT NULL,
+    `trigger_price` DOUBLE NOT NULL,
+    `percentage` INTEGER NOT NULL,
+    `status` VARCHAR(16) NOT NULL DEFAULT 'open',
+    `tx_hash` VARCHAR(66) NULL,
+    `error` VARCHAR(191) NULL,
+    `created_at` DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+    `updated_at` DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+
+    INDEX `orders_status_idx`(`status`),
+    INDEX `orders_user_id_status_idx`(`user_id`, `status`),
+    PRIMARY KEY (`id`)
+) DEFAULT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
@@ -0,0 +1,22 @@
+-- CreateTable
+CREATE TABLE `dca_plans` (
+    `id` INTEGER NOT NULL AUTO_INCREMENT,
+    `user_id` INTEGER NOT NULL,
+    `chain_id` INTEGER NOT NULL,
+    `token0_address` VARCHAR(42) NOT NULL,
+    `token0_name` VARCHAR(191) NOT NULL,
+    `token1_address` VARCHAR(42) NOT NULL,
+    `token1_name` VARCHAR(191) NOT NULL,
+    `token1_decimals` INTEGER NOT NULL,
+    `amount` DECIMAL(65, 0) NOT NULL,
+    `interval_hours` INTEGER NOT NULL,
+    `next_run_at` DATETIME(3) NOT NULL,
+    `last_run_at` DATETIME(3) NULL,
+    `last_error` VARCHAR(191) NULL,
+    `active` BOOLEAN NOT NULL DEFAULT true,
+    `created_at` DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+
+    INDEX `dca_plans_active_next_run_at_idx`(`active`, `next_run_at`),
+    INDEX `dca_plans_user_id_active_idx`(`user_id`, `active`),
+    PRIMARY KEY (`id`)
+) DEFAULT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
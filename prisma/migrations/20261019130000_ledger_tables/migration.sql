@@ -0,0 +1,43 @@
+-- CreateTable
+CREATE TABLE `ledger_entries` (
+    `id` INTEGER NOT NULL AUTO_INCREMENT,
+    `user_id` INTEGER NOT NULL,
+    `chain_id` INTEGER NOT NULL,
+    `kind` VARCHAR(8) NOT NULL,
+    `tx_hash` VARCHAR(66) NOT NULL,
+    `success` BOOLEAN NOT NULL,
+    `src_token_address` VARCHAR(42) NOT NULL,
+    `src_amount` DECIMAL(65, 0) NOT NULL,
+    `dst_token_address` VARCHAR(42) NULL,
+    `dst_amount` DECIMAL(65, 0) NULL,
+    `to_address` VARCHAR(42) NULL,
+    `gas_used` BIGINT NOT NULL DEFAULT 0,
+    `gas_price` DECIMAL(65, 0) NOT NULL DEFAULT 0,
+    `price` DOUBLE NULL,
+    `usd_value` DOUBLE NULL,
+    `gas_usd` DOUBLE NULL,
+    `created_at` DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+
+    UNIQUE INDEX `ledger_entries_tx_hash_key`(`tx_hash`),
+    INDEX `ledger_entries_user_id_created_at_idx`(`user_id`, `created_at`),
+    INDEX `ledger_entries_chain_id_src_token_address_dst_token_address_idx`(`chain_id`, `src_token_address`, `dst_token_address`),
+    PRIMARY KEY (`id`)
+) DEFAULT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
+
+-- CreateTable
+CREATE TABLE `pnl_positions` (
+    `user_id` INTEGER NOT NULL,
+    `chain_id` INTEGER NOT NULL,
+    `token_address` VARCHAR(42) NOT NULL,
+    `bought_amount` DECIMAL(65, 0) NOT NULL DEFAULT 0,
+    `bought_usd` DOUBLE NOT NULL DEFAULT 0,
+    `sold_amount` DECIMAL(65, 0) NOT NULL DEFAULT 0,
+    `sold_usd` DOUBLE NOT NULL DEFAULT 0,
+    `withdrawn_amount` DECIMAL(65, 0) NOT NULL DEFAULT 0,
+    `gas_amount` DECIMAL(65, 0) NOT NULL DEFAULT 0,
+    `gas_usd` DOUBLE NOT NULL DEFAULT 0,
+    `unpriced` INTEGER NOT NULL DEFAULT 0,
+    `updated_at` DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+
+    PRIMARY KEY (`user_id`, `chain_id`, `token_address`)
+) DEFAULT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;